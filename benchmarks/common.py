@@ -0,0 +1,60 @@
+"""
+Helpers shared by the benchmarks that write comparable JSON results.
+"""
+
+import json
+import os
+import subprocess
+import time
+from typing import Dict, List, Optional
+
+
+def percentile(values: List[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+def summarize(latencies: List[float], elapsed: Optional[float] = None, errors: int = 0) -> Dict:
+    """
+    Reduces latencies in seconds to the summary stored per benchmark: count, throughput and percentiles in milliseconds.
+    """
+    summary: Dict = {"requests": len(latencies), "errors": errors}
+    if elapsed:
+        summary["throughput_rps"] = round(len(latencies) / elapsed, 2)
+    if latencies:
+        summary.update(
+            {
+                "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+                "p90_ms": round(percentile(latencies, 0.90) * 1000, 3),
+                "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+                "max_ms": round(max(latencies) * 1000, 3),
+            }
+        )
+    return summary
+
+
+def run_metadata(**config) -> Dict:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "commit": commit,
+        "cpu_count": os.cpu_count(),
+        "config": config,
+    }
+
+
+def write_results(payload: Dict, output: Optional[str]) -> None:
+    """
+    Prints the results and, if output is set, saves them so later runs can be compared with benchmarks.compare.
+    """
+    text = json.dumps(payload, indent=2)
+    if output:
+        os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+        with open(output, "w") as f:
+            f.write(text + "\n")
+    print(text)
@@ -0,0 +1,57 @@
+"""
+Compares two result files written with --output by benchmarks.load_test or
+benchmarks.service_micro, and exits with status 1 if any latency percentile regressed by more
+than the tolerance or throughput dropped by more than it.
+
+    python -m benchmarks.compare baseline.json candidate.json --tolerance 0.10
+"""
+
+import argparse
+import json
+import sys
+
+LATENCY_KEYS = ("p50_ms", "p90_ms", "p99_ms")
+
+
+def compare(baseline: dict, candidate: dict, tolerance: float) -> list:
+    rows = []
+    for name, before in baseline["results"].items():
+        after = candidate["results"].get(name)
+        if after is None:
+            continue
+        for key in LATENCY_KEYS + ("throughput_rps",):
+            if key not in before or key not in after or not before[key]:
+                continue
+            change = (after[key] - before[key]) / before[key]
+            worse = -change if key == "throughput_rps" else change
+            rows.append(
+                {
+                    "name": name,
+                    "metric": key,
+                    "baseline": before[key],
+                    "candidate": after[key],
+                    "change": round(change, 4),
+                    "regression": worse > tolerance,
+                }
+            )
+    return rows
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("baseline")
+    parser.add_argument("candidate")
+    parser.add_argument("--tolerance", type=float, default=0.10)
+    args = parser.parse_args()
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+    rows = compare(baseline, candidate, args.tolerance)
+    print(json.dumps(rows, indent=2))
+    if any(row["regression"] for row in rows):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
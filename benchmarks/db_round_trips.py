@@ -0,0 +1,135 @@
+"""
+Counts Postgres round-trips per image request for the old create-then-update write pair and
+for the single-write / batched-transition paths in project.image_request_store.
+
+Requires a database set up with `prisma db push`:
+
+    DATABASE_URL=... python -m benchmarks.db_round_trips --requests 200
+"""
+
+import argparse
+import asyncio
+import json
+import time
+import uuid
+
+import prisma
+import prisma.enums
+import prisma.models
+import project.image_request_store
+from prisma import Prisma
+
+
+class RoundTripCounter:
+    """
+    Wraps the query engine of a connected client and counts every request sent to it.
+    """
+
+    def __init__(self, client: Prisma) -> None:
+        self.count = 0
+        engine = client._engine
+        original_query = engine.query
+
+        async def counting_query(*args, **kwargs):
+            self.count += 1
+            return await original_query(*args, **kwargs)
+
+        engine.query = counting_query
+
+
+async def legacy_write(user_id: str) -> None:
+    record = await prisma.models.ImageRequest.prisma().create(
+        data={
+            "userId": user_id,
+            "textDescription": "benchmark prompt",
+            "AIModel": prisma.enums.AIModel.STABLEDIFFUSION,
+            "status": prisma.enums.ImageRequestStatus.PROCESSING,
+        }
+    )
+    await prisma.models.ImageRequest.prisma().update(
+        where={"id": record.id},
+        data={
+            "imageUrl": "http://example.com/image.png",
+            "status": prisma.enums.ImageRequestStatus.COMPLETED,
+        },
+    )
+
+
+async def single_write(user_id: str) -> None:
+    await project.image_request_store.create_image_request(
+        user_id,
+        "benchmark prompt",
+        prisma.enums.AIModel.STABLEDIFFUSION,
+        None,
+        None,
+        prisma.enums.ImageRequestStatus.COMPLETED,
+        image_url="http://example.com/image.png",
+        customization_options={"size": "512x512"},
+    )
+
+
+async def queued_write(user_id: str) -> None:
+    record = await project.image_request_store.create_image_request(
+        user_id,
+        "benchmark prompt",
+        prisma.enums.AIModel.STABLEDIFFUSION,
+        None,
+        None,
+        prisma.enums.ImageRequestStatus.PROCESSING,
+    )
+    await project.image_request_store.image_status_batcher.transition(
+        record.id,
+        prisma.enums.ImageRequestStatus.COMPLETED,
+        "http://example.com/image.png",
+    )
+
+
+async def measure(name, write, user_id, counter, requests, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one():
+        async with semaphore:
+            await write(user_id)
+
+    counter.count = 0
+    started = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(requests)))
+    elapsed = time.perf_counter() - started
+    return {
+        "path": name,
+        "requests": requests,
+        "round_trips": counter.count,
+        "round_trips_per_request": counter.count / requests,
+        "requests_per_second": requests / elapsed,
+    }
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=32)
+    args = parser.parse_args()
+
+    client = Prisma(auto_register=True)
+    await client.connect()
+    counter = RoundTripCounter(client)
+    user = await prisma.models.User.prisma().create(
+        data={"email": f"bench-{uuid.uuid4()}@example.com", "password": "x"}
+    )
+    try:
+        results = [
+            await measure(name, write, user.id, counter, args.requests, args.concurrency)
+            for name, write in [
+                ("create_then_update", legacy_write),
+                ("single_write", single_write),
+                ("queued_batched_transition", queued_write),
+            ]
+        ]
+    finally:
+        await prisma.models.User.prisma().delete(where={"id": user.id})
+        await client.disconnect()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
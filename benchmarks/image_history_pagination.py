@@ -0,0 +1,109 @@
+"""
+Seeds one user with millions of ImageRequest rows and compares page latency at increasing
+depth for keyset pagination (list_user_images) and OFFSET-based skip/take.
+
+Requires a database set up with `prisma db push` (so the composite indexes exist):
+
+    DATABASE_URL=... python -m benchmarks.image_history_pagination --rows 2000000
+"""
+
+import argparse
+import asyncio
+import json
+import time
+import uuid
+
+import prisma
+import prisma.models
+import project.list_user_images_service
+from prisma import Prisma
+
+SEED_QUERY = """
+    INSERT INTO "ImageRequest"
+        ("id", "userId", "createdAt", "updatedAt", "textDescription", "AIModel", "status", "imageUrl")
+    SELECT
+        gen_random_uuid(), $1,
+        NOW() - (n || ' seconds')::interval, NOW(),
+        'seeded prompt ' || n,
+        (ARRAY['DALLE2','IMAGEN','MIDJOURNEY','STABLEDIFFUSION'])[1 + n % 4]::"AIModel",
+        (ARRAY['COMPLETED','COMPLETED','COMPLETED','FAILED'])[1 + n % 4]::"ImageRequestStatus",
+        'http://example.com/' || n || '.png'
+    FROM generate_series($2::int, $3::int) AS n
+"""
+
+
+async def seed(user_id: str, rows: int, chunk: int = 200_000) -> None:
+    client = prisma.get_client()
+    for start in range(0, rows, chunk):
+        await client.execute_raw(SEED_QUERY, user_id, start, min(start + chunk, rows) - 1)
+    await client.execute_raw('ANALYZE "ImageRequest"')
+
+
+async def time_call(call, repeats: int) -> float:
+    latencies = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        await call()
+        latencies.append(time.perf_counter() - started)
+    return sorted(latencies)[len(latencies) // 2] * 1000
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=2_000_000)
+    parser.add_argument("--page-size", type=int, default=50)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument(
+        "--depths", type=int, nargs="+", default=[0, 10_000, 100_000, 1_000_000]
+    )
+    args = parser.parse_args()
+
+    client = Prisma(auto_register=True)
+    await client.connect()
+    user = await prisma.models.User.prisma().create(
+        data={"email": f"bench-{uuid.uuid4()}@example.com", "password": "x"}
+    )
+    try:
+        await seed(user.id, args.rows)
+        results = []
+        for depth in [depth for depth in args.depths if depth < args.rows]:
+            # Fetch the row at the requested depth once to build the equivalent cursor.
+            anchor = await prisma.models.ImageRequest.prisma().find_many(
+                where={"userId": user.id},
+                order=[{"createdAt": "desc"}, {"id": "desc"}],
+                skip=max(depth - 1, 0),
+                take=1,
+            )
+            cursor = (
+                project.list_user_images_service.encode_cursor(
+                    anchor[0].createdAt, anchor[0].id
+                )
+                if depth
+                else None
+            )
+            keyset_ms = await time_call(
+                lambda: project.list_user_images_service.list_user_images(
+                    user.id, args.page_size, cursor, fields=["status", "imageUrl"]
+                ),
+                args.repeats,
+            )
+            offset_ms = await time_call(
+                lambda: prisma.models.ImageRequest.prisma().find_many(
+                    where={"userId": user.id},
+                    order=[{"createdAt": "desc"}, {"id": "desc"}],
+                    skip=depth,
+                    take=args.page_size,
+                ),
+                args.repeats,
+            )
+            results.append(
+                {"depth": depth, "keyset_p50_ms": keyset_ms, "offset_p50_ms": offset_ms}
+            )
+    finally:
+        await prisma.models.User.prisma().delete(where={"id": user.id})
+        await client.disconnect()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
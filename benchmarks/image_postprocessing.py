@@ -0,0 +1,96 @@
+"""
+Throughput of each image post-processing step on stub-rendered images, on one core and
+through the process pool. Needs the Pillow and numpy packages; no database.
+
+    python -m benchmarks.image_postprocessing --size 1024 --iterations 50 \\
+        --output benchmarks/results/postprocessing.json
+
+Every operation includes decoding the source PNG and encoding the result; "reencode"
+is that fixed cost alone, so the cost of a step is the difference to it.
+"""
+
+import argparse
+import asyncio
+import time
+from typing import Callable, Dict
+
+import project.image_postprocessing
+import project.image_storage
+from benchmarks.common import run_metadata, summarize, write_results
+from project.image_backends import render_stub_png
+
+OPERATIONS: Dict[str, Dict[str, str]] = {
+    "reencode": {"format": "png"},
+    "crop": {"crop": "16:9"},
+    "resize": {"width": "512"},
+    "jpeg": {"format": "jpeg", "quality": "85"},
+    "webp": {"format": "webp", "quality": "80"},
+    "watermark": {"watermark": "true"},
+    "pipeline": {"crop": "4:3", "width": "768", "watermark": "true", "format": "webp"},
+}
+
+
+def measure(call: Callable[[], object], iterations: int) -> dict:
+    call()
+    latencies = []
+    started = time.perf_counter()
+    for _ in range(iterations):
+        call_started = time.perf_counter()
+        call()
+        latencies.append(time.perf_counter() - call_started)
+    return summarize(latencies, time.perf_counter() - started)
+
+
+async def measure_pool(data: bytes, options: Dict[str, str], iterations: int) -> dict:
+    spec = project.image_postprocessing.parse_postprocessing_options(options)
+    await project.image_postprocessing.start_image_processing()
+    latencies = []
+
+    async def one() -> None:
+        call_started = time.perf_counter()
+        await project.image_postprocessing.postprocess(data, spec)
+        latencies.append(time.perf_counter() - call_started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(iterations)))
+    elapsed = time.perf_counter() - started
+    await project.image_postprocessing.close_image_processing()
+    return summarize(latencies, elapsed)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=int, default=1024, help="Edge of the square source image in pixels")
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument("--output", help="Also write the JSON results to this file")
+    args = parser.parse_args()
+
+    data = render_stub_png("benchmark image post-processing", args.size)
+    results = {}
+    for name, options in OPERATIONS.items():
+        spec = project.image_postprocessing.parse_postprocessing_options(options)
+        results[name] = measure(
+            lambda: project.image_postprocessing.postprocess_image(data, spec), args.iterations
+        )
+    results["thumbnail_variant"] = measure(
+        lambda: project.image_storage.render_variant(data, "thumbnail"), args.iterations
+    )
+    results["pipeline_pool"] = asyncio.run(
+        measure_pool(data, OPERATIONS["pipeline"], args.iterations * 4)
+    )
+    write_results(
+        {
+            "benchmark": "image_postprocessing",
+            "meta": run_metadata(
+                size=args.size,
+                iterations=args.iterations,
+                process_workers=project.image_postprocessing.IMAGE_PROCESS_WORKERS,
+            ),
+            "results": results,
+        },
+        args.output,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,311 @@
+"""
+Replays a mix of signup, login, profile read/update and image generation traffic against the
+HTTP API and reports throughput and latency percentiles per endpoint.
+
+By default it boots the app with `python -m project.serve` against DATABASE_URL, with stub image
+backends and generation rate limits lifted. Start Postgres and create the schema first:
+
+    docker-compose up -d db && prisma db push
+    DATABASE_URL=... python -m benchmarks.load_test --users 50 --duration 60 \\
+        --output benchmarks/results/load.json
+
+Pass --url to drive an already running server instead. Compare two runs with
+`python -m benchmarks.compare`.
+
+Any response other than 2xx counts as an error, and the run exits with status 1 when the
+share of errors exceeds --max-error-rate, so a broken endpoint cannot pass as a fast one.
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+import httpx
+from benchmarks.common import run_metadata, summarize, write_results
+
+# Relative frequency of each action in the replayed traffic.
+DEFAULT_MIX = {
+    "signup": 5,
+    "login": 10,
+    "profile_read": 40,
+    "profile_update": 10,
+    "generate": 30,
+    "generate_queued": 5,
+}
+
+PROMPTS = [
+    "a lighthouse on a cliff at dusk",
+    "a bowl of ramen in the style of ukiyo-e",
+    "an astronaut riding a horse",
+    "a cozy reading nook with plants",
+    "a cyberpunk street market in the rain",
+]
+AI_MODELS = ["DALLE2", "IMAGEN", "MIDJOURNEY", "STABLEDIFFUSION"]
+
+
+class Recorder:
+    def __init__(self) -> None:
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Dict[str, int] = defaultdict(int)
+        self.statuses: Dict[str, Dict[int, int]] = defaultdict(lambda: defaultdict(int))
+        self.recording = False
+
+    async def call(self, name: str, client: httpx.AsyncClient, method: str, url: str, **kwargs):
+        started = time.perf_counter()
+        try:
+            response = await client.request(method, url, **kwargs)
+        except httpx.HTTPError:
+            if self.recording:
+                self.errors[name] += 1
+            return None
+        if self.recording:
+            self.latencies[name].append(time.perf_counter() - started)
+            self.statuses[name][response.status_code] += 1
+            if not response.is_success:
+                self.errors[name] += 1
+        return response
+
+
+class VirtualUser:
+    """
+    One simulated client with its own account, session and think time.
+    """
+
+    def __init__(self, client: httpx.AsyncClient, recorder: Recorder, think_time: float) -> None:
+        self.client = client
+        self.recorder = recorder
+        self.think_time = think_time
+        self.user_ids: List[str] = []
+        self.user_id: Optional[str] = None
+        self.email = ""
+        self.password = "benchmark-password"
+        self.token: Optional[str] = None
+
+    async def signup(self) -> None:
+        email = f"load-{uuid.uuid4()}@example.com"
+        response = await self.recorder.call(
+            "signup",
+            self.client,
+            "POST",
+            "/user/account/",
+            params={
+                "email": email,
+                "password": self.password,
+                "firstName": "Load",
+                "lastName": "Test",
+            },
+        )
+        if response is not None and response.status_code == 200:
+            self.user_id = response.json()["userId"]
+            self.user_ids.append(self.user_id)
+            self.email = email
+            self.token = None
+
+    async def login(self) -> None:
+        response = await self.recorder.call(
+            "login",
+            self.client,
+            "POST",
+            "/auth/login/",
+            params={"email": self.email, "password": self.password},
+        )
+        if response is not None and response.status_code == 200:
+            self.token = response.json()["session_token"]
+
+    async def profile_read(self) -> None:
+        await self.recorder.call(
+            "profile_read", self.client, "GET", f"/user/profile/{self.user_id}"
+        )
+
+    async def profile_update(self) -> None:
+        await self.recorder.call(
+            "profile_update",
+            self.client,
+            "PUT",
+            f"/user/profile/{self.user_id}/update",
+            params={
+                "firstName": "Load",
+                "lastName": f"Test {random.randint(0, 1000)}",
+                "email": self.email,
+                "bio": "",
+            },
+        )
+
+    async def generate(self, queued: bool = False) -> None:
+        # Half of the prompts repeat, so the result cache sees a realistic hit rate.
+        prompt = random.choice(PROMPTS)
+        if random.random() < 0.5:
+            prompt = f"{prompt} #{uuid.uuid4().hex[:8]}"
+        await self.recorder.call(
+            "generate_queued" if queued else "generate",
+            self.client,
+            "POST",
+            "/image/generate/",
+            params={
+                "text_description": prompt,
+                "ai_model": random.choice(AI_MODELS),
+                "theme": "",
+                "style": "",
+                "queued": str(queued).lower(),
+            },
+            headers={"Authorization": f"Bearer {self.token}"},
+        )
+
+    async def run(self, mix: Dict[str, int], deadline: float) -> None:
+        await self.signup()
+        await self.login()
+        actions = list(mix)
+        weights = [mix[action] for action in actions]
+        while time.monotonic() < deadline:
+            action = random.choices(actions, weights)[0]
+            if self.user_id is None or action == "signup":
+                await self.signup()
+                await self.login()
+            elif action == "login" or self.token is None:
+                await self.login()
+            elif action == "generate_queued":
+                await self.generate(queued=True)
+            else:
+                await getattr(self, action)()
+            if self.think_time:
+                await asyncio.sleep(random.expovariate(1 / self.think_time))
+
+
+def boot_server(port: int, workers: int) -> subprocess.Popen:
+    env = dict(os.environ)
+    env.setdefault("IMAGE_BACKEND_MODE", "stub")
+    env.setdefault("IMAGE_STORE_PATH", tempfile.mkdtemp(prefix="load-test-images-"))
+    for plan in ("FREE", "BASIC", "PREMIUM"):
+        env.setdefault(f"RATE_LIMIT_{plan}_PER_MINUTE", "")
+    # Tokens issued by one worker must verify on the others.
+    env.setdefault("SESSION_SECRET", uuid.uuid4().hex)
+    # The simulated users are on the FREE plan; keep the watermark out of the generation timings.
+    env.setdefault("IMAGE_WATERMARK_PLANS", "")
+    return subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "project.serve",
+            "--port",
+            str(port),
+            "--workers",
+            str(workers),
+            "--log-level",
+            "warning",
+        ],
+        env=env,
+    )
+
+
+async def wait_until_ready(client: httpx.AsyncClient, timeout: float = 60.0) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if (await client.get("/ai/models/")).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        await asyncio.sleep(0.25)
+    raise RuntimeError("Server did not become ready")
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="Target a running server instead of booting one")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--server-workers", type=int, default=1)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--duration", type=float, default=60.0)
+    parser.add_argument("--warmup", type=float, default=5.0)
+    parser.add_argument("--think-time", type=float, default=0.0, help="Mean seconds between a user's requests")
+    parser.add_argument(
+        "--mix",
+        default=",".join(f"{action}={weight}" for action, weight in DEFAULT_MIX.items()),
+        help="Comma-separated action=weight pairs",
+    )
+    parser.add_argument("--output", help="Also write the JSON results to this file")
+    parser.add_argument(
+        "--max-error-rate",
+        type=float,
+        default=0.0,
+        help="Exit with status 1 if more than this fraction of the requests were not 2xx",
+    )
+    args = parser.parse_args()
+    mix = {
+        action: int(weight)
+        for action, weight in (pair.split("=") for pair in args.mix.split(","))
+    }
+
+    server = None
+    base_url = args.url
+    if base_url is None:
+        server = boot_server(args.port, args.server_workers)
+        base_url = f"http://127.0.0.1:{args.port}"
+    recorder = Recorder()
+    limits = httpx.Limits(max_connections=args.users, max_keepalive_connections=args.users)
+    try:
+        async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=120) as client:
+            await wait_until_ready(client)
+            users = [VirtualUser(client, recorder, args.think_time) for _ in range(args.users)]
+            deadline = time.monotonic() + args.warmup + args.duration
+            tasks = [asyncio.create_task(user.run(mix, deadline)) for user in users]
+            await asyncio.sleep(args.warmup)
+            recorder.recording = True
+            started = time.monotonic()
+            await asyncio.gather(*tasks)
+            elapsed = time.monotonic() - started
+            recorder.recording = False
+            for user in users:
+                for user_id in user.user_ids:
+                    await client.delete(f"/user/account/{user_id}")
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    results = {
+        name: {
+            **summarize(latencies, elapsed, recorder.errors[name]),
+            "statuses": {str(code): count for code, count in sorted(recorder.statuses[name].items())},
+        }
+        for name, latencies in sorted(recorder.latencies.items())
+    }
+    all_latencies = [latency for latencies in recorder.latencies.values() for latency in latencies]
+    results["total"] = summarize(all_latencies, elapsed, sum(recorder.errors.values()))
+    if args.url is None and "throughput_rps" in results["total"]:
+        results["total"]["throughput_rps_per_worker"] = round(
+            results["total"]["throughput_rps"] / args.server_workers, 2
+        )
+    write_results(
+        {
+            "benchmark": "load_test",
+            "meta": run_metadata(
+                url=args.url,
+                server_workers=args.server_workers,
+                users=args.users,
+                duration=args.duration,
+                think_time=args.think_time,
+                mix=mix,
+            ),
+            "results": results,
+        },
+        args.output,
+    )
+    if results["total"]["errors"] > args.max_error_rate * results["total"]["requests"]:
+        failing = ", ".join(
+            f"{name} ({count})" for name, count in sorted(recorder.errors.items()) if count
+        )
+        print(f"Requests failed: {failing}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
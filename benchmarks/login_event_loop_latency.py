@@ -0,0 +1,84 @@
+"""
+Measures event-loop latency while many logins verify bcrypt hashes concurrently, once with
+bcrypt called inline (as user_login used to) and once through project.password_hashing.
+
+No database is needed:
+
+    python -m benchmarks.login_event_loop_latency --logins 64 --rounds 12
+"""
+
+import argparse
+import asyncio
+import json
+import statistics
+import time
+
+import bcrypt
+import project.password_hashing
+
+
+async def probe_loop_lag(stop: asyncio.Event, interval: float, lags: list) -> None:
+    """
+    Schedules a tick every interval seconds and records how late each one fires.
+    """
+    while not stop.is_set():
+        expected = time.perf_counter() + interval
+        await asyncio.sleep(interval)
+        lags.append(max(time.perf_counter() - expected, 0.0))
+
+
+async def inline_login(password: str, hashed: str) -> bool:
+    return bcrypt.checkpw(password.encode("utf-8"), hashed.encode("utf-8"))
+
+
+async def offloaded_login(password: str, hashed: str) -> bool:
+    return await project.password_hashing.verify_password(password, hashed)
+
+
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+async def run(name, login, logins, password, hashed, interval):
+    stop = asyncio.Event()
+    lags: list = []
+    probe = asyncio.create_task(probe_loop_lag(stop, interval, lags))
+    started = time.perf_counter()
+    await asyncio.gather(*(login(password, hashed) for _ in range(logins)))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await probe
+    return {
+        "mode": name,
+        "logins": logins,
+        "elapsed_s": elapsed,
+        "logins_per_second": logins / elapsed,
+        "loop_lag_p50_ms": percentile(lags, 0.50) * 1000,
+        "loop_lag_p99_ms": percentile(lags, 0.99) * 1000,
+        "loop_lag_max_ms": max(lags, default=0.0) * 1000,
+        "loop_lag_mean_ms": (statistics.mean(lags) if lags else 0.0) * 1000,
+    }
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--logins", type=int, default=64)
+    parser.add_argument("--rounds", type=int, default=project.password_hashing.BCRYPT_ROUNDS)
+    parser.add_argument("--probe-interval", type=float, default=0.005)
+    args = parser.parse_args()
+
+    password = "correct horse battery staple"
+    hashed = await project.password_hashing.hash_password(password, args.rounds)
+    results = [
+        await run(name, login, args.logins, password, hashed, args.probe_interval)
+        for name, login in [("inline", inline_login), ("executor", offloaded_login)]
+    ]
+    project.password_hashing.shutdown_password_executor()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
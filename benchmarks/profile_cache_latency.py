@@ -0,0 +1,70 @@
+"""
+Compares cold (cache cleared before every read) and warm get_user_profile latency.
+
+Requires a database set up with `prisma db push`:
+
+    DATABASE_URL=... python -m benchmarks.profile_cache_latency --reads 2000
+"""
+
+import argparse
+import asyncio
+import json
+import time
+import uuid
+
+import prisma.models
+import project.get_user_profile_service
+from prisma import Prisma
+
+
+def percentile(values: list, q: float) -> float:
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+async def timed_reads(user_id: str, reads: int, cold: bool) -> list:
+    cache = project.get_user_profile_service.user_profile_cache
+    latencies = []
+    for _ in range(reads):
+        if cold:
+            await cache.invalidate(user_id)
+        started = time.perf_counter()
+        await project.get_user_profile_service.get_user_profile(user_id)
+        latencies.append(time.perf_counter() - started)
+    return latencies
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--reads", type=int, default=2000)
+    args = parser.parse_args()
+
+    client = Prisma(auto_register=True)
+    await client.connect()
+    user = await prisma.models.User.prisma().create(
+        data={
+            "email": f"bench-{uuid.uuid4()}@example.com",
+            "password": "x",
+            "profiles": {"create": {"firstName": "Bench", "lastName": "Mark"}},
+        }
+    )
+    try:
+        results = []
+        for mode, cold in [("cold", True), ("warm", False)]:
+            latencies = await timed_reads(user.id, args.reads, cold)
+            results.append(
+                {
+                    "mode": mode,
+                    "reads": args.reads,
+                    "p50_ms": percentile(latencies, 0.50) * 1000,
+                    "p99_ms": percentile(latencies, 0.99) * 1000,
+                }
+            )
+    finally:
+        await prisma.models.User.prisma().delete(where={"id": user.id})
+        await client.disconnect()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
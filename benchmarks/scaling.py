@@ -0,0 +1,99 @@
+"""
+Runs benchmarks.load_test against 1, 2, 4, ... uvicorn workers (up to the CPU count) and
+reports how total throughput scales with the number of workers.
+
+    DATABASE_URL=... SHARED_STATE_BACKEND=redis IMAGE_QUEUE_BACKEND=postgres \\
+        python -m benchmarks.scaling --users 100 --duration 30 \\
+        --output benchmarks/results/scaling.json
+
+efficiency is the throughput per worker relative to the single-worker run; 1.0 is linear
+scaling. Give the load generator its own cores (or machine, with --url on load_test) when
+the worker count approaches the CPU count, otherwise it competes with the server.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from typing import List
+
+from benchmarks.common import run_metadata, write_results
+
+
+def worker_counts(max_workers: int) -> List[int]:
+    counts = []
+    workers = 1
+    while workers < max_workers:
+        counts.append(workers)
+        workers *= 2
+    return counts + [max_workers]
+
+
+def run_load_test(workers: int, args: argparse.Namespace) -> dict:
+    with tempfile.TemporaryDirectory() as directory:
+        output = os.path.join(directory, "load.json")
+        subprocess.run(
+            [
+                sys.executable,
+                "-m",
+                "benchmarks.load_test",
+                "--server-workers",
+                str(workers),
+                "--port",
+                str(args.port),
+                "--users",
+                str(args.users),
+                "--duration",
+                str(args.duration),
+                "--warmup",
+                str(args.warmup),
+                "--output",
+                output,
+            ],
+            stdout=subprocess.DEVNULL,
+            check=True,
+        )
+        with open(output) as f:
+            return json.load(f)["results"]["total"]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--max-workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--port", type=int, default=8767)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--duration", type=float, default=30.0)
+    parser.add_argument("--warmup", type=float, default=5.0)
+    parser.add_argument("--output", help="Also write the JSON results to this file")
+    args = parser.parse_args()
+
+    results = {}
+    baseline = None
+    for workers in worker_counts(max(1, args.max_workers)):
+        total = run_load_test(workers, args)
+        throughput = total.get("throughput_rps", 0.0)
+        if baseline is None:
+            baseline = throughput
+        total["speedup"] = round(throughput / baseline, 2) if baseline else None
+        total["efficiency"] = round(throughput / (baseline * workers), 2) if baseline else None
+        results[f"workers_{workers}"] = total
+    write_results(
+        {
+            "benchmark": "scaling",
+            "meta": run_metadata(
+                max_workers=args.max_workers,
+                users=args.users,
+                duration=args.duration,
+                shared_state_backend=os.environ.get("SHARED_STATE_BACKEND", "memory"),
+                image_queue_backend=os.environ.get("IMAGE_QUEUE_BACKEND", "local"),
+            ),
+            "results": results,
+        },
+        args.output,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+"""
+Measures the single-core throughput of rendering the same endpoint result through FastAPI's
+response_model handling (*_validated) and through project.serializers.ModelResponse
+(*_compiled). It needs no database.
+
+    python -m benchmarks.serialization --requests 5000 --output benchmarks/results/serialization.json
+"""
+
+import argparse
+import asyncio
+import time
+from datetime import datetime
+
+import prisma.enums
+import project.generate_image_service
+import project.list_user_images_service
+import project.serializers
+from benchmarks.common import run_metadata, summarize, write_results
+from fastapi import FastAPI
+from fastapi.responses import JSONResponse, Response
+from fastapi.routing import APIRoute, serialize_response
+
+
+def serialization_app() -> FastAPI:
+    generated = project.generate_image_service.GenerateImageResponse(
+        request_id="5a0c7c8e-2f7e-4a55-9d1e-7e4b3c1f2a90",
+        image_url="/image/5a0c7c8e-2f7e-4a55-9d1e-7e4b3c1f2a90/file",
+        status=prisma.enums.ImageRequestStatus.COMPLETED,
+        ai_model_used=prisma.enums.AIModel.STABLEDIFFUSION,
+        text_description_used="a lighthouse on a cliff at dusk",
+    )
+    page = project.list_user_images_service.UserImagesResponse(
+        images=[
+            project.list_user_images_service.ImageRequestSummary(
+                id=f"request-{i}",
+                createdAt=datetime(2024, 1, 1, 12, 0, i % 60),
+                status=prisma.enums.ImageRequestStatus.COMPLETED,
+                AIModel=prisma.enums.AIModel.DALLE2,
+                imageUrl=f"/image/request-{i}/file",
+                textDescription="a cozy reading nook with plants",
+            )
+            for i in range(50)
+        ],
+        next_cursor="cursor",
+    )
+    app = FastAPI()
+
+    @app.get(
+        "/generate/validated",
+        response_model=project.generate_image_service.GenerateImageResponse,
+    )
+    async def generate_validated():
+        return generated
+
+    @app.get("/generate/compiled")
+    async def generate_compiled():
+        return project.serializers.ModelResponse(generated)
+
+    @app.get(
+        "/images/validated",
+        response_model=project.list_user_images_service.UserImagesResponse,
+        response_model_exclude_unset=True,
+    )
+    async def images_validated():
+        return page
+
+    @app.get("/images/compiled")
+    async def images_compiled():
+        return project.serializers.ModelResponse(page, exclude_unset=True)
+
+    return app
+
+
+async def measure_serialization(requests: int) -> dict:
+    """
+    Times calling each endpoint and turning its return value into a response, the per-request CPU the two paths differ in.
+    """
+    results = {}
+    for route in serialization_app().routes:
+        if not isinstance(route, APIRoute):
+            continue
+
+        async def render(route=route) -> Response:
+            content = await route.endpoint()
+            if isinstance(content, Response):
+                return content
+            serialized = await serialize_response(
+                field=route.response_field,
+                response_content=content,
+                exclude_unset=route.response_model_exclude_unset,
+                is_coroutine=True,
+            )
+            return JSONResponse(serialized)
+
+        for _ in range(min(requests, 200)):
+            await render()
+        latencies = []
+        started = time.perf_counter()
+        for _ in range(requests):
+            request_started = time.perf_counter()
+            await render()
+            latencies.append(time.perf_counter() - request_started)
+        results[route.path.strip("/").replace("/", "_")] = summarize(
+            latencies, time.perf_counter() - started
+        )
+    return results
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--output", help="Also write the JSON results to this file")
+    args = parser.parse_args()
+
+    results = await measure_serialization(args.requests)
+    write_results(
+        {
+            "benchmark": "serialization",
+            "meta": run_metadata(requests=args.requests),
+            "results": results,
+        },
+        args.output,
+    )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
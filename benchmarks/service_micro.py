@@ -0,0 +1,115 @@
+"""
+Micro-benchmarks of generate_image, user_login and get_user_profile called directly, without
+HTTP, at a fixed concurrency. Image generation uses the default stub backends.
+
+Requires a database set up with `prisma db push`:
+
+    DATABASE_URL=... python -m benchmarks.service_micro --iterations 500 --concurrency 8 \\
+        --output benchmarks/results/micro.json
+"""
+
+import argparse
+import asyncio
+import time
+import uuid
+from typing import Awaitable, Callable
+
+import prisma.enums
+import prisma.models
+import project.create_user_account_service
+import project.generate_image_service
+import project.get_user_profile_service
+import project.user_login_service
+from benchmarks.common import run_metadata, summarize, write_results
+from prisma import Prisma
+
+
+async def measure(
+    call: Callable[[int], Awaitable[object]], iterations: int, concurrency: int
+) -> dict:
+    latencies = []
+    errors = 0
+    counter = iter(range(iterations))
+
+    async def worker() -> None:
+        nonlocal errors
+        for i in counter:
+            started = time.perf_counter()
+            try:
+                await call(i)
+            except Exception:
+                errors += 1
+                continue
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return summarize(latencies, time.perf_counter() - started, errors)
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--iterations", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--output", help="Also write the JSON results to this file")
+    args = parser.parse_args()
+
+    client = Prisma(auto_register=True)
+    await client.connect()
+    email = f"micro-{uuid.uuid4()}@example.com"
+    password = "benchmark-password"
+    account = await project.create_user_account_service.create_user_account(
+        email, password, "Micro", "Bench"
+    )
+    run = f"{uuid.uuid4().hex[:8]}"
+    try:
+        results = {
+            "user_login": await measure(
+                lambda i: project.user_login_service.user_login(email, password),
+                args.iterations,
+                args.concurrency,
+            ),
+            "get_user_profile": await measure(
+                lambda i: project.get_user_profile_service.get_user_profile(account.userId),
+                args.iterations,
+                args.concurrency,
+            ),
+            # Unique prompts measure a full render plus insert; repeated ones the result cache.
+            "generate_image_uncached": await measure(
+                lambda i: project.generate_image_service.generate_image(
+                    account.userId,
+                    f"micro benchmark {run} {i}",
+                    prisma.enums.AIModel.STABLEDIFFUSION,
+                    None,
+                    None,
+                ),
+                args.iterations,
+                args.concurrency,
+            ),
+            "generate_image_cached": await measure(
+                lambda i: project.generate_image_service.generate_image(
+                    account.userId,
+                    f"micro benchmark {run} 0",
+                    prisma.enums.AIModel.STABLEDIFFUSION,
+                    None,
+                    None,
+                ),
+                args.iterations,
+                args.concurrency,
+            ),
+        }
+    finally:
+        await prisma.models.User.prisma().delete(where={"id": account.userId})
+        await client.disconnect()
+    write_results(
+        {
+            "benchmark": "service_micro",
+            "meta": run_metadata(iterations=args.iterations, concurrency=args.concurrency),
+            "results": results,
+        },
+        args.output,
+    )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,4 @@
+import time
+
+# Taken before any other project module is imported; the start of the startup report.
+IMPORT_STARTED = time.perf_counter()
@@ -0,0 +1,102 @@
+import asyncio
+import os
+from enum import Enum
+from typing import List
+
+import prisma
+import prisma.models
+import project.get_user_profile_service
+import project.rate_limiting
+from pydantic import BaseModel
+
+ADMIN_BULK_DELETE_MAX_IDS = int(os.environ.get("ADMIN_BULK_DELETE_MAX_IDS", "1000"))
+
+
+class BulkDeleteUsersRequest(BaseModel):
+    """
+    The ids of the user accounts to delete.
+    """
+
+    ids: List[str]
+
+
+class BulkDeleteStatus(Enum):
+    DELETED: str = "DELETED"
+    NOT_FOUND: str = "NOT_FOUND"
+
+
+class BulkDeleteResult(BaseModel):
+    """
+    The outcome for one requested id.
+    """
+
+    id: str
+    status: BulkDeleteStatus
+
+
+class BulkDeleteUsersResponse(BaseModel):
+    """
+    One result per distinct requested id, in request order, and the number of accounts deleted.
+    """
+
+    results: List[BulkDeleteResult]
+    deleted: int
+
+
+async def bulk_delete_user_accounts(ids: List[str]) -> BulkDeleteUsersResponse:
+    """
+    Deletes many user accounts, together with everything that cascades from them, in one transaction.
+
+    The existing accounts among ids are looked up and removed with a single delete_many
+    inside the same transaction, so the reported results match what was deleted. Cached
+    profiles and plans of the deleted users are invalidated afterwards.
+
+    Args:
+        ids (List[str]): The user ids to delete; duplicates are ignored. At most ADMIN_BULK_DELETE_MAX_IDS.
+
+    Returns:
+        BulkDeleteUsersResponse: DELETED or NOT_FOUND for every id, and the number of deleted accounts.
+
+    Example:
+        bulk_delete_user_accounts(["existing-id", "missing-id"])
+        > BulkDeleteUsersResponse(results=[BulkDeleteResult(id="existing-id", status=DELETED), BulkDeleteResult(id="missing-id", status=NOT_FOUND)], deleted=1)
+    """
+    ids = list(dict.fromkeys(ids))
+    if not ids:
+        raise ValueError("At least one id is required")
+    if len(ids) > ADMIN_BULK_DELETE_MAX_IDS:
+        raise ValueError(f"At most {ADMIN_BULK_DELETE_MAX_IDS} ids can be deleted at once")
+    async with prisma.get_client().tx() as transaction:
+        existing = {
+            user.id
+            for user in await prisma.models.User.prisma(transaction).find_many(
+                where={"id": {"in": ids}}
+            )
+        }
+        deleted = 0
+        if existing:
+            deleted = await prisma.models.User.prisma(transaction).delete_many(
+                where={"id": {"in": list(existing)}}
+            )
+    await asyncio.gather(
+        *(
+            cache.invalidate(id)
+            for id in existing
+            for cache in (
+                project.get_user_profile_service.user_profile_cache,
+                project.rate_limiting.user_plan_cache,
+            )
+        )
+    )
+    return BulkDeleteUsersResponse(
+        results=[
+            BulkDeleteResult(
+                id=id,
+                status=(
+                    BulkDeleteStatus.DELETED if id in existing else BulkDeleteStatus.NOT_FOUND
+                ),
+            )
+            for id in ids
+        ],
+        deleted=deleted,
+    )
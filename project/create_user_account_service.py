@@ -1,8 +1,8 @@
 from typing import Optional
 
-import bcrypt
 import prisma
 import prisma.models
+import project.password_hashing
 from pydantic import BaseModel
 
 
@@ -41,9 +41,7 @@ async def create_user_account(
         raise ValueError(
             "The provided email address is already associated with an existing account."
         )
-    hashed_password = bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt()).decode(
-        "utf-8"
-    )
+    hashed_password = await project.password_hashing.hash_password(password)
     user = await prisma.models.User.prisma().create(
         data={
             "email": email,
@@ -0,0 +1,67 @@
+import os
+from typing import Dict, Optional
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+# Query engine connections per worker; when unset, DATABASE_MAX_CONNECTIONS is split evenly
+# between the WEB_CONCURRENCY workers, and otherwise the engine's default applies.
+DATABASE_POOL_SIZE = os.environ.get("DATABASE_POOL_SIZE", "")
+DATABASE_MAX_CONNECTIONS = os.environ.get("DATABASE_MAX_CONNECTIONS", "")
+# Seconds to wait for a free pooled connection, and to establish a new one.
+DATABASE_POOL_TIMEOUT = os.environ.get("DATABASE_POOL_TIMEOUT", "")
+DATABASE_CONNECT_TIMEOUT = os.environ.get("DATABASE_CONNECT_TIMEOUT", "")
+# Prepared statements cached per connection; must be 0 behind PgBouncer in transaction mode.
+DATABASE_STATEMENT_CACHE_SIZE = os.environ.get("DATABASE_STATEMENT_CACHE_SIZE", "")
+DATABASE_PGBOUNCER = os.environ.get("DATABASE_PGBOUNCER", "false").lower() == "true"
+WEB_CONCURRENCY = int(os.environ.get("WEB_CONCURRENCY", "1"))
+
+
+def pool_settings(workers: int = WEB_CONCURRENCY) -> Dict[str, str]:
+    """
+    Returns the query engine connection parameters configured by the DATABASE_* environment variables.
+
+    Args:
+        workers (int): The number of processes sharing DATABASE_MAX_CONNECTIONS.
+
+    Returns:
+        Dict[str, str]: Query parameters understood by the Prisma query engine.
+    """
+    settings: Dict[str, str] = {}
+    if DATABASE_POOL_SIZE:
+        settings["connection_limit"] = DATABASE_POOL_SIZE
+    elif DATABASE_MAX_CONNECTIONS:
+        settings["connection_limit"] = str(max(1, int(DATABASE_MAX_CONNECTIONS) // max(1, workers)))
+    if DATABASE_POOL_TIMEOUT:
+        settings["pool_timeout"] = DATABASE_POOL_TIMEOUT
+    if DATABASE_CONNECT_TIMEOUT:
+        settings["connect_timeout"] = DATABASE_CONNECT_TIMEOUT
+    if DATABASE_STATEMENT_CACHE_SIZE:
+        settings["statement_cache_size"] = DATABASE_STATEMENT_CACHE_SIZE
+    if DATABASE_PGBOUNCER:
+        settings["pgbouncer"] = "true"
+    return settings
+
+
+def database_url(url: Optional[str] = None, workers: int = WEB_CONCURRENCY) -> Optional[str]:
+    """
+    Adds the pool settings to DATABASE_URL. Parameters already present in the URL win.
+
+    Example:
+        With DATABASE_MAX_CONNECTIONS=40 and WEB_CONCURRENCY=4,
+        database_url("postgresql://db/app") == "postgresql://db/app?connection_limit=10"
+    """
+    url = url if url is not None else os.environ.get("DATABASE_URL")
+    if not url:
+        return None
+    parts = urlsplit(url)
+    query = dict(parse_qsl(parts.query, keep_blank_values=True))
+    for key, value in pool_settings(workers).items():
+        query.setdefault(key, value)
+    return urlunsplit(parts._replace(query=urlencode(query)))
+
+
+def client_options() -> Dict[str, object]:
+    """
+    Returns the keyword arguments for constructing this worker's Prisma client.
+    """
+    url = database_url()
+    return {"datasource": {"url": url}} if url else {}
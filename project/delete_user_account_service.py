@@ -1,5 +1,7 @@
 import prisma
 import prisma.models
+import project.get_user_profile_service
+import project.rate_limiting
 from pydantic import BaseModel
 
 
@@ -16,7 +18,8 @@ async def delete_user_account(id: str) -> DeleteUserAccountResponse:
     Deletes an existing user account from the database based on the given unique identifier (ID).
 
     If the user account exists and is successfully deleted, a confirmation message is returned.
-    Otherwise, if the user account cannot be found or cannot be deleted, a failure message is returned.
+    If the user account cannot be found, a failure message is returned. Database errors are
+    raised to the caller instead of being reported as a failed deletion.
 
     Args:
     - id (str): The unique identifier of the user account to be deleted.
@@ -29,12 +32,13 @@ async def delete_user_account(id: str) -> DeleteUserAccountResponse:
     - delete_user_account("some-unique-user-id") -> DeleteUserAccountResponse(message="User account with ID some-unique-user-id has been successfully deleted.")
     - delete_user_account("non-existent-user-id") -> DeleteUserAccountResponse(message="Failed to delete user account with ID non-existent-user-id.")
     """
-    try:
-        deleted_user = await prisma.models.User.prisma().delete(where={"id": id})
-        return DeleteUserAccountResponse(
-            message=f"User account with ID {id} has been successfully deleted."
-        )
-    except Exception as e:
+    deleted_user = await prisma.models.User.prisma().delete(where={"id": id})
+    if deleted_user is None:
         return DeleteUserAccountResponse(
             message=f"Failed to delete user account with ID {id}."
         )
+    await project.get_user_profile_service.user_profile_cache.invalidate(id)
+    await project.rate_limiting.user_plan_cache.invalidate(id)
+    return DeleteUserAccountResponse(
+        message=f"User account with ID {id} has been successfully deleted."
+    )
@@ -0,0 +1,208 @@
+import asyncio
+import logging
+import os
+from collections import deque
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Deque, Dict, Generic, List, Optional, Tuple, TypeVar
+
+import prisma
+import prisma.models
+import project.metrics
+
+logger = logging.getLogger(__name__)
+
+EVENT_BUFFER_CAPACITY = int(os.environ.get("EVENT_BUFFER_CAPACITY", "50000"))
+EVENT_FLUSH_BATCH_SIZE = int(os.environ.get("EVENT_FLUSH_BATCH_SIZE", "500"))
+EVENT_FLUSH_INTERVAL = float(os.environ.get("EVENT_FLUSH_INTERVAL", "2.0"))
+
+T = TypeVar("T")
+
+
+class BatchingBuffer(Generic[T]):
+    """
+    A bounded ring buffer that a background task drains in batches.
+
+    offer() never blocks the request path: once the buffer is full the oldest item is
+    dropped and counted. The flusher writes a batch when batch_size items are waiting or
+    every flush_interval seconds, whichever comes first. A batch whose write fails is split
+    in halves and retried, down to single items, so one bad row only costs itself; items
+    that cannot be written on their own are dropped and counted, so a poisoned batch cannot
+    stall the pipeline.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        flush: Callable[[List[T]], Awaitable[None]],
+        capacity: int = EVENT_BUFFER_CAPACITY,
+        batch_size: int = EVENT_FLUSH_BATCH_SIZE,
+        flush_interval: float = EVENT_FLUSH_INTERVAL,
+    ) -> None:
+        self.name = name
+        self.flush = flush
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.accepted = 0
+        self.dropped = 0
+        self.flushed = 0
+        self.flush_failures = 0
+        self._buffer: Deque[T] = deque(maxlen=capacity)
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        project.metrics.event_buffer_pending.set_function(self.__len__, buffer=name)
+
+    def __len__(self) -> int:
+        return len(self._buffer)
+
+    def offer(self, item: T) -> None:
+        """
+        Adds an item without waiting, evicting the oldest one if the buffer is full.
+        """
+        if len(self._buffer) == self._buffer.maxlen:
+            self._drop(1, "full")
+        self._buffer.append(item)
+        self.accepted += 1
+        if len(self._buffer) >= self.batch_size:
+            self._wakeup.set()
+
+    async def flush_once(self) -> None:
+        """
+        Writes up to batch_size buffered items.
+        """
+        batch = [
+            self._buffer.popleft()
+            for _ in range(min(self.batch_size, len(self._buffer)))
+        ]
+        if not batch:
+            return
+        dropped, error = await self._write(batch)
+        if dropped:
+            logger.error(
+                "Dropped %d of %d %s events that could not be written",
+                dropped,
+                len(batch),
+                self.name,
+                exc_info=error,
+            )
+
+    async def _write(self, batch: List[T]) -> Tuple[int, Optional[Exception]]:
+        """
+        Writes a batch, retrying the halves of a failed one separately.
+
+        Returns:
+            Tuple[int, Optional[Exception]]: How many items were dropped, and the last error.
+        """
+        try:
+            await self.flush(batch)
+            self.flushed += len(batch)
+            return 0, None
+        except Exception as e:
+            self.flush_failures += 1
+            if len(batch) == 1:
+                self._drop(1, "write_failed")
+                return 1, e
+        middle = len(batch) // 2
+        dropped, error = await self._write(batch[:middle])
+        dropped_rest, error_rest = await self._write(batch[middle:])
+        return dropped + dropped_rest, error_rest or error
+
+    def _drop(self, count: int, reason: str) -> None:
+        self.dropped += count
+        project.metrics.event_buffer_dropped.inc(count, buffer=self.name, reason=reason)
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            while self._buffer:
+                await self.flush_once()
+                if len(self._buffer) < self.batch_size:
+                    break
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """
+        Stops the background flusher and writes everything still buffered.
+        """
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        while self._buffer:
+            await self.flush_once()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "buffered": len(self._buffer),
+            "accepted": self.accepted,
+            "dropped": self.dropped,
+            "flushed": self.flushed,
+            "flush_failures": self.flush_failures,
+        }
+
+
+async def _write_access_logs(rows: List[Dict[str, Any]]) -> None:
+    await prisma.models.AccessLog.prisma().create_many(data=rows)
+
+
+async def _write_analytics_events(rows: List[Dict[str, Any]]) -> None:
+    await prisma.models.AnalyticsEvent.prisma().create_many(data=rows)
+
+
+access_log_buffer: BatchingBuffer[Dict[str, Any]] = BatchingBuffer(
+    "AccessLog", _write_access_logs
+)
+analytics_event_buffer: BatchingBuffer[Dict[str, Any]] = BatchingBuffer(
+    "AnalyticsEvent", _write_analytics_events
+)
+
+
+def record_access(
+    endpoint: str, method: str, user_id: Optional[str], response_time_ms: int
+) -> None:
+    """
+    Buffers an AccessLog row for the next batched flush.
+    """
+    access_log_buffer.offer(
+        {
+            "userId": user_id,
+            "endpoint": endpoint,
+            "method": method,
+            "responseTime": response_time_ms,
+            "accessedAt": datetime.now(),
+        }
+    )
+
+
+def record_analytics_event(
+    type: str, metadata: Dict[str, Any], occurred_at: Optional[datetime] = None
+) -> None:
+    """
+    Buffers an AnalyticsEvent row for the next batched flush. occurred_at defaults to now.
+    """
+    analytics_event_buffer.offer(
+        {
+            "type": type,
+            "metadata": prisma.Json(metadata),
+            "occurredAt": occurred_at or datetime.now(),
+        }
+    )
+
+
+def start_event_ingestion() -> None:
+    access_log_buffer.start()
+    analytics_event_buffer.start()
+
+
+async def stop_event_ingestion() -> None:
+    """
+    Flushes every buffered event; called on lifespan shutdown.
+    """
+    await access_log_buffer.stop()
+    await analytics_event_buffer.stop()
@@ -0,0 +1,353 @@
+import asyncio
+import os
+import uuid
+from datetime import datetime
+from typing import AsyncIterator, Dict, List, Optional
+
+import prisma
+import prisma.enums
+import prisma.models
+import project.generate_image_service
+import project.generation_accounting
+import project.image_events
+import project.image_job_queue
+import project.image_request_store
+import project.image_result_cache
+import project.prompt_moderation
+import project.prompt_similarity_index
+import project.rate_limiting
+from pydantic import BaseModel
+
+IMAGE_BATCH_MAX_PROMPTS = int(os.environ.get("IMAGE_BATCH_MAX_PROMPTS", "1000"))
+IMAGE_BATCH_CONCURRENCY = int(os.environ.get("IMAGE_BATCH_CONCURRENCY", "16"))
+IMAGE_BATCH_UPDATE_SIZE = int(os.environ.get("IMAGE_BATCH_UPDATE_SIZE", "50"))
+
+
+class BatchPrompt(BaseModel):
+    """
+    One prompt of a batch generation request.
+    """
+
+    text_description: str
+    ai_model: prisma.enums.AIModel
+    theme: Optional[str] = None
+    style: Optional[str] = None
+    customization_options: Optional[Dict[str, str]] = None
+
+
+class GenerateImageBatchRequest(BaseModel):
+    """
+    The prompts to generate in one call.
+    """
+
+    prompts: List[BatchPrompt]
+
+
+class GenerateImageBatchItem(BaseModel):
+    """
+    The outcome of one prompt of a batch, streamed back as soon as it is known. index refers to the position in the request.
+    """
+
+    index: int
+    request_id: str
+    status: prisma.enums.ImageRequestStatus
+    image_url: Optional[str] = None
+    error: Optional[str] = None
+
+
+class ImageBatch:
+    """
+    A batch whose ImageRequest rows have been inserted and whose prompts are ready to be dispatched.
+    """
+
+    def __init__(
+        self,
+        prompts: List[BatchPrompt],
+        request_ids: Dict[int, str],
+        cache_keys: Dict[int, str],
+        cached: Dict[int, project.image_result_cache.CachedImageResult],
+        rejected: Optional[Dict[int, str]] = None,
+        user_id: Optional[str] = None,
+        rate_limited: bool = False,
+    ) -> None:
+        self.prompts = prompts
+        self.request_ids = request_ids
+        self.cache_keys = cache_keys
+        self.cached = cached
+        self.rejected = rejected or {}
+        self.user_id = user_id
+        self.rate_limited = rate_limited and user_id is not None
+        # One prompt at a time waits for the user's token bucket, instead of all of them polling it.
+        self._token_lock = asyncio.Lock()
+        # Timings of the prompts that were generated rather than shared from the cache.
+        self.timings: Dict[int, project.generation_accounting.GenerationTiming] = {}
+        self._pending_updates: List[project.image_request_store.StatusTransition] = []
+
+    async def _flush_updates(self) -> None:
+        updates, self._pending_updates = self._pending_updates, []
+        await project.image_request_store.write_status_transitions(updates)
+
+    async def _run_one(
+        self, index: int, semaphore: asyncio.Semaphore
+    ) -> GenerateImageBatchItem:
+        prompt = self.prompts[index]
+        request_id = self.request_ids[index]
+        if self.rate_limited:
+            async with self._token_lock:
+                await project.rate_limiting.wait_for_generation_token(self.user_id)
+
+        async def compute() -> project.image_result_cache.CachedImageResult:
+            timing = self.timings[index] = project.generation_accounting.GenerationTiming()
+            async with semaphore:
+                # The lease of the row starts now; until here _renew_leases kept it alive.
+                await prisma.models.ImageRequest.prisma().update(
+                    where={"id": request_id}, data={"claimedAt": datetime.now()}
+                )
+                image_url = await project.generate_image_service.render_image(
+                    prompt.text_description,
+                    prompt.ai_model,
+                    prompt.theme,
+                    prompt.style,
+                    request_id=request_id,
+                    customization_options=prompt.customization_options,
+                    timing=timing,
+                )
+            if self.user_id is not None:
+                await project.generation_accounting.record_generation(
+                    self.user_id, prompt.ai_model, timing
+                )
+            await project.prompt_similarity_index.record_completed_image(
+                request_id,
+                image_url,
+                prompt.text_description,
+                prompt.ai_model,
+                prompt.theme,
+                prompt.style,
+                prompt.customization_options,
+            )
+            return project.image_result_cache.CachedImageResult(
+                request_id=request_id, image_url=image_url
+            )
+
+        try:
+            # Repeated prompts within the batch share a single backend call.
+            result, _ = await project.image_result_cache.image_result_cache.get_or_compute(
+                self.cache_keys[index], compute
+            )
+        except Exception as e:
+            if self.user_id is not None and index in self.timings:
+                await project.generation_accounting.record_generation(
+                    self.user_id, prompt.ai_model, self.timings[index], failed=True
+                )
+            return GenerateImageBatchItem(
+                index=index,
+                request_id=request_id,
+                status=prisma.enums.ImageRequestStatus.FAILED,
+                error=str(e),
+            )
+        return GenerateImageBatchItem(
+            index=index,
+            request_id=request_id,
+            status=prisma.enums.ImageRequestStatus.COMPLETED,
+            image_url=result.image_url,
+        )
+
+    async def _renew_leases(self, tasks: List[asyncio.Task]) -> None:
+        """
+        Keeps the rows of unfinished prompts from being requeued by the lease reaper while
+        they wait for a concurrency slot or a rate limit token, or are being generated.
+        """
+        while True:
+            await asyncio.sleep(project.image_job_queue.IMAGE_REQUEST_LEASE_SECONDS / 3)
+            unfinished = [
+                self.request_ids[index]
+                for index, task in zip(self.request_ids, tasks)
+                if not task.done()
+            ]
+            if unfinished:
+                await prisma.models.ImageRequest.prisma().update_many(
+                    where={
+                        "id": {"in": unfinished},
+                        "status": prisma.enums.ImageRequestStatus.PROCESSING,
+                    },
+                    data={"claimedAt": datetime.now()},
+                )
+
+    async def results(self) -> AsyncIterator[GenerateImageBatchItem]:
+        """
+        Yields one item per prompt in completion order. Status updates are written back in
+        groups of IMAGE_BATCH_UPDATE_SIZE through a single batched transaction each.
+        """
+        for index, cached in self.cached.items():
+            await project.image_events.publish_status(
+                cached.request_id, prisma.enums.ImageRequestStatus.COMPLETED, cached.image_url
+            )
+            yield GenerateImageBatchItem(
+                index=index,
+                request_id=cached.request_id,
+                status=prisma.enums.ImageRequestStatus.COMPLETED,
+                image_url=cached.image_url,
+            )
+        for index, request_id in self.rejected.items():
+            yield GenerateImageBatchItem(
+                index=index,
+                request_id=request_id,
+                status=prisma.enums.ImageRequestStatus.FAILED,
+                error="The prompt was rejected by content moderation",
+            )
+        semaphore = asyncio.Semaphore(IMAGE_BATCH_CONCURRENCY)
+        tasks = [
+            asyncio.create_task(self._run_one(index, semaphore))
+            for index in self.request_ids
+        ]
+        lease_renewal = asyncio.create_task(self._renew_leases(tasks))
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                item = await next_done
+                self._pending_updates.append(
+                    (
+                        item.request_id,
+                        item.status,
+                        item.image_url,
+                        self.timings[item.index].columns()
+                        if item.index in self.timings
+                        else None,
+                    )
+                )
+                if len(self._pending_updates) >= IMAGE_BATCH_UPDATE_SIZE:
+                    await self._flush_updates()
+                await project.image_events.publish_status(
+                    item.request_id, item.status, item.image_url
+                )
+                yield item
+        finally:
+            # If the client went away, stop the remaining work and fail its rows so they do not stay PROCESSING.
+            unfinished = [
+                self.request_ids[index]
+                for index, task in zip(self.request_ids, tasks)
+                if not task.done()
+            ]
+            for task in [lease_renewal, *tasks]:
+                task.cancel()
+            await asyncio.gather(lease_renewal, *tasks, return_exceptions=True)
+            await self._flush_updates()
+            if unfinished:
+                await prisma.models.ImageRequest.prisma().update_many(
+                    where={"id": {"in": unfinished}},
+                    data={"status": prisma.enums.ImageRequestStatus.FAILED},
+                )
+                for request_id in unfinished:
+                    await project.image_events.publish_status(
+                        request_id, prisma.enums.ImageRequestStatus.FAILED
+                    )
+
+
+async def start_image_batch(
+    user_id: str, prompts: List[BatchPrompt], rate_limited: bool = False
+) -> ImageBatch:
+    """
+    Validates a batch and inserts an ImageRequest row for every prompt.
+
+    Prompts whose result is already cached get a COMPLETED row pointing at the cached image
+    and are not generated again. Prompts matching the moderation blocklist are recorded as
+    FAILED, with a ModerationReport, and come back as FAILED items without being generated.
+
+    All rows, their CustOption rows and the ModerationReports are written by create_many
+    statements in a single transaction, so every request_id the batch returns already exists.
+
+    Args:
+        user_id (str): The authenticated user the requests belong to.
+        prompts (List[BatchPrompt]): The prompts to generate.
+        rate_limited (bool): Charge each generated prompt to the user's plan as it starts,
+            waiting for the token bucket to refill when it is empty.
+
+    Returns:
+        ImageBatch: The prepared batch; iterate ImageBatch.results() to run it.
+    """
+    if not prompts:
+        raise ValueError("A batch must contain at least one prompt")
+    if len(prompts) > IMAGE_BATCH_MAX_PROMPTS:
+        raise ValueError(
+            f"A batch may contain at most {IMAGE_BATCH_MAX_PROMPTS} prompts"
+        )
+    cache_keys: Dict[int, str] = {}
+    cached: Dict[int, project.image_result_cache.CachedImageResult] = {}
+    rejected: Dict[int, str] = {}
+    rejections: List[project.prompt_moderation.Rejection] = []
+    request_ids: Dict[int, str] = {}
+    rows = []
+    customization_options: Dict[str, Dict[str, str]] = {}
+    now = datetime.now()
+    for index, prompt in enumerate(prompts):
+        cache_key = project.image_result_cache.result_cache_key(
+            prompt.text_description,
+            prompt.ai_model,
+            prompt.theme,
+            prompt.style,
+            prompt.customization_options,
+        )
+        cache_keys[index] = cache_key
+        verdict = project.prompt_moderation.moderate_prompt(
+            prompt.text_description,
+            prompt.theme,
+            prompt.style,
+            prompt.customization_options,
+        )
+        if not verdict.allowed:
+            rejection = project.prompt_moderation.build_rejection(
+                user_id,
+                prompt.text_description,
+                prompt.ai_model,
+                prompt.theme,
+                prompt.style,
+                prompt.customization_options,
+                verdict.term,
+                cache_key,
+            )
+            rejections.append(rejection)
+            rejected[index] = rejection[0]["id"]
+            continue
+        # Ids are generated here so that create_many, which only returns a count, needs no read-back.
+        request_id = str(uuid.uuid4())
+        row = {
+            "id": request_id,
+            "userId": user_id,
+            "textDescription": prompt.text_description,
+            "AIModel": prompt.ai_model,
+            "theme": prompt.theme,
+            "style": prompt.style,
+            "promptHash": cache_key,
+        }
+        hit = await project.image_result_cache.image_result_cache.get(cache_key)
+        if hit is not None:
+            # The user gets a COMPLETED request of their own pointing at the cached image.
+            cached[index] = project.image_result_cache.CachedImageResult(
+                request_id=request_id, image_url=hit.image_url
+            )
+            row["status"] = prisma.enums.ImageRequestStatus.COMPLETED
+            row["imageUrl"] = hit.image_url
+        else:
+            request_ids[index] = request_id
+            row["status"] = prisma.enums.ImageRequestStatus.PROCESSING
+            # Claimed by this batch, so queue workers leave the row alone.
+            row["claimedAt"] = now
+        rows.append(row)
+        if prompt.customization_options:
+            customization_options[request_id] = prompt.customization_options
+    if rows or rejections:
+        async with prisma.get_client().batch_() as batcher:
+            if rows:
+                project.image_request_store.add_image_requests_to_batch(
+                    batcher, rows, customization_options
+                )
+            if rejections:
+                project.prompt_moderation.add_rejections_to_batch(batcher, rejections)
+    return ImageBatch(
+        prompts,
+        request_ids,
+        cache_keys,
+        cached,
+        rejected,
+        user_id=user_id,
+        rate_limited=rate_limited,
+    )
@@ -1,21 +1,53 @@
+import base64
+import logging
+import time
+import uuid
+from datetime import datetime
 from enum import Enum
-from typing import Optional
+from typing import Any, Dict, Optional
 
 import prisma
 import prisma.enums
+import prisma.errors
 import prisma.models
+import project.event_ingestion
+import project.generation_accounting
+import project.image_backends
+import project.image_events
+import project.image_job_queue
+import project.image_postprocessing
+import project.image_request_store
+import project.image_result_cache
+import project.image_storage
+import project.metrics
+import project.prompt_moderation
+import project.prompt_similarity_index
 from pydantic import BaseModel
 
+logger = logging.getLogger(__name__)
+
 
 class GenerateImageResponse(BaseModel):
     """
     This model provides details about the generated image, including the URL and status.
     """
 
-    image_url: str
+    request_id: str
+    image_url: Optional[str] = None
     status: prisma.enums.ImageRequestStatus
     ai_model_used: prisma.enums.AIModel
     text_description_used: str
+    similar_image: Optional[project.prompt_similarity_index.SimilarImage] = None
+
+
+class IdempotencyKeyReused(Exception):
+    """
+    Raised when an Idempotency-Key is sent again with a different prompt, model or options than the request that first used it.
+    """
+
+    def __init__(self, request_id: str) -> None:
+        super().__init__("The Idempotency-Key was already used for a different request")
+        self.request_id = request_id
 
 
 class AIModel(Enum):
@@ -31,44 +63,690 @@ class ImageRequestStatus(Enum):
     FAILED: str = "FAILED"
 
 
+def image_data_url(image: project.image_backends.GeneratedImage) -> str:
+    """
+    Returns the URL of a backend result, inlining raw bytes as a data URL.
+    """
+    if image.url:
+        return image.url
+    return f"data:{image.content_type};base64,{base64.b64encode(image.data).decode('ascii')}"
+
+
+async def render_image(
+    text_description: str,
+    ai_model: prisma.enums.AIModel,
+    theme: Optional[str],
+    style: Optional[str],
+    on_preview: Optional[project.image_backends.PreviewCallback] = None,
+    request_id: Optional[str] = None,
+    customization_options: Optional[Dict[str, str]] = None,
+    timing: Optional[project.generation_accounting.GenerationTiming] = None,
+) -> str:
+    """
+    Runs the selected AI model on the request inputs and returns the URL of the resulting image.
+
+    Images the backend returns as bytes are post-processed (crop, resize, watermark,
+    format and quality, as set in customization_options) in the image process pool,
+    written to the blob store under request_id and served from GET /image/{id}/file.
+    Images hosted by the provider are returned as they are.
+
+    Args:
+        text_description (str): The textual description to render.
+        ai_model (prisma.enums.AIModel): The AI model to render with.
+        theme (Optional[str]): Optional theme preference.
+        style (Optional[str]): Optional style preference.
+        on_preview (Optional[PreviewCallback]): Receives intermediate frames, if the backend produces any.
+        request_id (Optional[str]): The ImageRequest the image is stored under. Without it, raw bytes are inlined as a data URL.
+        customization_options (Optional[Dict[str, str]]): The option/value pairs of the request, validated by apply_plan_options.
+        timing (Optional[GenerationTiming]): Receives the backend and post-processing time and the stored size, also when the backend fails.
+
+    Returns:
+        str: The URL of the generated image.
+    """
+    if timing is None:
+        timing = project.generation_accounting.GenerationTiming()
+    backend = project.image_backends.get_backend(ai_model)
+    started = time.perf_counter()
+    try:
+        image = await backend.generate(text_description, theme, style, on_preview)
+    finally:
+        timing.backend_ms = project.generation_accounting.elapsed_ms(started)
+    if image.data is not None and request_id is not None:
+        data = image.data
+        spec = project.image_postprocessing.parse_postprocessing_options(customization_options)
+        if spec is not None:
+            started = time.perf_counter()
+            data = await project.image_postprocessing.postprocess(data, spec)
+            timing.postprocess_ms = project.generation_accounting.elapsed_ms(started)
+        timing.image_bytes = len(data)
+        return await project.image_storage.store_image(request_id, data)
+    return image_data_url(image)
+
+
+async def _finish_reserved_request(
+    request_id: str,
+    status: prisma.enums.ImageRequestStatus,
+    image_url: Optional[str] = None,
+    ai_model: Optional[prisma.enums.AIModel] = None,
+    timing: Optional[Dict[str, Any]] = None,
+    prompt_hash: Optional[str] = None,
+) -> None:
+    """
+    Writes the outcome of a row reserved for an Idempotency-Key and tells its event subscribers.
+    """
+    await project.image_request_store.finish_image_request(
+        request_id, status, image_url, ai_model, timing, prompt_hash=prompt_hash
+    )
+    await project.image_events.publish_status(request_id, status, image_url)
+
+
+async def _record_served_image(
+    user_id: str,
+    text_description: str,
+    ai_model: prisma.enums.AIModel,
+    theme: Optional[str],
+    style: Optional[str],
+    customization_options: Optional[Dict[str, str]],
+    image_url: str,
+    prompt_hash: str,
+    idempotency_key: Optional[str] = None,
+) -> str:
+    """
+    Stores a COMPLETED request for the caller pointing at an image served from an earlier request, so it shows up in their history.
+
+    Cache hits and near-duplicates answer with this request rather than the earlier one,
+    which may belong to another user.
+
+    Returns:
+        str: The id of the new request.
+
+    Raises:
+        prisma.errors.UniqueViolationError: If the user already has a request with idempotency_key.
+    """
+    image_request = await project.image_request_store.create_image_request(
+        user_id,
+        text_description,
+        ai_model,
+        theme,
+        style,
+        prisma.enums.ImageRequestStatus.COMPLETED,
+        prompt_hash=prompt_hash,
+        image_url=image_url,
+        customization_options=customization_options,
+        idempotency_key=idempotency_key,
+    )
+    await project.image_events.publish_status(
+        image_request.id, prisma.enums.ImageRequestStatus.COMPLETED, image_url
+    )
+    return image_request.id
+
+
+async def _generate_with_model(
+    user_id: str,
+    text_description: str,
+    ai_model: prisma.enums.AIModel,
+    theme: Optional[str],
+    style: Optional[str],
+    customization_options: Optional[Dict[str, str]],
+    record_failure: bool,
+    reserved_request_id: Optional[str] = None,
+) -> GenerateImageResponse:
+    """
+    Runs generate_image for one model. A failed model call is only recorded as a FAILED row when record_failure is set.
+
+    With reserved_request_id, the outcome is written to that PROCESSING row instead of a new one.
+    """
+    cache_key = project.image_result_cache.result_cache_key(
+        text_description, ai_model, theme, style, customization_options
+    )
+    similar = project.prompt_similarity_index.find_similar_image(
+        text_description, ai_model, theme, style, customization_options
+    )
+    if similar is not None and project.prompt_similarity_index.PROMPT_SIMILARITY_MODE == "serve":
+        if reserved_request_id is not None:
+            request_id = reserved_request_id
+            await _finish_reserved_request(
+                reserved_request_id,
+                prisma.enums.ImageRequestStatus.COMPLETED,
+                similar.image_url,
+                ai_model,
+                prompt_hash=cache_key,
+            )
+        else:
+            request_id = await _record_served_image(
+                user_id,
+                text_description,
+                ai_model,
+                theme,
+                style,
+                customization_options,
+                similar.image_url,
+                cache_key,
+            )
+        return GenerateImageResponse(
+            request_id=request_id,
+            image_url=similar.image_url,
+            status=prisma.enums.ImageRequestStatus.COMPLETED,
+            ai_model_used=ai_model,
+            text_description_used=text_description,
+            similar_image=similar,
+        )
+
+    async def compute() -> project.image_result_cache.CachedImageResult:
+        # The id is chosen up front so the image can be stored under it before the row exists.
+        request_id = reserved_request_id or str(uuid.uuid4())
+        timing = project.generation_accounting.GenerationTiming()
+        try:
+            image_url = await render_image(
+                text_description,
+                ai_model,
+                theme,
+                style,
+                request_id=request_id,
+                customization_options=customization_options,
+                timing=timing,
+            )
+        except Exception:
+            await project.generation_accounting.record_generation(
+                user_id, ai_model, timing, failed=True
+            )
+            if record_failure and reserved_request_id is not None:
+                # Only the timing; generate_image marks the row FAILED.
+                await project.image_request_store.finish_image_request(
+                    request_id,
+                    prisma.enums.ImageRequestStatus.PROCESSING,
+                    timing=timing.columns(),
+                )
+            elif record_failure:
+                await project.image_request_store.create_image_request(
+                    user_id,
+                    text_description,
+                    ai_model,
+                    theme,
+                    style,
+                    prisma.enums.ImageRequestStatus.FAILED,
+                    prompt_hash=cache_key,
+                    customization_options=customization_options,
+                    request_id=request_id,
+                    timing=timing.columns(),
+                )
+                await project.image_events.publish_status(
+                    request_id, prisma.enums.ImageRequestStatus.FAILED
+                )
+            project.event_ingestion.record_analytics_event(
+                "image_generation_failed", {"ai_model": ai_model, "queued": False}
+            )
+            raise
+        await project.generation_accounting.record_generation(user_id, ai_model, timing)
+        project.event_ingestion.record_analytics_event(
+            "image_generation_completed", {"ai_model": ai_model, "queued": False}
+        )
+        if reserved_request_id is not None:
+            await _finish_reserved_request(
+                request_id,
+                prisma.enums.ImageRequestStatus.COMPLETED,
+                image_url,
+                ai_model,
+                timing.columns(),
+                prompt_hash=cache_key,
+            )
+        else:
+            await project.image_request_store.create_image_request(
+                user_id,
+                text_description,
+                ai_model,
+                theme,
+                style,
+                prisma.enums.ImageRequestStatus.COMPLETED,
+                prompt_hash=cache_key,
+                image_url=image_url,
+                customization_options=customization_options,
+                request_id=request_id,
+                timing=timing.columns(),
+            )
+            await project.image_events.publish_status(
+                request_id, prisma.enums.ImageRequestStatus.COMPLETED, image_url
+            )
+        await project.prompt_similarity_index.record_completed_image(
+            request_id,
+            image_url,
+            text_description,
+            ai_model,
+            theme,
+            style,
+            customization_options,
+        )
+        return project.image_result_cache.CachedImageResult(
+            request_id=request_id, image_url=image_url
+        )
+
+    result, hit = await project.image_result_cache.image_result_cache.get_or_compute(
+        cache_key, compute
+    )
+    request_id = reserved_request_id or result.request_id
+    if hit and reserved_request_id is not None:
+        # Answered by the cache or by a concurrent identical request.
+        await _finish_reserved_request(
+            reserved_request_id,
+            prisma.enums.ImageRequestStatus.COMPLETED,
+            result.image_url,
+            ai_model,
+            prompt_hash=cache_key,
+        )
+    elif hit:
+        request_id = await _record_served_image(
+            user_id,
+            text_description,
+            ai_model,
+            theme,
+            style,
+            customization_options,
+            result.image_url,
+            cache_key,
+        )
+    return GenerateImageResponse(
+        request_id=request_id,
+        image_url=result.image_url,
+        status=prisma.enums.ImageRequestStatus.COMPLETED,
+        ai_model_used=ai_model,
+        text_description_used=text_description,
+        similar_image=(
+            similar if similar is not None and similar.image_url != result.image_url else None
+        ),
+    )
+
+
+async def replay_idempotent_request(
+    user_id: str,
+    idempotency_key: str,
+    text_description: str,
+    ai_model: prisma.enums.AIModel,
+    theme: Optional[str],
+    style: Optional[str],
+    customization_options: Optional[Dict[str, str]],
+) -> Optional[GenerateImageResponse]:
+    """
+    Returns the request a user already created with an Idempotency-Key, in whatever state it is now, or None if the key is new.
+
+    The endpoint calls this before charging the rate limit, so a replayed retry costs nothing.
+
+    Raises:
+        IdempotencyKeyReused: If the stored request was for a different prompt, model or options.
+    """
+    existing = await project.image_request_store.find_idempotent_request(user_id, idempotency_key)
+    if existing is None:
+        return None
+    # A substitute model may have produced the stored image; the row then carries its key.
+    if existing.AIModel not in project.image_backends.failover_chain(
+        ai_model
+    ) or existing.promptHash != project.image_result_cache.result_cache_key(
+        text_description, existing.AIModel, theme, style, customization_options
+    ):
+        raise IdempotencyKeyReused(existing.id)
+    return GenerateImageResponse(
+        request_id=existing.id,
+        image_url=existing.imageUrl,
+        status=existing.status,
+        ai_model_used=existing.AIModel,
+        text_description_used=existing.textDescription,
+    )
+
+
 async def generate_image(
+    user_id: str,
     text_description: str,
     ai_model: prisma.enums.AIModel,
     theme: Optional[str],
     style: Optional[str],
+    customization_options: Optional[Dict[str, str]] = None,
+    allow_substitution: bool = False,
+    idempotency_key: Optional[str] = None,
 ) -> GenerateImageResponse:
     """
     Generates an image based on user input using the selected AI model.
 
+    Identical requests (after canonicalization) are answered from the result cache, and
+    concurrent identical requests share a single backend call; either way the caller gets a
+    COMPLETED request of their own pointing at the shared image. The ImageRequest row is
+    written once, after the model call, with its final status. The image of a near-duplicate
+    earlier request is attached as similar_image, or served instead when PROMPT_SIMILARITY_MODE
+    is "serve", in which case it is stored as a COMPLETED request of the caller.
+    Prompts matching the moderation blocklist are rejected before any of this.
+
+    With allow_substitution, a request whose model fails or has an open circuit breaker
+    moves on to the substitutes IMAGE_BACKEND_FAILOVER lists for it, and ai_model_used
+    (and the stored row) name the model that produced the image.
+
+    With an idempotency_key, the ImageRequest row is inserted as PROCESSING before the
+    model call and finished afterwards. Repeating the key returns that row as it is then
+    (the image once it is COMPLETED) without generating again, and a request that was
+    interrupted by a crash is picked up again by the lease reaper in project.image_job_queue.
+
     Args:
+        user_id (str): The authenticated user the request belongs to.
         text_description (str): The textual description provided by the user, which serves as input for generating the image.
         ai_model (prisma.enums.AIModel): The selected AI model to be used for image generation. Can be one of: DALLE2, IMAGEN, MIDJOURNEY, STABLEDIFFUSION.
         theme (Optional[str]): Optional: The theme preference for the generated image.
         style (Optional[str]): Optional: The style preference for the generated image.
+        customization_options (Optional[Dict[str, str]]): Optional: Additional option/value pairs, stored as CustOption rows. width, height, crop, format, quality and watermark are applied to the image after generation.
+        allow_substitution (bool): Optional: Whether another model may be used if the selected one is failing.
+        idempotency_key (Optional[str]): Optional: A client-chosen key that makes retries of this request return the first one.
 
     Returns:
         GenerateImageResponse: This model provides details about the generated image, including the URL and status.
+
+    Raises:
+        PromptRejected: If the request matched the moderation blocklist.
+        IdempotencyKeyReused: If idempotency_key was already used for a different request.
+    """
+    cache_key = project.image_result_cache.result_cache_key(
+        text_description, ai_model, theme, style, customization_options
+    )
+    project.prompt_moderation.check_prompt(
+        user_id,
+        text_description,
+        ai_model,
+        theme,
+        style,
+        customization_options,
+        prompt_hash=cache_key,
+    )
+    reserved_request_id = None
+    if idempotency_key is not None:
+        replay = await replay_idempotent_request(
+            user_id, idempotency_key, text_description, ai_model, theme, style, customization_options
+        )
+        if replay is not None:
+            return replay
+        try:
+            reserved = await project.image_request_store.create_image_request(
+                user_id,
+                text_description,
+                ai_model,
+                theme,
+                style,
+                prisma.enums.ImageRequestStatus.PROCESSING,
+                prompt_hash=cache_key,
+                customization_options=customization_options,
+                claimed=True,
+                idempotency_key=idempotency_key,
+            )
+        except prisma.errors.UniqueViolationError:
+            # A concurrent retry with the same key got there first.
+            replay = await replay_idempotent_request(
+                user_id, idempotency_key, text_description, ai_model, theme, style, customization_options
+            )
+            if replay is None:
+                raise
+            return replay
+        reserved_request_id = reserved.id
+    candidates = (
+        project.image_backends.failover_chain(ai_model) if allow_substitution else [ai_model]
+    )
+    try:
+        for position, candidate in enumerate(candidates):
+            last = position == len(candidates) - 1
+            try:
+                return await _generate_with_model(
+                    user_id,
+                    text_description,
+                    candidate,
+                    theme,
+                    style,
+                    customization_options,
+                    record_failure=last,
+                    reserved_request_id=reserved_request_id,
+                )
+            except project.image_backends.ImageBackendError as e:
+                if last:
+                    raise
+                substitute = candidates[position + 1]
+                logger.warning("Falling back from %s to %s: %s", candidate, substitute, e)
+                project.metrics.image_backend_failovers.inc(
+                    from_model=prisma.enums.AIModel(candidate).value,
+                    to_model=prisma.enums.AIModel(substitute).value,
+                )
+    except Exception:
+        if reserved_request_id is not None:
+            # Also covers failures outside this request's own model call, such as a failed
+            # identical request it was waiting for, so the reserved row never stays PROCESSING.
+            await _finish_reserved_request(
+                reserved_request_id, prisma.enums.ImageRequestStatus.FAILED
+            )
+        raise
+    raise AssertionError("unreachable")
+
+
+async def enqueue_generate_image(
+    user_id: str,
+    text_description: str,
+    ai_model: prisma.enums.AIModel,
+    theme: Optional[str],
+    style: Optional[str],
+    customization_options: Optional[Dict[str, str]] = None,
+    weight: float = 1.0,
+    idempotency_key: Optional[str] = None,
+) -> GenerateImageResponse:
+    """
+    Records an image request as PROCESSING and hands it to the worker pool instead of generating it inline.
+
+    The caller gets the request id back immediately and can poll GET /image/{id} until the
+    request is COMPLETED or FAILED.
+
+    Args:
+        user_id (str): The authenticated user the request belongs to.
+        text_description (str): The textual description provided by the user, which serves as input for generating the image.
+        ai_model (prisma.enums.AIModel): The selected AI model to be used for image generation.
+        theme (Optional[str]): Optional: The theme preference for the generated image.
+        style (Optional[str]): Optional: The style preference for the generated image.
+        customization_options (Optional[Dict[str, str]]): Optional: Additional option/value pairs, stored as CustOption rows. width, height, crop, format, quality and watermark are applied to the image after generation.
+        weight (float): The user's share of the worker pool relative to other users, from their plan.
+        idempotency_key (Optional[str]): Optional: A client-chosen key; repeating it returns the request it first created instead of queueing another.
+
+    Returns:
+        GenerateImageResponse: The queued request, with no image_url yet, or, if an identical
+        request is already cached, a COMPLETED request of the caller with its image. The image of a
+        near-duplicate earlier request is attached as similar_image, or served as the result,
+        stored as a COMPLETED request of the caller, when PROMPT_SIMILARITY_MODE is "serve".
+
+    Raises:
+        PromptRejected: If the request matched the moderation blocklist.
+        IdempotencyKeyReused: If idempotency_key was already used for a different request.
     """
-    image_request_record = await prisma.models.ImageRequest.prisma().create(
-        data={
-            "userId": "user_id_placeholder",
-            "textDescription": text_description,
-            "prisma.enums.AIModel": ai_model,
-            "theme": theme,
-            "style": style,
-            "status": prisma.enums.ImageRequestStatus.PROCESSING,
-        }
-    )
-    completed_request = await prisma.models.ImageRequest.prisma().update(
-        where={"id": image_request_record.id},
-        data={
-            "imageUrl": "http://example.com/placeholder_image.png",
-            "status": prisma.enums.ImageRequestStatus.COMPLETED,
-        },
+    cache_key = project.image_result_cache.result_cache_key(
+        text_description, ai_model, theme, style, customization_options
+    )
+    project.prompt_moderation.check_prompt(
+        user_id,
+        text_description,
+        ai_model,
+        theme,
+        style,
+        customization_options,
+        prompt_hash=cache_key,
+    )
+    if idempotency_key is not None:
+        replay = await replay_idempotent_request(
+            user_id, idempotency_key, text_description, ai_model, theme, style, customization_options
+        )
+        if replay is not None:
+            return replay
+    cached = await project.image_result_cache.image_result_cache.get(cache_key)
+    similar = (
+        project.prompt_similarity_index.find_similar_image(
+            text_description, ai_model, theme, style, customization_options
+        )
+        if cached is None
+        else None
+    )
+    try:
+        if cached is not None:
+            request_id = await _record_served_image(
+                user_id,
+                text_description,
+                ai_model,
+                theme,
+                style,
+                customization_options,
+                cached.image_url,
+                cache_key,
+                idempotency_key=idempotency_key,
+            )
+            return GenerateImageResponse(
+                request_id=request_id,
+                image_url=cached.image_url,
+                status=prisma.enums.ImageRequestStatus.COMPLETED,
+                ai_model_used=ai_model,
+                text_description_used=text_description,
+            )
+        if similar is not None and project.prompt_similarity_index.PROMPT_SIMILARITY_MODE == "serve":
+            request_id = await _record_served_image(
+                user_id,
+                text_description,
+                ai_model,
+                theme,
+                style,
+                customization_options,
+                similar.image_url,
+                cache_key,
+                idempotency_key=idempotency_key,
+            )
+            return GenerateImageResponse(
+                request_id=request_id,
+                image_url=similar.image_url,
+                status=prisma.enums.ImageRequestStatus.COMPLETED,
+                ai_model_used=ai_model,
+                text_description_used=text_description,
+                similar_image=similar,
+            )
+        image_request_record = await project.image_request_store.create_image_request(
+            user_id,
+            text_description,
+            ai_model,
+            theme,
+            style,
+            prisma.enums.ImageRequestStatus.PROCESSING,
+            prompt_hash=cache_key,
+            customization_options=customization_options,
+            idempotency_key=idempotency_key,
+        )
+    except prisma.errors.UniqueViolationError:
+        if idempotency_key is None:
+            raise
+        replay = await replay_idempotent_request(
+            user_id, idempotency_key, text_description, ai_model, theme, style, customization_options
+        )
+        if replay is None:
+            raise
+        return replay
+    await project.image_job_queue.get_image_job_queue().submit(
+        image_request_record.id, owner=user_id, weight=weight
+    )
+    await project.image_events.publish_status(
+        image_request_record.id, prisma.enums.ImageRequestStatus.PROCESSING
     )
     return GenerateImageResponse(
-        image_url=completed_request.imageUrl,
-        status=completed_request.status,
-        ai_model_used=completed_request.AIModel,
-        text_description_used=completed_request.textDescription,
+        request_id=image_request_record.id,
+        image_url=None,
+        status=image_request_record.status,
+        ai_model_used=image_request_record.AIModel,
+        text_description_used=image_request_record.textDescription,
+        similar_image=similar,
+    )
+
+
+async def process_image_request(request_id: str) -> None:
+    """
+    Generates the image for a queued request and moves it to COMPLETED, or to FAILED if the model call raises.
+
+    Requests that are no longer PROCESSING (for example because another worker already
+    finished them) are skipped. A request without claimedAt (one from the local queue) is
+    stamped as claimed now, which starts its lease. The final transition goes through the status batcher, so
+    concurrent workers share one write; it also stores the queue wait, backend and
+    post-processing time, which are added to the generation accounting as well.
+
+    Args:
+        request_id (str): The id of the ImageRequest to process.
+    """
+    image_request = await prisma.models.ImageRequest.prisma().find_unique(
+        where={"id": request_id}, include={"customizationOptions": True}
+    )
+    if (
+        not image_request
+        or image_request.status != prisma.enums.ImageRequestStatus.PROCESSING
+    ):
+        return
+    claimed_at = image_request.claimedAt
+    if claimed_at is None:
+        # The local queue hands out ids without touching the row; stamp the claim so the
+        # queue wait is known and the lease reaper can take the request over if it hangs.
+        claimed_at = datetime.now(image_request.createdAt.tzinfo)
+        await prisma.models.ImageRequest.prisma().update_many(
+            where={"id": request_id, "claimedAt": None},
+            data={"claimedAt": claimed_at},
+        )
+    customization_options = {
+        option.option: option.value for option in image_request.customizationOptions or []
+    }
+    timing = project.generation_accounting.GenerationTiming(
+        queue_wait_ms=project.generation_accounting.queue_wait_ms(
+            image_request.createdAt, claimed_at
+        )
+    )
+
+    async def on_preview(preview: project.image_backends.GeneratedImage) -> None:
+        await project.image_events.publish_preview(request_id, image_data_url(preview))
+
+    try:
+        image_url = await render_image(
+            image_request.textDescription,
+            image_request.AIModel,
+            image_request.theme,
+            image_request.style,
+            on_preview if project.image_events.image_event_hub.subscriber_count() else None,
+            request_id=request_id,
+            customization_options=customization_options,
+            timing=timing,
+        )
+    except Exception:
+        project.event_ingestion.record_analytics_event(
+            "image_generation_failed", {"ai_model": image_request.AIModel, "queued": True}
+        )
+        await project.generation_accounting.record_generation(
+            image_request.userId, image_request.AIModel, timing, failed=True
+        )
+        await project.image_request_store.image_status_batcher.transition(
+            request_id, prisma.enums.ImageRequestStatus.FAILED, timing=timing.columns()
+        )
+        await project.image_events.publish_status(
+            request_id, prisma.enums.ImageRequestStatus.FAILED
+        )
+        raise
+    project.event_ingestion.record_analytics_event(
+        "image_generation_completed", {"ai_model": image_request.AIModel, "queued": True}
+    )
+    await project.generation_accounting.record_generation(
+        image_request.userId, image_request.AIModel, timing
+    )
+    await project.image_request_store.image_status_batcher.transition(
+        request_id, prisma.enums.ImageRequestStatus.COMPLETED, image_url, timing.columns()
+    )
+    await project.image_events.publish_status(
+        request_id, prisma.enums.ImageRequestStatus.COMPLETED, image_url
+    )
+    await project.prompt_similarity_index.record_completed_image(
+        request_id,
+        image_url,
+        image_request.textDescription,
+        image_request.AIModel,
+        image_request.theme,
+        image_request.style,
+        customization_options,
     )
+    if image_request.promptHash:
+        await project.image_result_cache.image_result_cache.set(
+            image_request.promptHash,
+            project.image_result_cache.CachedImageResult(
+                request_id=request_id, image_url=image_url
+            ),
+        )
@@ -0,0 +1,445 @@
+import asyncio
+import bisect
+import logging
+import os
+import time
+from datetime import datetime, timezone
+from enum import Enum
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import prisma
+import prisma.enums
+import prisma.models
+import project.event_ingestion
+import project.image_backends
+import project.rate_limiting
+from pydantic import BaseModel
+
+logger = logging.getLogger(__name__)
+
+# Minutes of per-minute aggregates kept in memory, and the longest window a report may cover.
+GENERATION_ACCOUNTING_WINDOW_MINUTES = int(
+    os.environ.get("GENERATION_ACCOUNTING_WINDOW_MINUTES", "60")
+)
+GENERATION_ACCOUNTING_MAX_REPORT_MINUTES = int(
+    os.environ.get("GENERATION_ACCOUNTING_MAX_REPORT_MINUTES", str(7 * 24 * 60))
+)
+# Seconds between writes of the finished minutes as AnalyticsEvent rollups.
+GENERATION_ROLLUP_INTERVAL = float(os.environ.get("GENERATION_ROLLUP_INTERVAL", "60"))
+
+ROLLUP_EVENT_TYPE = "generation_rollup"
+# Upper bounds of the backend latency histogram kept per rollup; slower calls go in a last bucket.
+LATENCY_BUCKETS_MS = (100, 250, 500, 1000, 2500, 5000, 10000, 20000, 30000, 60000, 120000)
+
+
+class GenerationTiming(BaseModel):
+    """
+    Where the time of one generation went, and how large the stored image is.
+    """
+
+    queue_wait_ms: Optional[int] = None
+    backend_ms: Optional[int] = None
+    postprocess_ms: Optional[int] = None
+    image_bytes: Optional[int] = None
+
+    def columns(self) -> Dict[str, int]:
+        """
+        Returns the measured values keyed by ImageRequest column.
+        """
+        return {
+            column: value
+            for column, value in (
+                ("queueWaitMs", self.queue_wait_ms),
+                ("backendMs", self.backend_ms),
+                ("postProcessMs", self.postprocess_ms),
+                ("imageBytes", self.image_bytes),
+            )
+            if value is not None
+        }
+
+
+def elapsed_ms(started: float) -> int:
+    """
+    Milliseconds since a time.perf_counter() reading.
+    """
+    return int((time.perf_counter() - started) * 1000)
+
+
+def queue_wait_ms(created_at: datetime, claimed_at: Optional[datetime]) -> int:
+    """
+    Milliseconds a queued request waited: until claimedAt when a queue stamped it, otherwise until now.
+    """
+    end = claimed_at if claimed_at is not None else datetime.now(created_at.tzinfo)
+    return max(0, int((end - created_at).total_seconds() * 1000))
+
+
+class Rollup:
+    """
+    Additive totals of the generations of one model and tier in one minute.
+
+    Rollups merge by adding their fields, so minutes from several workers, or several
+    minutes, combine into one without keeping individual requests.
+    """
+
+    FIELDS = (
+        "images",
+        "failures",
+        "backend_ms",
+        "max_backend_ms",
+        "queued",
+        "queue_wait_ms",
+        "postprocess_ms",
+        "image_bytes",
+    )
+
+    def __init__(self) -> None:
+        self.images = 0
+        self.failures = 0
+        self.backend_ms = 0
+        self.max_backend_ms = 0
+        self.queued = 0
+        self.queue_wait_ms = 0
+        self.postprocess_ms = 0
+        self.image_bytes = 0
+        self.latency_counts = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+
+    def add(self, timing: GenerationTiming, failed: bool) -> None:
+        if failed:
+            self.failures += 1
+        else:
+            self.images += 1
+            self.postprocess_ms += timing.postprocess_ms or 0
+            self.image_bytes += timing.image_bytes or 0
+        if timing.backend_ms is not None:
+            self.backend_ms += timing.backend_ms
+            self.max_backend_ms = max(self.max_backend_ms, timing.backend_ms)
+            self.latency_counts[bisect.bisect_left(LATENCY_BUCKETS_MS, timing.backend_ms)] += 1
+        if timing.queue_wait_ms is not None:
+            self.queued += 1
+            self.queue_wait_ms += timing.queue_wait_ms
+
+    def merge(self, other: "Rollup") -> None:
+        for field in self.FIELDS:
+            if field == "max_backend_ms":
+                self.max_backend_ms = max(self.max_backend_ms, other.max_backend_ms)
+            else:
+                setattr(self, field, getattr(self, field) + getattr(other, field))
+        self.latency_counts = [a + b for a, b in zip(self.latency_counts, other.latency_counts)]
+
+    def backend_percentile(self, q: float) -> Optional[float]:
+        """
+        Estimates a backend latency percentile by interpolating linearly inside the histogram bucket it falls in.
+        """
+        calls = sum(self.latency_counts)
+        if not calls:
+            return None
+        rank = q * calls
+        seen = 0
+        for i, count in enumerate(self.latency_counts):
+            if count and seen + count >= rank:
+                lower = LATENCY_BUCKETS_MS[i - 1] if i else 0
+                upper = LATENCY_BUCKETS_MS[i] if i < len(LATENCY_BUCKETS_MS) else self.max_backend_ms
+                estimate = lower + (upper - lower) * (rank - seen) / count
+                return round(min(estimate, self.max_backend_ms), 1)
+            seen += count
+        return float(self.max_backend_ms)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            **{field: getattr(self, field) for field in self.FIELDS},
+            "latency_counts": self.latency_counts,
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "Rollup":
+        rollup = cls()
+        for field in cls.FIELDS:
+            setattr(rollup, field, int(data.get(field, 0)))
+        counts = list(data.get("latency_counts") or [])
+        rollup.latency_counts = (counts + [0] * len(rollup.latency_counts))[
+            : len(rollup.latency_counts)
+        ]
+        return rollup
+
+
+# (epoch minute, model, plan)
+RollupKey = Tuple[int, str, str]
+
+
+class TierCapacity(BaseModel):
+    """
+    The share of a model's generations that came from one plan.
+    """
+
+    tier: str
+    images: int
+    failures: int
+    backend_p95_ms: Optional[float] = None
+
+
+class ModelCapacity(BaseModel):
+    """
+    Throughput, latency and the concurrency they imply for one model over the report window.
+
+    sustained_images_per_minute averages the minutes in which the model generated anything;
+    peak_images_per_minute is the busiest one. mean_concurrency is the average number of
+    backend calls in flight (total backend time over active time, Little's law), the
+    concurrency needed to sustain that throughput at that latency; peak_concurrency is the
+    same for the busiest minute.
+    """
+
+    ai_model: prisma.enums.AIModel
+    images: int
+    failures: int
+    error_rate: float
+    active_minutes: int
+    sustained_images_per_minute: float
+    peak_images_per_minute: int
+    backend_p50_ms: Optional[float] = None
+    backend_p95_ms: Optional[float] = None
+    mean_backend_ms: Optional[float] = None
+    mean_queue_wait_ms: Optional[float] = None
+    mean_postprocess_ms: Optional[float] = None
+    mean_image_bytes: Optional[float] = None
+    mean_concurrency: float
+    peak_concurrency: float
+    configured_concurrency: Optional[int] = None
+    tiers: List[TierCapacity]
+
+
+class CapacitySource(Enum):
+    CLUSTER: str = "cluster"
+    WORKER: str = "worker"
+
+
+class CapacityReport(BaseModel):
+    """
+    Per-model capacity figures over the last window_minutes, from every worker's persisted rollups (cluster) or this worker's memory (worker).
+    """
+
+    window_minutes: int
+    source: CapacitySource
+    models: List[ModelCapacity]
+
+
+def _mean(total: int, count: int) -> Optional[float]:
+    return round(total / count, 1) if count else None
+
+
+def capacity_report(
+    rollups: Iterable[Tuple[RollupKey, Rollup]], window_minutes: int, source: CapacitySource
+) -> CapacityReport:
+    """
+    Combines per-minute rollups into capacity figures for every model that has any.
+    """
+    per_model: Dict[str, Rollup] = {}
+    per_minute: Dict[Tuple[str, int], Rollup] = {}
+    per_tier: Dict[Tuple[str, str], Rollup] = {}
+    for (minute, model, tier), rollup in rollups:
+        for key, table in (
+            (model, per_model),
+            ((model, minute), per_minute),
+            ((model, tier), per_tier),
+        ):
+            table.setdefault(key, Rollup()).merge(rollup)
+    models = []
+    for model, total in sorted(per_model.items()):
+        minutes = [rollup for (name, _), rollup in per_minute.items() if name == model]
+        active = [rollup for rollup in minutes if rollup.images]
+        calls = sum(total.latency_counts)
+        try:
+            configured = project.image_backends.get_backend(
+                prisma.enums.AIModel(model)
+            ).concurrency
+        except Exception:
+            configured = None
+        models.append(
+            ModelCapacity(
+                ai_model=prisma.enums.AIModel(model),
+                images=total.images,
+                failures=total.failures,
+                error_rate=round(total.failures / ((total.images + total.failures) or 1), 4),
+                active_minutes=len(active),
+                sustained_images_per_minute=round(total.images / (len(active) or 1), 2),
+                peak_images_per_minute=max((rollup.images for rollup in minutes), default=0),
+                backend_p50_ms=total.backend_percentile(0.5),
+                backend_p95_ms=total.backend_percentile(0.95),
+                mean_backend_ms=_mean(total.backend_ms, calls),
+                mean_queue_wait_ms=_mean(total.queue_wait_ms, total.queued),
+                mean_postprocess_ms=_mean(total.postprocess_ms, total.images),
+                mean_image_bytes=_mean(total.image_bytes, total.images),
+                mean_concurrency=round(total.backend_ms / ((len(minutes) or 1) * 60000), 2),
+                peak_concurrency=round(
+                    max((rollup.backend_ms for rollup in minutes), default=0) / 60000, 2
+                ),
+                configured_concurrency=configured,
+                tiers=[
+                    TierCapacity(
+                        tier=tier,
+                        images=rollup.images,
+                        failures=rollup.failures,
+                        backend_p95_ms=rollup.backend_percentile(0.95),
+                    )
+                    for (name, tier), rollup in sorted(per_tier.items())
+                    if name == model
+                ],
+            )
+        )
+    return CapacityReport(window_minutes=window_minutes, source=source, models=models)
+
+
+class GenerationAccounting:
+    """
+    Rolling per-minute aggregates of generation cost for each model and plan, in memory.
+
+    Finished minutes are written as one AnalyticsEvent per model, plan and minute, so the
+    persisted history grows with the number of active minutes rather than of requests.
+    """
+
+    def __init__(self, window_minutes: int = GENERATION_ACCOUNTING_WINDOW_MINUTES) -> None:
+        self.window_minutes = window_minutes
+        self._rollups: Dict[RollupKey, Rollup] = {}
+        # Minutes before this one have been written.
+        self._persisted_before = int(time.time() // 60)
+
+    def record(
+        self,
+        ai_model: prisma.enums.AIModel,
+        tier: str,
+        timing: GenerationTiming,
+        failed: bool = False,
+    ) -> None:
+        minute = int(time.time() // 60)
+        key = (minute, prisma.enums.AIModel(ai_model).value, tier)
+        rollup = self._rollups.get(key)
+        if rollup is None:
+            rollup = self._rollups[key] = Rollup()
+            self._prune(minute)
+        rollup.add(timing, failed)
+
+    def _prune(self, minute: int) -> None:
+        oldest = minute - self.window_minutes
+        for key in [key for key in self._rollups if key[0] < oldest]:
+            del self._rollups[key]
+
+    def rollups(self, window_minutes: Optional[int] = None) -> List[Tuple[RollupKey, Rollup]]:
+        oldest = int(time.time() // 60) - (window_minutes or self.window_minutes)
+        return [(key, rollup) for key, rollup in self._rollups.items() if key[0] >= oldest]
+
+    def persist(self, include_current: bool = False) -> int:
+        """
+        Buffers the minutes not yet written as AnalyticsEvent rollups; the current minute only with include_current.
+
+        Returns:
+            int: The number of rollups buffered.
+        """
+        until = int(time.time() // 60) + (1 if include_current else 0)
+        written = 0
+        for (minute, model, tier), rollup in sorted(self._rollups.items()):
+            if self._persisted_before <= minute < until:
+                project.event_ingestion.record_analytics_event(
+                    ROLLUP_EVENT_TYPE,
+                    {"ai_model": model, "tier": tier, **rollup.to_dict()},
+                    occurred_at=datetime.fromtimestamp(minute * 60, timezone.utc),
+                )
+                written += 1
+        self._persisted_before = max(self._persisted_before, until)
+        return written
+
+
+generation_accounting = GenerationAccounting()
+
+_rollup_task: Optional[asyncio.Task] = None
+
+
+async def record_generation(
+    user_id: str,
+    ai_model: prisma.enums.AIModel,
+    timing: GenerationTiming,
+    failed: bool = False,
+) -> None:
+    """
+    Adds one generation to the aggregates of its model and of the user's plan.
+    """
+    try:
+        tier = (await project.rate_limiting.get_user_plan(user_id)).name
+    except Exception:
+        tier = "UNKNOWN"
+    generation_accounting.record(ai_model, tier, timing, failed)
+
+
+async def load_rollups(window_minutes: int) -> List[Tuple[RollupKey, Rollup]]:
+    """
+    Reads the persisted rollups of every worker for the last window_minutes.
+    """
+    since = datetime.fromtimestamp(
+        (int(time.time() // 60) - window_minutes) * 60, timezone.utc
+    )
+    events = await prisma.models.AnalyticsEvent.prisma().find_many(
+        where={"type": ROLLUP_EVENT_TYPE, "occurredAt": {"gte": since}}
+    )
+    rollups = []
+    for event in events:
+        metadata = event.metadata
+        if not isinstance(metadata, dict) or "ai_model" not in metadata:
+            continue
+        minute = int(event.occurredAt.timestamp() // 60)
+        rollups.append(
+            (
+                (minute, metadata["ai_model"], metadata.get("tier", "UNKNOWN")),
+                Rollup.from_dict(metadata),
+            )
+        )
+    return rollups
+
+
+async def get_capacity_report(
+    window_minutes: int = 60, source: CapacitySource = CapacitySource.CLUSTER
+) -> CapacityReport:
+    """
+    Reports sustained and peak throughput, latency and implied concurrency for each model.
+
+    Args:
+        window_minutes (int): How far back to look, at most GENERATION_ACCOUNTING_MAX_REPORT_MINUTES.
+        source (CapacitySource): "cluster" combines the rollups every worker has persisted, which lag by up
+            to GENERATION_ROLLUP_INTERVAL; "worker" reads this worker's in-memory aggregates,
+            which are current but cover at most GENERATION_ACCOUNTING_WINDOW_MINUTES.
+
+    Returns:
+        CapacityReport: One entry per model with generations in the window.
+    """
+    if not 1 <= window_minutes <= GENERATION_ACCOUNTING_MAX_REPORT_MINUTES:
+        raise ValueError(
+            f"window_minutes must be between 1 and {GENERATION_ACCOUNTING_MAX_REPORT_MINUTES}"
+        )
+    if source == CapacitySource.CLUSTER:
+        rollups = await load_rollups(window_minutes)
+    else:
+        rollups = generation_accounting.rollups(window_minutes)
+    return capacity_report(rollups, window_minutes, source)
+
+
+async def _persist_periodically() -> None:
+    while True:
+        await asyncio.sleep(GENERATION_ROLLUP_INTERVAL)
+        try:
+            generation_accounting.persist()
+        except Exception:
+            logger.exception("Failed to persist generation rollups")
+
+
+def start_generation_accounting() -> None:
+    global _rollup_task
+    if _rollup_task is None:
+        _rollup_task = asyncio.create_task(_persist_periodically())
+
+
+def stop_generation_accounting() -> None:
+    """
+    Stops the periodic rollups and buffers everything not yet written, including the current minute.
+    """
+    global _rollup_task
+    if _rollup_task is not None:
+        _rollup_task.cancel()
+        _rollup_task = None
+    generation_accounting.persist(include_current=True)
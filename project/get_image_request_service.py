@@ -0,0 +1,107 @@
+from datetime import datetime
+from typing import AsyncIterator, Optional
+
+import prisma
+import prisma.enums
+import prisma.models
+import project.image_events
+import project.image_storage
+from pydantic import BaseModel
+
+
+class ImageRequestStatusResponse(BaseModel):
+    """
+    The current state of an image request, used by clients polling a queued generation.
+    """
+
+    request_id: str
+    status: prisma.enums.ImageRequestStatus
+    image_url: Optional[str] = None
+    ai_model: prisma.enums.AIModel
+    text_description: str
+    createdAt: datetime
+    updatedAt: datetime
+
+
+async def get_image_request(id: str) -> ImageRequestStatusResponse:
+    """
+    Retrieves the status of an image request.
+
+    Args:
+        id (str): The unique identifier of the ImageRequest, as returned by POST /image/generate/.
+
+    Returns:
+        ImageRequestStatusResponse: The current state of the image request. image_url is only set once the status is COMPLETED.
+    """
+    image_request = await prisma.models.ImageRequest.prisma().find_unique(
+        where={"id": id}
+    )
+    if not image_request:
+        raise ValueError("Image request not found")
+    return ImageRequestStatusResponse(
+        request_id=image_request.id,
+        status=image_request.status,
+        image_url=image_request.imageUrl,
+        ai_model=image_request.AIModel,
+        text_description=image_request.textDescription,
+        createdAt=image_request.createdAt,
+        updatedAt=image_request.updatedAt,
+    )
+
+
+async def get_image_request_owner(id: str) -> Optional[str]:
+    """
+    Returns the id of the user who made an image request, or None if there is no such request.
+    """
+    image_request = await prisma.models.ImageRequest.prisma().find_unique(
+        where={"id": id}
+    )
+    return image_request.userId if image_request else None
+
+
+async def was_served_image(id: str, user_id: str) -> bool:
+    """
+    Whether one of a user's requests was answered with the image of request id.
+
+    Result cache and near-duplicate hits store the URL of an earlier, possibly another
+    user's, request as their imageUrl, so their owner must be able to fetch that file.
+    """
+    count = await prisma.models.ImageRequest.prisma().count(
+        where={"userId": user_id, "imageUrl": project.image_storage.image_file_url(id)}
+    )
+    return count > 0
+
+
+async def stream_image_request(
+    id: str, keepalive: float = 15.0
+) -> AsyncIterator[Optional[project.image_events.ImageEvent]]:
+    """
+    Streams the events of an image request until it is COMPLETED or FAILED.
+
+    The first event is the current state from the database. The subscription is opened
+    before that read, so no transition can slip in between. None is yielded whenever
+    keepalive seconds pass without an event, so the transport can send a heartbeat.
+
+    Args:
+        id (str): The unique identifier of the ImageRequest.
+        keepalive (float): Seconds between heartbeats.
+
+    Returns:
+        AsyncIterator[Optional[ImageEvent]]: Status transitions and preview frames.
+    """
+    async with project.image_events.image_event_hub.subscribe(id) as subscription:
+        current = await get_image_request(id)
+        event = project.image_events.ImageEvent(
+            request_id=current.request_id,
+            status=current.status,
+            image_url=current.image_url,
+            occurred_at=current.updatedAt,
+        )
+        yield event
+        if event.is_terminal:
+            return
+        while True:
+            event = await subscription.next(timeout=keepalive)
+            yield event
+            if event is not None and event.is_terminal:
+                return
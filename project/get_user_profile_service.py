@@ -3,6 +3,7 @@ from datetime import datetime
 import prisma
 import prisma.enums
 import prisma.models
+import project.profile_cache
 from pydantic import BaseModel
 
 
@@ -20,21 +21,12 @@ class UserProfileResponse(BaseModel):
     updatedAt: datetime
 
 
-async def get_user_profile(id: str) -> UserProfileResponse:
-    """
-    Retrieves a user's profile information based on the given user id.
-
-    Args:
-        id (str): The unique identifier of the user. This corresponds to the userId in the User and Profile database models.
+user_profile_cache = project.profile_cache.create_read_through_cache(
+    "user-profile", UserProfileResponse
+)
 
-    Returns:
-        UserProfileResponse: The response object containing user profile information. This is based on both the User and Profile models but potentially includes sanitized or selected data for privacy considerations.
 
-    Example:
-        id = 'some-uuid-here'
-        profile = await get_user_profile(id)
-        print(profile)
-    """
+async def _load_user_profile(id: str) -> UserProfileResponse:
     user = await prisma.models.User.prisma().find_unique(
         where={"id": id}, include={"profiles": True}
     )
@@ -51,3 +43,24 @@ async def get_user_profile(id: str) -> UserProfileResponse:
         updatedAt=user.updatedAt,
     )
     return response
+
+
+async def get_user_profile(id: str) -> UserProfileResponse:
+    """
+    Retrieves a user's profile information based on the given user id.
+
+    Profiles are served from a read-through cache keyed by user id; update_user_profile and
+    delete_user_account invalidate it.
+
+    Args:
+        id (str): The unique identifier of the user. This corresponds to the userId in the User and Profile database models.
+
+    Returns:
+        UserProfileResponse: The response object containing user profile information. This is based on both the User and Profile models but potentially includes sanitized or selected data for privacy considerations.
+
+    Example:
+        id = 'some-uuid-here'
+        profile = await get_user_profile(id)
+        print(profile)
+    """
+    return await user_profile_cache.get(id, lambda: _load_user_profile(id))
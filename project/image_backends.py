@@ -0,0 +1,667 @@
+import asyncio
+import base64
+import hashlib
+import logging
+import os
+import random
+import struct
+import time
+import zlib
+from abc import ABC, abstractmethod
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+
+import httpx
+import prisma
+import prisma.enums
+import project.metrics
+from pydantic import BaseModel
+
+logger = logging.getLogger(__name__)
+
+# "stub" renders every model locally; "remote" calls the real providers.
+IMAGE_BACKEND_MODE = os.environ.get("IMAGE_BACKEND_MODE", "stub")
+# Models tried in order when a caller allows substitution, e.g. "STABLEDIFFUSION:DALLE2|IMAGEN,MIDJOURNEY:STABLEDIFFUSION".
+IMAGE_BACKEND_FAILOVER = os.environ.get("IMAGE_BACKEND_FAILOVER", "")
+
+
+class GeneratedImage(BaseModel):
+    """
+    The output of a backend call. Providers either host the image themselves (url) or return the encoded bytes (data).
+    """
+
+    content_type: str = "image/png"
+    url: Optional[str] = None
+    data: Optional[bytes] = None
+
+
+PreviewCallback = Callable[[GeneratedImage], Awaitable[None]]
+
+
+class ImageBackendError(Exception):
+    """
+    Raised when a backend cannot produce an image within its timeout and retry budget.
+    """
+
+
+class BackendUnavailable(ImageBackendError):
+    """
+    Raised without calling the provider while the backend's circuit breaker is open.
+    """
+
+
+def _model_name(ai_model: prisma.enums.AIModel) -> str:
+    return getattr(ai_model, "value", str(ai_model))
+
+
+def build_prompt(text_description: str, theme: Optional[str], style: Optional[str]) -> str:
+    """
+    Folds the optional theme and style preferences into the prompt sent to the model.
+    """
+    parts = [text_description]
+    if theme:
+        parts.append(f"theme: {theme}")
+    if style:
+        parts.append(f"style: {style}")
+    return ", ".join(parts)
+
+
+def _setting(ai_model: prisma.enums.AIModel, name: str, default: str) -> str:
+    return os.environ.get(
+        f"IMAGE_BACKEND_{prisma.enums.AIModel(ai_model).value}_{name}", default
+    )
+
+
+def _optional_float(value: str) -> Optional[float]:
+    return float(value) if value else None
+
+
+class CircuitBreaker:
+    """
+    Tracks the outcome and latency of recent provider calls and stops sending calls to a failing provider.
+
+    The breaker opens when, over the last window seconds and at least min_calls calls,
+    the share of failed calls reaches error_rate or the share of calls slower than
+    slow_call_seconds reaches slow_call_rate. While open, calls are refused. After
+    open_seconds a single trial call is let through (half-open): if it succeeds quickly
+    the breaker closes, otherwise it opens again.
+    """
+
+    CLOSED = "closed"
+    HALF_OPEN = "half_open"
+    OPEN = "open"
+
+    def __init__(
+        self,
+        name: str = "",
+        window: float = 60.0,
+        min_calls: int = 20,
+        error_rate: float = 0.5,
+        slow_call_seconds: Optional[float] = None,
+        slow_call_rate: float = 0.8,
+        open_seconds: float = 30.0,
+        max_samples: int = 1000,
+    ) -> None:
+        self.name = name
+        self.window = window
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.slow_call_rate = slow_call_rate
+        self.open_seconds = open_seconds
+        self.max_samples = max_samples
+        self.state = self.CLOSED
+        self.opened_at = 0.0
+        self.times_opened = 0
+        self._trial_in_flight = False
+        # (finished at, succeeded, slow, latency)
+        self._samples: Deque[Tuple[float, bool, bool, float]] = deque()
+        self._failures = 0
+        self._slow = 0
+        self._percentiles: Dict[float, Tuple[float, Optional[float]]] = {}
+
+    def _trim(self, now: float) -> None:
+        samples = self._samples
+        while samples and (
+            samples[0][0] < now - self.window or len(samples) > self.max_samples
+        ):
+            _, ok, slow, _ = samples.popleft()
+            self._failures -= not ok
+            self._slow -= slow
+
+    def _open(self, now: float) -> None:
+        self.state = self.OPEN
+        self.opened_at = now
+        self.times_opened += 1
+        self._trial_in_flight = False
+
+    def allow_request(self) -> bool:
+        """
+        Returns whether a call may be made now. In the half-open state only one trial call is allowed at a time.
+        """
+        if self.state == self.OPEN:
+            if time.monotonic() - self.opened_at < self.open_seconds:
+                return False
+            self.state = self.HALF_OPEN
+        if self.state == self.HALF_OPEN:
+            if self._trial_in_flight:
+                return False
+            self._trial_in_flight = True
+        return True
+
+    def record(self, ok: bool, latency: float) -> None:
+        """
+        Records the outcome of a provider call and opens or closes the breaker accordingly.
+        """
+        now = time.monotonic()
+        slow = self.slow_call_seconds is not None and latency >= self.slow_call_seconds
+        if self.state == self.HALF_OPEN:
+            if ok and not slow:
+                self.state = self.CLOSED
+                self._trial_in_flight = False
+                self._samples.clear()
+                self._failures = self._slow = 0
+            else:
+                self._open(now)
+            return
+        self._samples.append((now, ok, slow, latency))
+        self._failures += not ok
+        self._slow += slow
+        self._trim(now)
+        calls = len(self._samples)
+        if self.state == self.CLOSED and calls >= self.min_calls and (
+            self._failures / calls >= self.error_rate
+            or self._slow / calls >= self.slow_call_rate
+        ):
+            self._open(now)
+            logger.warning(
+                "Circuit breaker of %s opened after %d failed and %d slow of %d calls",
+                self.name,
+                self._failures,
+                self._slow,
+                calls,
+            )
+
+    def abandon(self) -> None:
+        """
+        Forgets a call that was cancelled before it finished, freeing the half-open trial slot.
+        """
+        if self.state == self.HALF_OPEN:
+            self._trial_in_flight = False
+
+    def latency_percentile(self, percentile: float) -> Optional[float]:
+        """
+        Returns the given percentile of successful call latencies in the window, or None with fewer than min_calls samples.
+
+        The value is recomputed at most once a second.
+        """
+        now = time.monotonic()
+        cached = self._percentiles.get(percentile)
+        if cached is not None and cached[0] > now:
+            return cached[1]
+        self._trim(now)
+        latencies = sorted(latency for _, ok, _, latency in self._samples if ok)
+        value = None
+        if len(latencies) >= self.min_calls:
+            value = latencies[min(len(latencies) - 1, int(len(latencies) * percentile / 100))]
+        self._percentiles[percentile] = (now + 1.0, value)
+        return value
+
+    def state_code(self) -> int:
+        """
+        Returns 0 when closed, 1 when half-open and 2 when open, for the state gauge.
+        """
+        return {self.CLOSED: 0, self.HALF_OPEN: 1, self.OPEN: 2}[self.state]
+
+
+class ImageBackend(ABC):
+    """
+    Base class for the adapter behind one AIModel value.
+
+    Every backend owns a semaphore, so a slow provider can only tie up its own share of
+    in-flight generations, and retries failed calls within a fixed budget. A circuit
+    breaker refuses calls outright while the provider is failing, and with
+    hedge_percentile set a second attempt is started when the first one takes longer
+    than that percentile of recent latencies.
+    """
+
+    def __init__(
+        self,
+        ai_model: prisma.enums.AIModel,
+        concurrency: int = 8,
+        timeout: float = 60.0,
+        retries: int = 2,
+        retry_backoff: float = 0.5,
+        breaker: Optional[CircuitBreaker] = None,
+        hedge_percentile: Optional[float] = None,
+    ) -> None:
+        self.ai_model = ai_model
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self.breaker = breaker or CircuitBreaker(_model_name(ai_model))
+        self.hedge_percentile = hedge_percentile
+        self._semaphore = asyncio.Semaphore(concurrency)
+
+    @classmethod
+    def from_env(cls, ai_model: prisma.enums.AIModel, **kwargs) -> "ImageBackend":
+        """
+        Builds the backend with limits read from IMAGE_BACKEND_<MODEL>_CONCURRENCY, _TIMEOUT,
+        _RETRIES, _BREAKER_{WINDOW,MIN_CALLS,ERROR_RATE,SLOW_CALL_SECONDS,OPEN_SECONDS} and _HEDGE_PERCENTILE.
+        """
+        return cls(
+            ai_model,
+            concurrency=int(_setting(ai_model, "CONCURRENCY", "8")),
+            timeout=float(_setting(ai_model, "TIMEOUT", "60")),
+            retries=int(_setting(ai_model, "RETRIES", "2")),
+            breaker=CircuitBreaker(
+                _model_name(ai_model),
+                window=float(_setting(ai_model, "BREAKER_WINDOW", "60")),
+                min_calls=int(_setting(ai_model, "BREAKER_MIN_CALLS", "20")),
+                error_rate=float(_setting(ai_model, "BREAKER_ERROR_RATE", "0.5")),
+                slow_call_seconds=_optional_float(
+                    _setting(ai_model, "BREAKER_SLOW_CALL_SECONDS", "")
+                ),
+                open_seconds=float(_setting(ai_model, "BREAKER_OPEN_SECONDS", "30")),
+            ),
+            hedge_percentile=_optional_float(_setting(ai_model, "HEDGE_PERCENTILE", "")),
+            **kwargs,
+        )
+
+    def in_flight(self) -> int:
+        """
+        Returns the number of generations currently holding a concurrency slot.
+        """
+        return self.concurrency - self._semaphore._value
+
+    async def generate(
+        self,
+        text_description: str,
+        theme: Optional[str],
+        style: Optional[str],
+        on_preview: Optional[PreviewCallback] = None,
+    ) -> GeneratedImage:
+        """
+        Generates one image, waiting for a free concurrency slot first.
+
+        Backends that can produce intermediate frames pass them to on_preview. When hedging
+        is enabled and the first attempt is slower than hedge_percentile of recent calls, a
+        second attempt is started if a concurrency slot is free, and whichever succeeds first wins.
+
+        Raises:
+            BackendUnavailable: If the circuit breaker is open.
+            ImageBackendError: If every attempt failed or timed out.
+        """
+        if not self.breaker.allow_request():
+            raise BackendUnavailable(f"{self.ai_model} is unavailable: circuit breaker open")
+        prompt = build_prompt(text_description, theme, style)
+        hedge_delay = (
+            self.breaker.latency_percentile(self.hedge_percentile)
+            if self.hedge_percentile is not None and self.breaker.state == CircuitBreaker.CLOSED
+            else None
+        )
+        if hedge_delay is None:
+            return await self._generate_with_retries(prompt, on_preview)
+        attempts = [asyncio.create_task(self._generate_with_retries(prompt, on_preview))]
+        try:
+            done, pending = await asyncio.wait(attempts, timeout=hedge_delay)
+            if done or self.in_flight() >= self.concurrency:
+                return await attempts[0]
+            project.metrics.image_backend_hedges.inc(ai_model=_model_name(self.ai_model))
+            attempts.append(asyncio.create_task(self._generate_with_retries(prompt, None)))
+            pending = set(attempts)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for attempt in done:
+                    if attempt.exception() is None:
+                        return attempt.result()
+            return await attempts[0]
+        finally:
+            for attempt in attempts:
+                attempt.cancel()
+
+    async def _generate_with_retries(
+        self, prompt: str, on_preview: Optional[PreviewCallback]
+    ) -> GeneratedImage:
+        started = time.perf_counter()
+        outcome = "error"
+        try:
+            async with self._semaphore:
+                for attempt in range(self.retries + 1):
+                    call_started = time.perf_counter()
+                    try:
+                        image = await asyncio.wait_for(
+                            self._generate_with_previews(prompt, on_preview), self.timeout
+                        )
+                    except Exception as e:
+                        # Malformed responses (bad JSON, missing keys, invalid base64) count
+                        # as failures too; otherwise a failed half-open trial would keep its slot.
+                        self.breaker.record(False, time.perf_counter() - call_started)
+                        # Retrying is pointless once the breaker has opened.
+                        if attempt == self.retries or self.breaker.state != CircuitBreaker.CLOSED:
+                            raise ImageBackendError(
+                                f"{self.ai_model} failed after {attempt + 1} attempts: {e!r}"
+                            ) from e
+                        logger.warning(
+                            "%s attempt %d failed: %r", self.ai_model, attempt + 1, e
+                        )
+                        await asyncio.sleep(self.retry_backoff * 2**attempt)
+                        continue
+                    self.breaker.record(True, time.perf_counter() - call_started)
+                    outcome = "ok"
+                    return image
+            raise AssertionError("unreachable")
+        except asyncio.CancelledError:
+            outcome = "cancelled"
+            self.breaker.abandon()
+            raise
+        finally:
+            project.metrics.image_backend_seconds.observe(
+                time.perf_counter() - started,
+                ai_model=_model_name(self.ai_model),
+                outcome=outcome,
+            )
+
+    @abstractmethod
+    async def _generate(self, prompt: str) -> GeneratedImage:
+        """
+        Performs a single provider call.
+        """
+
+    async def _generate_with_previews(
+        self, prompt: str, on_preview: Optional[PreviewCallback]
+    ) -> GeneratedImage:
+        """
+        Performs a single provider call, reporting intermediate frames if the provider has any.
+        """
+        return await self._generate(prompt)
+
+    async def aclose(self) -> None:
+        """
+        Releases any pooled connections.
+        """
+
+
+class HttpImageBackend(ImageBackend):
+    """
+    A backend that talks to a remote provider over a pooled, keep-alive HTTP client.
+    """
+
+    default_url: str = ""
+
+    def __init__(self, ai_model: prisma.enums.AIModel, **kwargs) -> None:
+        super().__init__(ai_model, **kwargs)
+        self.url = _setting(ai_model, "URL", self.default_url)
+        api_key = _setting(ai_model, "API_KEY", "")
+        self.client = httpx.AsyncClient(
+            headers={"Authorization": f"Bearer {api_key}"} if api_key else {},
+            limits=httpx.Limits(
+                max_connections=self.concurrency,
+                max_keepalive_connections=self.concurrency,
+            ),
+            timeout=self.timeout,
+        )
+
+    async def aclose(self) -> None:
+        await self.client.aclose()
+
+
+class DallE2Backend(HttpImageBackend):
+    default_url = "https://api.openai.com/v1/images/generations"
+
+    async def _generate(self, prompt: str) -> GeneratedImage:
+        response = await self.client.post(
+            self.url,
+            json={"model": "dall-e-2", "prompt": prompt, "n": 1, "size": "512x512"},
+        )
+        response.raise_for_status()
+        return GeneratedImage(url=response.json()["data"][0]["url"])
+
+
+class ImagenBackend(HttpImageBackend):
+    # Vertex AI predict endpoint; set IMAGE_BACKEND_IMAGEN_URL to the project/location specific URL.
+    default_url = "https://us-central1-aiplatform.googleapis.com/v1/publishers/google/models/imagegeneration:predict"
+
+    async def _generate(self, prompt: str) -> GeneratedImage:
+        response = await self.client.post(
+            self.url,
+            json={"instances": [{"prompt": prompt}], "parameters": {"sampleCount": 1}},
+        )
+        response.raise_for_status()
+        prediction = response.json()["predictions"][0]
+        return GeneratedImage(
+            content_type=prediction.get("mimeType", "image/png"),
+            data=base64.b64decode(prediction["bytesBase64Encoded"]),
+        )
+
+
+class MidjourneyBackend(HttpImageBackend):
+    # Midjourney has no public API; this expects a proxy that answers {"image_url": ...}.
+    default_url = "http://localhost:8081/imagine"
+
+    async def _generate(self, prompt: str) -> GeneratedImage:
+        response = await self.client.post(self.url, json={"prompt": prompt})
+        response.raise_for_status()
+        return GeneratedImage(url=response.json()["image_url"])
+
+
+class StableDiffusionBackend(HttpImageBackend):
+    default_url = "https://api.stability.ai/v1/generation/stable-diffusion-xl-1024-v1-0/text-to-image"
+
+    async def _generate(self, prompt: str) -> GeneratedImage:
+        response = await self.client.post(
+            self.url,
+            json={"text_prompts": [{"text": prompt}], "samples": 1},
+            headers={"Accept": "image/png"},
+        )
+        response.raise_for_status()
+        return GeneratedImage(content_type="image/png", data=response.content)
+
+
+def encode_png(width: int, height: int, rows: bytes) -> bytes:
+    """
+    Encodes raw 8-bit RGB rows (without filter bytes) as a PNG.
+    """
+
+    def chunk(tag: bytes, payload: bytes) -> bytes:
+        return (
+            struct.pack(">I", len(payload))
+            + tag
+            + payload
+            + struct.pack(">I", zlib.crc32(tag + payload) & 0xFFFFFFFF)
+        )
+
+    stride = width * 3
+    raw = b"".join(
+        b"\x00" + rows[y * stride : (y + 1) * stride] for y in range(height)
+    )
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+        + chunk(b"IDAT", zlib.compress(raw, 6))
+        + chunk(b"IEND", b"")
+    )
+
+
+def render_stub_png(prompt: str, size: int) -> bytes:
+    """
+    Renders a deterministic gradient PNG seeded by the prompt, so identical prompts give identical bytes.
+    """
+    seed = hashlib.sha256(prompt.encode("utf-8")).digest()
+    r0, g0, b0, dr, dg, db = seed[:6]
+    pixels = bytearray(size * size * 3)
+    i = 0
+    for y in range(size):
+        for x in range(size):
+            pixels[i] = (r0 + x * dr // size) & 0xFF
+            pixels[i + 1] = (g0 + y * dg // size) & 0xFF
+            pixels[i + 2] = (b0 + (x ^ y) * db // size) & 0xFF
+            i += 3
+    return encode_png(size, size, bytes(pixels))
+
+
+class StubImageBackend(ImageBackend):
+    """
+    Renders PNGs locally on the CPU after a configurable delay, for load tests that must not touch the network.
+
+    Faults can be injected to exercise the circuit breaker, hedging and failover: a
+    failure_rate share of calls fails with a connection error, and a slow_rate share takes
+    slow_latency instead of latency.
+    """
+
+    def __init__(
+        self,
+        ai_model: prisma.enums.AIModel,
+        latency: Optional[float] = None,
+        size: Optional[int] = None,
+        failure_rate: Optional[float] = None,
+        slow_rate: Optional[float] = None,
+        slow_latency: Optional[float] = None,
+        **kwargs,
+    ) -> None:
+        super().__init__(ai_model, **kwargs)
+        self.latency = (
+            latency
+            if latency is not None
+            else float(_setting(ai_model, "STUB_LATENCY", "0.05"))
+        )
+        self.size = size if size is not None else int(_setting(ai_model, "STUB_SIZE", "128"))
+        self.failure_rate = (
+            failure_rate
+            if failure_rate is not None
+            else float(_setting(ai_model, "STUB_FAILURE_RATE", "0"))
+        )
+        self.slow_rate = (
+            slow_rate if slow_rate is not None else float(_setting(ai_model, "STUB_SLOW_RATE", "0"))
+        )
+        self.slow_latency = (
+            slow_latency
+            if slow_latency is not None
+            else float(_setting(ai_model, "STUB_SLOW_LATENCY", "5"))
+        )
+
+    def _call_latency(self) -> float:
+        """
+        Returns the delay of the next call, which is slow_latency for a slow_rate share of calls.
+        """
+        if self.slow_rate and random.random() < self.slow_rate:
+            return self.slow_latency
+        return self.latency
+
+    async def _inject_failure(self) -> None:
+        if self.failure_rate and random.random() < self.failure_rate:
+            await asyncio.sleep(self.latency)
+            raise httpx.ConnectError(f"Injected failure of the {self.ai_model} stub")
+
+    async def _generate(self, prompt: str) -> GeneratedImage:
+        await self._inject_failure()
+        await asyncio.sleep(self._call_latency())
+        data = await asyncio.to_thread(render_stub_png, prompt, self.size)
+        return GeneratedImage(content_type="image/png", data=data)
+
+    async def _generate_with_previews(
+        self, prompt: str, on_preview: Optional[PreviewCallback]
+    ) -> GeneratedImage:
+        if on_preview is None:
+            return await self._generate(prompt)
+        await self._inject_failure()
+        latency = self._call_latency()
+        # Emit a coarse frame halfway through, like a diffusion model's intermediate step.
+        await asyncio.sleep(latency / 2)
+        preview = await asyncio.to_thread(render_stub_png, prompt, max(self.size // 8, 1))
+        await on_preview(GeneratedImage(content_type="image/png", data=preview))
+        await asyncio.sleep(latency / 2)
+        data = await asyncio.to_thread(render_stub_png, prompt, self.size)
+        return GeneratedImage(content_type="image/png", data=data)
+
+
+REMOTE_BACKENDS: Dict[prisma.enums.AIModel, type] = {
+    prisma.enums.AIModel.DALLE2: DallE2Backend,
+    prisma.enums.AIModel.IMAGEN: ImagenBackend,
+    prisma.enums.AIModel.MIDJOURNEY: MidjourneyBackend,
+    prisma.enums.AIModel.STABLEDIFFUSION: StableDiffusionBackend,
+}
+
+_backends: Dict[prisma.enums.AIModel, ImageBackend] = {}
+_added_models: List[prisma.enums.AIModel] = []
+# Bumped on every registration, including a backend replacing the one of its model, so
+# derived data such as the model catalogue can be rebuilt lazily.
+backends_version = 0
+
+
+def register_backend(backend: ImageBackend) -> None:
+    """
+    Installs a backend for its AIModel, replacing any previous one.
+    """
+    global backends_version
+    _backends[backend.ai_model] = backend
+    project.metrics.image_backend_in_flight.set_function(
+        backend.in_flight, ai_model=_model_name(backend.ai_model)
+    )
+    project.metrics.image_backend_circuit_state.set_function(
+        backend.breaker.state_code, ai_model=_model_name(backend.ai_model)
+    )
+    ai_model = backend.ai_model
+    if ai_model not in REMOTE_BACKENDS and ai_model not in _added_models:
+        _added_models.append(backend.ai_model)
+    backends_version += 1
+
+
+def available_ai_models() -> List[prisma.enums.AIModel]:
+    """
+    Returns every AIModel that has a backend, in a stable order.
+    """
+    return list(REMOTE_BACKENDS) + _added_models
+
+
+def get_backend(ai_model: prisma.enums.AIModel) -> ImageBackend:
+    """
+    Returns the backend registered for the given AIModel, building the default one on first use.
+    """
+    ai_model = prisma.enums.AIModel(ai_model)
+    backend = _backends.get(ai_model)
+    if backend is None:
+        backend_class = (
+            StubImageBackend if IMAGE_BACKEND_MODE == "stub" else REMOTE_BACKENDS[ai_model]
+        )
+        backend = backend_class.from_env(ai_model)
+        register_backend(backend)
+    return backend
+
+
+def parse_failover_policy(spec: str) -> Dict[prisma.enums.AIModel, List[prisma.enums.AIModel]]:
+    """
+    Parses "MODEL:SUBSTITUTE|SUBSTITUTE,MODEL:SUBSTITUTE" into the substitutes of each model, in order.
+    """
+    policy: Dict[prisma.enums.AIModel, List[prisma.enums.AIModel]] = {}
+    for entry in filter(None, (part.strip() for part in spec.split(","))):
+        model, _, substitutes = entry.partition(":")
+        policy[prisma.enums.AIModel(model.strip())] = [
+            prisma.enums.AIModel(substitute.strip())
+            for substitute in substitutes.split("|")
+            if substitute.strip()
+        ]
+    return policy
+
+
+FAILOVER_POLICY = parse_failover_policy(IMAGE_BACKEND_FAILOVER)
+
+
+def failover_chain(ai_model: prisma.enums.AIModel) -> List[prisma.enums.AIModel]:
+    """
+    Returns the requested model followed by the substitutes IMAGE_BACKEND_FAILOVER allows for it.
+    """
+    ai_model = prisma.enums.AIModel(ai_model)
+    return [ai_model] + [
+        substitute for substitute in FAILOVER_POLICY.get(ai_model, []) if substitute != ai_model
+    ]
+
+
+async def close_backends() -> None:
+    """
+    Closes every registered backend's connection pool.
+    """
+    for backend in list(_backends.values()):
+        await backend.aclose()
+    _backends.clear()
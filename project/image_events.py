@@ -0,0 +1,177 @@
+import asyncio
+import logging
+import os
+from datetime import datetime
+from typing import Dict, Optional, Set
+
+import prisma
+import prisma.enums
+from pydantic import BaseModel
+
+logger = logging.getLogger(__name__)
+
+# "none" delivers events only inside this process; "postgres" fans them out with LISTEN/NOTIFY
+# so a stream can be served by any worker.
+IMAGE_EVENTS_FANOUT = os.environ.get("IMAGE_EVENTS_FANOUT", "none")
+IMAGE_EVENTS_CHANNEL = "image_request_events"
+IMAGE_EVENTS_SUBSCRIBER_QUEUE_SIZE = 64
+
+TERMINAL_STATUSES = {
+    prisma.enums.ImageRequestStatus.COMPLETED,
+    prisma.enums.ImageRequestStatus.FAILED,
+}
+
+
+class ImageEvent(BaseModel):
+    """
+    A status transition or preview frame of an image request.
+    """
+
+    request_id: str
+    status: prisma.enums.ImageRequestStatus
+    image_url: Optional[str] = None
+    preview_url: Optional[str] = None
+    occurred_at: datetime
+
+    @property
+    def is_terminal(self) -> bool:
+        return self.status in TERMINAL_STATUSES
+
+
+class ImageEventSubscription:
+    """
+    The events of one request, buffered for one consumer. Use as an async context manager.
+    """
+
+    def __init__(self, hub: "ImageEventHub", request_id: str) -> None:
+        self.hub = hub
+        self.request_id = request_id
+        self.queue: asyncio.Queue[ImageEvent] = asyncio.Queue(
+            maxsize=IMAGE_EVENTS_SUBSCRIBER_QUEUE_SIZE
+        )
+
+    async def __aenter__(self) -> "ImageEventSubscription":
+        self.hub._subscribers.setdefault(self.request_id, set()).add(self)
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        subscribers = self.hub._subscribers.get(self.request_id)
+        if subscribers is not None:
+            subscribers.discard(self)
+            if not subscribers:
+                del self.hub._subscribers[self.request_id]
+
+    async def next(self, timeout: Optional[float] = None) -> Optional[ImageEvent]:
+        """
+        Waits for the next event; returns None if none arrives within timeout.
+        """
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    def _offer(self, event: ImageEvent) -> None:
+        if self.queue.full():
+            # A slow consumer only loses intermediate events; make room for the newest one.
+            self.queue.get_nowait()
+        self.queue.put_nowait(event)
+
+
+class ImageEventHub:
+    """
+    In-process pub/sub of image request events keyed by request id, with optional
+    Postgres LISTEN/NOTIFY fan-out between workers.
+    """
+
+    def __init__(self, fanout: str = IMAGE_EVENTS_FANOUT) -> None:
+        self.fanout = fanout
+        self.published = 0
+        self._subscribers: Dict[str, Set[ImageEventSubscription]] = {}
+        self._listener = None
+
+    def subscribe(self, request_id: str) -> ImageEventSubscription:
+        return ImageEventSubscription(self, request_id)
+
+    def subscriber_count(self) -> int:
+        return sum(len(subscribers) for subscribers in self._subscribers.values())
+
+    def _deliver(self, event: ImageEvent) -> None:
+        for subscription in list(self._subscribers.get(event.request_id, ())):
+            subscription._offer(event)
+
+    async def publish(self, event: ImageEvent) -> None:
+        """
+        Delivers an event to local subscribers and, with Postgres fan-out, to every other worker.
+        """
+        self.published += 1
+        if self.fanout != "postgres":
+            self._deliver(event)
+            return
+        # Preview frames can exceed the 8000-byte NOTIFY payload limit, so they stay local.
+        if event.preview_url is not None:
+            self._deliver(event)
+            return
+        try:
+            await prisma.get_client().execute_raw(
+                "SELECT pg_notify($1, $2)", IMAGE_EVENTS_CHANNEL, event.model_dump_json()
+            )
+        except Exception:
+            logger.exception("Could not fan out image event; delivering locally only")
+            self._deliver(event)
+
+    def _on_notification(self, connection, pid, channel, payload: str) -> None:
+        try:
+            self._deliver(ImageEvent.model_validate_json(payload))
+        except ValueError:
+            logger.warning("Ignoring malformed image event notification")
+
+    async def start(self) -> None:
+        """
+        Starts listening for notifications from other workers when Postgres fan-out is enabled.
+        Requires the `asyncpg` package, which is not installed by default.
+        """
+        if self.fanout != "postgres" or self._listener is not None:
+            return
+        try:
+            import asyncpg
+        except ImportError as e:
+            raise RuntimeError(
+                "IMAGE_EVENTS_FANOUT=postgres requires the 'asyncpg' package"
+            ) from e
+
+        self._listener = await asyncpg.connect(os.environ["DATABASE_URL"])
+        await self._listener.add_listener(IMAGE_EVENTS_CHANNEL, self._on_notification)
+
+    async def stop(self) -> None:
+        if self._listener is not None:
+            await self._listener.close()
+            self._listener = None
+
+
+image_event_hub = ImageEventHub()
+
+
+async def publish_status(
+    request_id: str,
+    status: prisma.enums.ImageRequestStatus,
+    image_url: Optional[str] = None,
+) -> None:
+    await image_event_hub.publish(
+        ImageEvent(
+            request_id=request_id,
+            status=status,
+            image_url=image_url,
+            occurred_at=datetime.now(),
+        )
+    )
+
+
+async def publish_preview(request_id: str, preview_url: str) -> None:
+    await image_event_hub.publish(
+        ImageEvent(
+            request_id=request_id,
+            status=prisma.enums.ImageRequestStatus.PROCESSING,
+            preview_url=preview_url,
+            occurred_at=datetime.now(),
+        )
+    )
@@ -0,0 +1,317 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+from abc import ABC, abstractmethod
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+import prisma
+import prisma.enums
+import project.image_events
+import project.metrics
+
+logger = logging.getLogger(__name__)
+
+IMAGE_QUEUE_BACKEND = os.environ.get("IMAGE_QUEUE_BACKEND", "local")
+IMAGE_QUEUE_WORKERS = int(os.environ.get("IMAGE_QUEUE_WORKERS", "4"))
+IMAGE_QUEUE_POLL_INTERVAL = float(os.environ.get("IMAGE_QUEUE_POLL_INTERVAL", "1.0"))
+# A claimed request still PROCESSING after this long is assumed to have lost its worker.
+IMAGE_REQUEST_LEASE_SECONDS = float(os.environ.get("IMAGE_REQUEST_LEASE_SECONDS", "900"))
+# Times an expired request is put back on the queue before it is marked FAILED.
+IMAGE_REQUEST_MAX_REQUEUES = int(os.environ.get("IMAGE_REQUEST_MAX_REQUEUES", "2"))
+IMAGE_REQUEST_REAP_INTERVAL = float(os.environ.get("IMAGE_REQUEST_REAP_INTERVAL", "60"))
+
+
+class ImageJobQueue(ABC):
+    """
+    A queue of ImageRequest ids waiting to be processed by the worker pool.
+    """
+
+    @abstractmethod
+    async def submit(
+        self, request_id: str, owner: Optional[str] = None, weight: float = 1.0
+    ) -> None:
+        """
+        Makes a freshly inserted PROCESSING ImageRequest available to the workers.
+
+        owner and weight are scheduling hints: queues that support them share the workers
+        between owners in proportion to their weights.
+        """
+
+    @abstractmethod
+    async def claim(self) -> str:
+        """
+        Waits until a request is available and returns its id. Each id is handed to exactly one worker.
+        """
+
+    @abstractmethod
+    def depth(self) -> int:
+        """
+        Returns the number of requests known to be waiting in this process.
+        """
+
+
+class LocalImageJobQueue(ImageJobQueue):
+    """
+    An in-process queue with weighted fair scheduling between owners. Jobs are lost if the
+    process dies before they are claimed.
+
+    Each job gets a virtual finish time of max(virtual clock, owner's last finish) + 1/weight
+    and jobs are claimed in finish-time order. An owner with weight 4 is therefore served four
+    times as often as one with weight 1 while both have work queued, and a user with a
+    thousand queued jobs only delays a newcomer by one job per worker.
+    """
+
+    def __init__(self) -> None:
+        self._heap: List[Tuple[float, int, str]] = []
+        self._finish: Dict[str, float] = {}
+        self._virtual_time = 0.0
+        self._sequence = itertools.count()
+        self._ready = asyncio.Semaphore(0)
+
+    async def submit(
+        self, request_id: str, owner: Optional[str] = None, weight: float = 1.0
+    ) -> None:
+        # Jobs without an owner are a flow of their own.
+        flow = owner if owner is not None else request_id
+        finish = max(self._virtual_time, self._finish.get(flow, 0.0)) + 1.0 / weight
+        self._finish[flow] = finish
+        heapq.heappush(self._heap, (finish, next(self._sequence), request_id))
+        self._ready.release()
+
+    async def claim(self) -> str:
+        await self._ready.acquire()
+        finish, _, request_id = heapq.heappop(self._heap)
+        self._virtual_time = max(self._virtual_time, finish)
+        if len(self._finish) > 2 * len(self._heap) + 1000:
+            # Owners whose last job is behind the clock would start from it anyway.
+            self._finish = {
+                flow: last
+                for flow, last in self._finish.items()
+                if last > self._virtual_time
+            }
+        return request_id
+
+    def depth(self) -> int:
+        return len(self._heap)
+
+
+class PostgresImageJobQueue(ImageJobQueue):
+    """
+    Uses the ImageRequest table itself as the queue, so any worker process connected to the
+    same database can pick up a request. Rows are claimed with SELECT ... FOR UPDATE SKIP LOCKED
+    and stamped with claimedAt, which keeps the claiming transaction short.
+
+    Claims are in creation order; owner and weight are ignored.
+    """
+
+    CLAIM_QUERY = """
+        UPDATE "ImageRequest" SET "claimedAt" = NOW()
+        WHERE "id" = (
+            SELECT "id" FROM "ImageRequest"
+            WHERE "status" = 'PROCESSING' AND "claimedAt" IS NULL
+            ORDER BY "createdAt"
+            LIMIT 1
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING "id"
+    """
+
+    def __init__(self, poll_interval: float = IMAGE_QUEUE_POLL_INTERVAL) -> None:
+        self.poll_interval = poll_interval
+        self._wakeup = asyncio.Event()
+        self._pending = 0
+
+    async def submit(
+        self, request_id: str, owner: Optional[str] = None, weight: float = 1.0
+    ) -> None:
+        # The row is already in the table; only wake up a local worker so it does not
+        # have to wait for the next poll.
+        self._pending += 1
+        self._wakeup.set()
+
+    async def claim(self) -> str:
+        while True:
+            row = await prisma.get_client().query_first(self.CLAIM_QUERY)
+            if row:
+                self._pending = max(self._pending - 1, 0)
+                return row["id"]
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def depth(self) -> int:
+        return self._pending
+
+
+class ImageWorkerPool:
+    """
+    A fixed number of asyncio tasks that claim request ids from a queue and run the handler on them.
+    """
+
+    def __init__(
+        self,
+        queue: ImageJobQueue,
+        handler: Callable[[str], Awaitable[None]],
+        concurrency: int = IMAGE_QUEUE_WORKERS,
+    ) -> None:
+        self.queue = queue
+        self.handler = handler
+        self.concurrency = concurrency
+        self._tasks: List[asyncio.Task] = []
+
+    async def _run(self) -> None:
+        while True:
+            request_id = await self.queue.claim()
+            try:
+                await self.handler(request_id)
+            except Exception:
+                logger.exception("Error processing image request %s", request_id)
+
+    def start(self) -> None:
+        for _ in range(self.concurrency - len(self._tasks)):
+            self._tasks.append(asyncio.create_task(self._run()))
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+
+def create_image_job_queue(backend: str = IMAGE_QUEUE_BACKEND) -> ImageJobQueue:
+    """
+    Builds the queue selected by IMAGE_QUEUE_BACKEND ("local" or "postgres").
+    """
+    if backend == "local":
+        return LocalImageJobQueue()
+    if backend == "postgres":
+        return PostgresImageJobQueue()
+    raise ValueError(f"Unknown image queue backend: {backend}")
+
+
+_image_job_queue: Optional[ImageJobQueue] = None
+
+
+def get_image_job_queue() -> ImageJobQueue:
+    """
+    Returns the process-wide image job queue, creating it on first use.
+    """
+    global _image_job_queue
+    if _image_job_queue is None:
+        _image_job_queue = create_image_job_queue()
+        project.metrics.image_queue_depth.set_function(_image_job_queue.depth)
+    return _image_job_queue
+
+
+# Both statements match PROCESSING rows whose lease expired; with $3, also rows that were
+# never claimed for as long (jobs of a local queue that died with its process).
+EXPIRED_LEASE_CONDITION = """
+    "status" = 'PROCESSING' AND (
+        "claimedAt" < NOW() - make_interval(secs => $1)
+        OR ($3 AND "claimedAt" IS NULL AND "createdAt" < NOW() - make_interval(secs => $1))
+    )
+"""
+
+FAIL_EXPIRED_QUERY = f"""
+    UPDATE "ImageRequest" SET "status" = 'FAILED', "updatedAt" = NOW()
+    WHERE {EXPIRED_LEASE_CONDITION} AND "requeueCount" >= $2
+    RETURNING "id"
+"""
+
+# The postgres queue claims rows whose claimedAt is NULL; a local queue gets the ids
+# submitted directly and the rows are stamped so they keep a lease meanwhile.
+REQUEUE_EXPIRED_QUERY = f"""
+    UPDATE "ImageRequest"
+    SET "requeueCount" = "requeueCount" + 1,
+        "claimedAt" = CASE WHEN $4 THEN NOW() ELSE NULL END,
+        "updatedAt" = NOW()
+    WHERE {EXPIRED_LEASE_CONDITION} AND "requeueCount" < $2
+    RETURNING "id", "userId"
+"""
+
+
+def _single_process() -> bool:
+    """
+    Whether this is the only server process, as far as WEB_CONCURRENCY (set by project.serve and read by uvicorn) tells.
+    """
+    return int(os.environ.get("WEB_CONCURRENCY", "1")) <= 1
+
+
+async def reap_expired_leases(startup: bool = False) -> Tuple[int, int]:
+    """
+    Puts PROCESSING requests whose worker stopped without finishing them back on the queue,
+    or marks them FAILED once they have been requeued IMAGE_REQUEST_MAX_REQUEUES times.
+
+    A request's lease starts when it is claimed (claimedAt) and lasts IMAGE_REQUEST_LEASE_SECONDS,
+    which must be longer than any generation takes. The statements are single UPDATEs, so
+    several processes can reap concurrently without handing a request out twice.
+
+    Args:
+        startup (bool): Also take over unclaimed requests older than the lease. Only done
+            with the local queue in a single-process deployment, where they can only be jobs
+            a previous process lost; with several workers they may sit in another live
+            worker's queue.
+
+    Returns:
+        Tuple[int, int]: The number of requests requeued and failed.
+    """
+    queue = get_image_job_queue()
+    local = isinstance(queue, LocalImageJobQueue)
+    take_orphans = startup and local and _single_process()
+    client = prisma.get_client()
+    failed = await client.query_raw(
+        FAIL_EXPIRED_QUERY,
+        IMAGE_REQUEST_LEASE_SECONDS,
+        IMAGE_REQUEST_MAX_REQUEUES,
+        take_orphans,
+    )  # type: ignore[arg-type]
+    requeued = await client.query_raw(
+        REQUEUE_EXPIRED_QUERY,
+        IMAGE_REQUEST_LEASE_SECONDS,
+        IMAGE_REQUEST_MAX_REQUEUES,
+        take_orphans,
+        local,
+    )  # type: ignore[arg-type]
+    for row in failed:
+        await project.image_events.publish_status(row["id"], prisma.enums.ImageRequestStatus.FAILED)
+    for row in requeued:
+        await queue.submit(row["id"], owner=row["userId"])
+    if failed or requeued:
+        logger.warning(
+            "Reaped expired image request leases: %d requeued, %d failed", len(requeued), len(failed)
+        )
+        project.metrics.image_requests_reaped.inc(len(requeued), action="requeued")
+        project.metrics.image_requests_reaped.inc(len(failed), action="failed")
+    return len(requeued), len(failed)
+
+
+async def _reap_periodically() -> None:
+    startup = True
+    while True:
+        try:
+            await reap_expired_leases(startup=startup)
+            startup = False
+        except Exception:
+            logger.exception("Failed to reap expired image request leases")
+        await asyncio.sleep(IMAGE_REQUEST_REAP_INTERVAL)
+
+
+_reaper_task: Optional[asyncio.Task] = None
+
+
+def start_lease_reaper() -> None:
+    global _reaper_task
+    if _reaper_task is None:
+        _reaper_task = asyncio.create_task(_reap_periodically())
+
+
+async def stop_lease_reaper() -> None:
+    global _reaper_task
+    if _reaper_task is not None:
+        _reaper_task.cancel()
+        await asyncio.gather(_reaper_task, return_exceptions=True)
+        _reaper_task = None
@@ -0,0 +1,373 @@
+import asyncio
+import io
+import logging
+import multiprocessing
+import os
+from concurrent.futures import Executor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from pydantic import BaseModel
+
+logger = logging.getLogger(__name__)
+
+# Processes that decode, transform and encode images (post-processing and variants).
+IMAGE_PROCESS_WORKERS = int(
+    os.environ.get(
+        "IMAGE_PROCESS_WORKERS",
+        os.environ.get("IMAGE_VARIANT_WORKERS", str(min(os.cpu_count() or 1, 4))),
+    )
+)
+IMAGE_MAX_DIMENSION = int(os.environ.get("IMAGE_MAX_DIMENSION", "4096"))
+IMAGE_DEFAULT_QUALITY = int(os.environ.get("IMAGE_DEFAULT_QUALITY", "85"))
+# Comma-separated plans (FREE, BASIC, PREMIUM, ADMIN) whose images are watermarked.
+IMAGE_WATERMARK_PLANS = frozenset(
+    plan.strip().upper()
+    for plan in os.environ.get("IMAGE_WATERMARK_PLANS", "FREE,BASIC").split(",")
+    if plan.strip()
+)
+IMAGE_WATERMARK_TEXT = os.environ.get("IMAGE_WATERMARK_TEXT", "image maker")
+IMAGE_WATERMARK_OPACITY = float(os.environ.get("IMAGE_WATERMARK_OPACITY", "0.35"))
+
+# Customization options understood by the pipeline; any other option is left to the model.
+WIDTH_OPTION = "width"
+HEIGHT_OPTION = "height"
+CROP_OPTION = "crop"
+FORMAT_OPTION = "format"
+QUALITY_OPTION = "quality"
+WATERMARK_OPTION = "watermark"
+
+FORMATS = {"png": "PNG", "jpeg": "JPEG", "jpg": "JPEG", "webp": "WEBP"}
+
+
+class PostProcessingUnavailable(Exception):
+    """
+    Raised when the user's plan requires a watermark but Pillow or numpy is not installed.
+    """
+
+
+class PostProcessingSpec(BaseModel):
+    """
+    The transformations applied to a generated image before it is stored, in this order:
+    center crop to an aspect ratio, resize, watermark, encode.
+    """
+
+    width: Optional[int] = None
+    height: Optional[int] = None
+    # Aspect ratio as (width, height), e.g. (16, 9).
+    crop: Optional[Tuple[int, int]] = None
+    # Pillow format name; the source format when None.
+    format: Optional[str] = None
+    quality: Optional[int] = None
+    watermark: bool = False
+
+
+def _dimension(name: str, value: str) -> int:
+    try:
+        size = int(value)
+    except ValueError:
+        size = 0
+    if not 1 <= size <= IMAGE_MAX_DIMENSION:
+        raise ValueError(f"{name} must be an integer between 1 and {IMAGE_MAX_DIMENSION}")
+    return size
+
+
+def parse_postprocessing_options(
+    customization_options: Optional[Dict[str, str]],
+) -> Optional[PostProcessingSpec]:
+    """
+    Extracts the post-processing steps from the customization options of a request.
+
+    Args:
+        customization_options (Optional[Dict[str, str]]): The option/value pairs of the request. Option names are case-insensitive.
+
+    Returns:
+        Optional[PostProcessingSpec]: The steps to apply, or None if the image is stored as generated.
+
+    Raises:
+        ValueError: If a post-processing option has an invalid value.
+
+    Example:
+        parse_postprocessing_options({"width": "512", "format": "webp", "lighting": "soft"})
+        > PostProcessingSpec(width=512, height=None, crop=None, format="WEBP", quality=None, watermark=False)
+    """
+    spec = PostProcessingSpec()
+    for option, value in (customization_options or {}).items():
+        option, value = option.strip().lower(), value.strip().lower()
+        if option == WIDTH_OPTION:
+            spec.width = _dimension(option, value)
+        elif option == HEIGHT_OPTION:
+            spec.height = _dimension(option, value)
+        elif option == CROP_OPTION:
+            ratio = value.split(":")
+            if len(ratio) != 2 or not all(part.isdigit() and int(part) > 0 for part in ratio):
+                raise ValueError('crop must be an aspect ratio such as "16:9"')
+            spec.crop = (int(ratio[0]), int(ratio[1]))
+        elif option == FORMAT_OPTION:
+            if value not in FORMATS:
+                raise ValueError(f"format must be one of {', '.join(FORMATS)}")
+            spec.format = FORMATS[value]
+        elif option == QUALITY_OPTION:
+            if not value.isdigit() or not 1 <= int(value) <= 100:
+                raise ValueError("quality must be an integer between 1 and 100")
+            spec.quality = int(value)
+        elif option == WATERMARK_OPTION:
+            spec.watermark = value == "true"
+    if spec == PostProcessingSpec():
+        return None
+    return spec
+
+
+def apply_plan_options(
+    customization_options: Optional[Dict[str, str]], plan_name: str
+) -> Optional[Dict[str, str]]:
+    """
+    Sets the watermark option from the user's plan and validates the post-processing options.
+
+    The watermark is recorded as a customization option so that it is part of the result
+    cache key and the stored CustOption rows, and queued requests pick it up too. Users
+    cannot set or clear it themselves.
+
+    Raises:
+        ValueError: If a post-processing option has an invalid value, or post-processing
+            options were given but Pillow or numpy is not installed.
+        PostProcessingUnavailable: If the plan requires a watermark but Pillow or numpy is not installed.
+    """
+    options = {
+        option: value
+        for option, value in (customization_options or {}).items()
+        if option.strip().lower() != WATERMARK_OPTION
+    }
+    if parse_postprocessing_options(options) is not None and not imaging_available():
+        raise ValueError(
+            "The width, height, crop, format and quality options are not supported by this server"
+        )
+    if plan_name in IMAGE_WATERMARK_PLANS:
+        if not imaging_available():
+            raise PostProcessingUnavailable(
+                f"Images of the {plan_name} plan are watermarked, but this server cannot watermark images"
+            )
+        options[WATERMARK_OPTION] = "true"
+    return options or None
+
+
+def _imaging():
+    try:
+        import numpy
+        from PIL import Image, ImageDraw, ImageFont
+    except ImportError as e:
+        raise RuntimeError(
+            "Image post-processing requires the 'Pillow' and 'numpy' packages"
+        ) from e
+    return numpy, Image, ImageDraw, ImageFont
+
+
+def center_crop(frame, ratio: Tuple[int, int]):
+    """
+    Returns the largest centered region of the frame with the given aspect ratio, as a view.
+    """
+    height, width = frame.shape[:2]
+    crop_width = min(width, height * ratio[0] // ratio[1]) or 1
+    crop_height = min(height, width * ratio[1] // ratio[0]) or 1
+    top = (height - crop_height) // 2
+    left = (width - crop_width) // 2
+    return frame[top : top + crop_height, left : left + crop_width]
+
+
+def resize(frame, width: Optional[int], height: Optional[int]):
+    """
+    Resamples the frame with Lanczos filtering; a missing dimension keeps the aspect ratio.
+    """
+    numpy, Image, _, _ = _imaging()
+    source_height, source_width = frame.shape[:2]
+    if width is None:
+        width = max(1, round(source_width * height / source_height))
+    if height is None:
+        height = max(1, round(source_height * width / source_width))
+    if (width, height) == (source_width, source_height):
+        return frame
+    resampling = getattr(Image, "Resampling", Image).LANCZOS
+    return numpy.asarray(
+        Image.fromarray(numpy.ascontiguousarray(frame)).resize((width, height), resampling)
+    )
+
+
+@lru_cache(maxsize=32)
+def watermark_mask(width: int, height: int):
+    """
+    Renders IMAGE_WATERMARK_TEXT once per frame size as a float alpha mask, scaled to the frame width.
+    """
+    numpy, Image, ImageDraw, ImageFont = _imaging()
+    font_size = max(10, width // 24)
+    try:
+        font = ImageFont.load_default(size=font_size)
+    except TypeError:
+        font = ImageFont.load_default()
+    left, top, right, bottom = ImageDraw.Draw(Image.new("L", (1, 1))).textbbox(
+        (0, 0), IMAGE_WATERMARK_TEXT, font=font
+    )
+    text = Image.new("L", (min(right - left, width), min(bottom - top, height)))
+    ImageDraw.Draw(text).text((-left, -top), IMAGE_WATERMARK_TEXT, fill=255, font=font)
+    mask = numpy.asarray(text, dtype=numpy.float32) * (IMAGE_WATERMARK_OPACITY / 255)
+    return mask[:, :, None]
+
+
+def watermark(frame):
+    """
+    Blends the watermark into the bottom-right corner of the frame in place; only that region is touched.
+    """
+    numpy, _, _, _ = _imaging()
+    height, width = frame.shape[:2]
+    mask = watermark_mask(width, height)
+    margin = max(0, min(width, height) // 40)
+    top = max(0, height - mask.shape[0] - margin)
+    left = max(0, width - mask.shape[1] - margin)
+    region = frame[top : top + mask.shape[0], left : left + mask.shape[1], :3]
+    region += ((255 - region) * mask[: region.shape[0], : region.shape[1]]).astype(numpy.uint8)
+    return frame
+
+
+def postprocess_image(data: bytes, spec: PostProcessingSpec) -> bytes:
+    """
+    Applies a PostProcessingSpec to an encoded image and returns the re-encoded bytes.
+
+    The image is decoded once into a NumPy frame. Cropping is a view of that frame, the
+    watermark is blended into it in place, and the encoder reads it without copying
+    unless a resize produced a new frame, so each step costs no extra full-frame copy.
+    Runs in the process pool, so it must stay a picklable module-level function.
+
+    Raises:
+        RuntimeError: If Pillow or NumPy is not installed.
+    """
+    numpy, Image, _, _ = _imaging()
+    with Image.open(io.BytesIO(data)) as image:
+        source_format = image.format
+        output_format = spec.format or (
+            source_format if source_format in FORMATS.values() else "PNG"
+        )
+        has_alpha = image.mode in ("RGBA", "LA", "PA") or "transparency" in image.info
+        mode = "RGBA" if has_alpha and output_format != "JPEG" else "RGB"
+        # One decoded, writable frame; every later step works on it or on a view of it.
+        frame = numpy.array(image.convert(mode) if image.mode != mode else image)
+    if spec.crop is not None:
+        frame = center_crop(frame, spec.crop)
+    if spec.width is not None or spec.height is not None:
+        frame = resize(frame, spec.width, spec.height)
+    if spec.watermark:
+        if not frame.flags.writeable:
+            frame = frame.copy()
+        frame = watermark(frame)
+    output = io.BytesIO()
+    encoded = Image.fromarray(numpy.ascontiguousarray(frame))
+    if output_format == "PNG":
+        encoded.save(output, format="PNG")
+    else:
+        encoded.save(
+            output, format=output_format, quality=spec.quality or IMAGE_DEFAULT_QUALITY
+        )
+    return output.getvalue()
+
+
+def _check_imaging() -> bool:
+    try:
+        _imaging()
+    except RuntimeError:
+        return False
+    return True
+
+
+_pool: Optional[ProcessPoolExecutor] = None
+# Whether Pillow and numpy are installed; checked once, by start_image_processing or on first use.
+_available: Optional[bool] = None
+
+
+def imaging_available() -> bool:
+    """
+    Returns whether images can be post-processed and variants rendered here.
+    """
+    global _available
+    if _available is None:
+        _available = _check_imaging()
+    return _available
+
+
+def get_process_pool() -> Executor:
+    """
+    Returns the process pool for CPU-bound image work, created on first use.
+    """
+    global _pool
+    if _pool is None:
+        # Workers are spawned rather than forked: forking a process that runs an event loop,
+        # threads and the Prisma query engine is not safe.
+        _pool = ProcessPoolExecutor(
+            max_workers=IMAGE_PROCESS_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+    return _pool
+
+
+async def run_in_process_pool(function: Callable[..., Any], *args: Any) -> Any:
+    """
+    Runs a picklable function in the image process pool without blocking the event loop.
+
+    If a worker died (for example killed for using too much memory), the pool is replaced
+    and the call is tried once more on the new one.
+
+    Raises:
+        BrokenProcessPool: If the call also broke the replacement pool.
+    """
+    global _pool
+    for attempt in range(2):
+        pool = get_process_pool()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(pool, function, *args)
+        except BrokenProcessPool:
+            if _pool is pool:
+                pool.shutdown(wait=False, cancel_futures=True)
+                _pool = None
+            if attempt:
+                raise
+            logger.warning("An image process pool worker died; starting a new pool")
+    raise AssertionError("unreachable")
+
+
+async def postprocess(data: bytes, spec: PostProcessingSpec) -> bytes:
+    """
+    Runs postprocess_image in the process pool. Returns the image unchanged when Pillow or NumPy is missing.
+    """
+    if not imaging_available():
+        return data
+    return await run_in_process_pool(postprocess_image, data, spec)
+
+
+async def start_image_processing() -> None:
+    """
+    Starts every pool worker and loads the imaging libraries in it, so no request pays for process startup.
+
+    Raises:
+        RuntimeError: If IMAGE_WATERMARK_PLANS names any plan but Pillow or numpy is not
+            installed, since every request of those plans would fail.
+    """
+    global _available
+    checks = await asyncio.gather(
+        *(run_in_process_pool(_check_imaging) for _ in range(IMAGE_PROCESS_WORKERS))
+    )
+    # Decided here once: a worker that dies later is replaced, it does not turn processing off.
+    _available = all(checks)
+    if _available:
+        return
+    if IMAGE_WATERMARK_PLANS:
+        raise RuntimeError(
+            "Pillow or numpy is not installed, so the plans in IMAGE_WATERMARK_PLANS "
+            f"({', '.join(sorted(IMAGE_WATERMARK_PLANS))}) cannot be watermarked; install "
+            "them or set IMAGE_WATERMARK_PLANS to an empty string"
+        )
+    logger.warning("Pillow or numpy is not installed; storing images without post-processing")
+
+
+async def close_image_processing() -> None:
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
@@ -0,0 +1,277 @@
+import asyncio
+import logging
+import os
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+import prisma
+import prisma.enums
+import prisma.models
+
+logger = logging.getLogger(__name__)
+
+IMAGE_STATUS_BATCH_SIZE = int(os.environ.get("IMAGE_STATUS_BATCH_SIZE", "50"))
+IMAGE_STATUS_BATCH_DELAY = float(os.environ.get("IMAGE_STATUS_BATCH_DELAY", "0.02"))
+
+# (request id, status, image URL, timing columns from GenerationTiming.columns())
+StatusTransition = Tuple[
+    str, prisma.enums.ImageRequestStatus, Optional[str], Optional[Dict[str, Any]]
+]
+
+
+def _customization_options_data(customization_options: Optional[Dict[str, str]]) -> List[dict]:
+    return [
+        {"option": option, "value": value}
+        for option, value in (customization_options or {}).items()
+    ]
+
+
+async def create_image_request(
+    user_id: str,
+    text_description: str,
+    ai_model: prisma.enums.AIModel,
+    theme: Optional[str],
+    style: Optional[str],
+    status: prisma.enums.ImageRequestStatus,
+    prompt_hash: Optional[str] = None,
+    image_url: Optional[str] = None,
+    customization_options: Optional[Dict[str, str]] = None,
+    claimed: bool = False,
+    request_id: Optional[str] = None,
+    timing: Optional[Dict[str, Any]] = None,
+    idempotency_key: Optional[str] = None,
+) -> prisma.models.ImageRequest:
+    """
+    Inserts an ImageRequest, together with its CustOption rows, in a single statement.
+
+    Synchronous generations call this once with the final status, so there is no
+    create-then-update pair. Queued generations call it with PROCESSING and later go
+    through the status batcher.
+
+    Args:
+        user_id (str): The owner of the request.
+        text_description (str): The prompt.
+        ai_model (prisma.enums.AIModel): The model the request is for.
+        theme (Optional[str]): Optional theme preference.
+        style (Optional[str]): Optional style preference.
+        status (prisma.enums.ImageRequestStatus): The status to store.
+        prompt_hash (Optional[str]): The result cache key of the request.
+        image_url (Optional[str]): The generated image, when it is already known.
+        customization_options (Optional[Dict[str, str]]): Option/value pairs stored as CustOption rows.
+        claimed (bool): Stamp claimedAt so queue workers leave the row alone.
+        request_id (Optional[str]): Use this id instead of a database-generated one.
+        timing (Optional[Dict[str, Any]]): Timing columns of the generation, from GenerationTiming.columns().
+        idempotency_key (Optional[str]): The Idempotency-Key of the request, unique per user.
+
+    Returns:
+        prisma.models.ImageRequest: The inserted row.
+
+    Raises:
+        prisma.errors.UniqueViolationError: If the user already has a request with idempotency_key.
+    """
+    data = {
+        "userId": user_id,
+        "textDescription": text_description,
+        "AIModel": ai_model,
+        "theme": theme,
+        "style": style,
+        "status": status,
+        "promptHash": prompt_hash,
+        "imageUrl": image_url,
+    }
+    if request_id is not None:
+        data["id"] = request_id
+    if claimed:
+        data["claimedAt"] = datetime.now()
+    if timing:
+        data.update(timing)
+    if idempotency_key is not None:
+        data["idempotencyKey"] = idempotency_key
+    options = _customization_options_data(customization_options)
+    if options:
+        data["customizationOptions"] = {"create": options}
+    return await prisma.models.ImageRequest.prisma().create(data=data)
+
+
+async def find_idempotent_request(
+    user_id: str, idempotency_key: str
+) -> Optional[prisma.models.ImageRequest]:
+    """
+    Looks up the request a user created with an Idempotency-Key, through the unique (userId, idempotencyKey) index.
+    """
+    return await prisma.models.ImageRequest.prisma().find_unique(
+        where={"userId_idempotencyKey": {"userId": user_id, "idempotencyKey": idempotency_key}}
+    )
+
+
+async def finish_image_request(
+    request_id: str,
+    status: prisma.enums.ImageRequestStatus,
+    image_url: Optional[str] = None,
+    ai_model: Optional[prisma.enums.AIModel] = None,
+    timing: Optional[Dict[str, Any]] = None,
+    prompt_hash: Optional[str] = None,
+) -> None:
+    """
+    Writes the outcome of a request that was inserted as PROCESSING before its generation started.
+
+    Args:
+        request_id (str): The reserved ImageRequest.
+        status (prisma.enums.ImageRequestStatus): COMPLETED or FAILED.
+        image_url (Optional[str]): The generated image.
+        ai_model (Optional[prisma.enums.AIModel]): The model that produced it, if a substitute did.
+        timing (Optional[Dict[str, Any]]): Timing columns of the generation, from GenerationTiming.columns().
+        prompt_hash (Optional[str]): The result cache key for ai_model, so the row is only reused for that model.
+    """
+    data: Dict[str, Any] = {"status": status, **(timing or {})}
+    if image_url is not None:
+        data["imageUrl"] = image_url
+    if ai_model is not None:
+        data["AIModel"] = ai_model
+    if prompt_hash is not None:
+        data["promptHash"] = prompt_hash
+    await prisma.models.ImageRequest.prisma().update(where={"id": request_id}, data=data)
+
+
+def add_image_requests_to_batch(
+    batcher: "prisma.Batch",
+    rows: List[dict],
+    customization_options: Dict[str, Dict[str, str]],
+) -> None:
+    """
+    Queues a create_many of ImageRequest rows, and of the CustOption rows keyed by request id, on a batch_() transaction.
+    """
+    batcher.imagerequest.create_many(data=rows)
+    option_rows = [
+        {"imageRequestId": request_id, **option}
+        for request_id, options in customization_options.items()
+        for option in _customization_options_data(options)
+    ]
+    if option_rows:
+        batcher.custoption.create_many(data=option_rows)
+
+
+async def write_status_transitions(
+    transitions: List[StatusTransition],
+) -> Dict[str, Exception]:
+    """
+    Applies many status transitions in one round-trip. FAILED transitions without an image or timing collapse into a single update_many.
+
+    The round-trip is one transaction, so a single failing update (for example of a row
+    deleted together with its user) would roll back all of them. In that case every
+    transition is retried on its own.
+
+    Returns:
+        Dict[str, Exception]: The error of each transition that could not be written, by request id.
+    """
+    if not transitions:
+        return {}
+    try:
+        await _write_status_transitions(transitions)
+        return {}
+    except Exception as e:
+        if len(transitions) == 1:
+            logger.error("Failed to write the status of image request %s: %r", transitions[0][0], e)
+            return {transitions[0][0]: e}
+        logger.warning(
+            "Batched write of %d status transitions failed; writing them one by one",
+            len(transitions),
+            exc_info=True,
+        )
+    errors: Dict[str, Exception] = {}
+    for transition in transitions:
+        try:
+            await _write_status_transitions([transition])
+        except Exception as e:
+            logger.error("Failed to write the status of image request %s: %r", transition[0], e)
+            errors[transition[0]] = e
+    return errors
+
+
+async def _write_status_transitions(transitions: List[StatusTransition]) -> None:
+    def collapsible(transition: StatusTransition) -> bool:
+        _, status, image_url, timing = transition
+        return status == prisma.enums.ImageRequestStatus.FAILED and image_url is None and not timing
+
+    failed = [transition[0] for transition in transitions if collapsible(transition)]
+    async with prisma.get_client().batch_() as batcher:
+        if failed:
+            batcher.imagerequest.update_many(
+                where={"id": {"in": failed}},
+                data={"status": prisma.enums.ImageRequestStatus.FAILED},
+            )
+        for transition in transitions:
+            if collapsible(transition):
+                continue
+            request_id, status, image_url, timing = transition
+            data = {"status": status, **(timing or {})}
+            if image_url is not None:
+                data["imageUrl"] = image_url
+            batcher.imagerequest.update(where={"id": request_id}, data=data)
+
+
+class ImageStatusBatcher:
+    """
+    Group-commits status transitions coming from concurrent queue workers.
+
+    A transition waits at most max_delay seconds, or until max_size transitions are
+    pending, and is then written together with the others in one batch_() transaction.
+    The caller's await returns once its transition is durable.
+    """
+
+    def __init__(
+        self,
+        max_size: int = IMAGE_STATUS_BATCH_SIZE,
+        max_delay: float = IMAGE_STATUS_BATCH_DELAY,
+    ) -> None:
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self.flushes = 0
+        self._pending: List[Tuple[StatusTransition, asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    async def transition(
+        self,
+        request_id: str,
+        status: prisma.enums.ImageRequestStatus,
+        image_url: Optional[str] = None,
+        timing: Optional[Dict[str, Any]] = None,
+    ) -> None:
+        """
+        Records a transition, with the timing columns of the generation if given, and waits until it has been written.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append(((request_id, status, image_url, timing), future))
+        if len(self._pending) >= self.max_size:
+            self._schedule_flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_delay, self._schedule_flush)
+        await future
+
+    def _schedule_flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        pending, self._pending = self._pending, []
+        if pending:
+            asyncio.ensure_future(self._flush(pending))
+
+    async def _flush(self, pending: List[Tuple[StatusTransition, asyncio.Future]]) -> None:
+        try:
+            errors = await write_status_transitions([transition for transition, _ in pending])
+            self.flushes += 1
+        except Exception as e:
+            logger.exception("Failed to write %d status transitions", len(pending))
+            errors = {transition[0]: e for transition, _ in pending}
+        # Only the callers whose own transition failed see an error.
+        for transition, future in pending:
+            if future.done():
+                continue
+            if transition[0] in errors:
+                future.set_exception(errors[transition[0]])
+            else:
+                future.set_result(None)
+
+
+image_status_batcher = ImageStatusBatcher()
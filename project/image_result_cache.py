@@ -0,0 +1,274 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from abc import ABC, abstractmethod
+from typing import Awaitable, Callable, Dict, Optional
+
+import prisma
+import prisma.enums
+import prisma.models
+import project.metrics
+import project.prompt_canonicalizer
+from project.ttl_lru_cache import TTLLRUCache
+from pydantic import BaseModel
+
+logger = logging.getLogger(__name__)
+
+IMAGE_RESULT_CACHE_ENTRIES = int(os.environ.get("IMAGE_RESULT_CACHE_ENTRIES", "10000"))
+IMAGE_RESULT_CACHE_BYTES = int(
+    os.environ.get("IMAGE_RESULT_CACHE_BYTES", str(64 * 1024 * 1024))
+)
+IMAGE_RESULT_CACHE_TTL = float(os.environ.get("IMAGE_RESULT_CACHE_TTL", "3600"))
+# Optional second tier shared between processes: "none", "postgres" or "disk".
+IMAGE_RESULT_CACHE_TIER2 = os.environ.get("IMAGE_RESULT_CACHE_TIER2", "none")
+IMAGE_RESULT_CACHE_DIR = os.environ.get("IMAGE_RESULT_CACHE_DIR", ".cache/image-results")
+
+
+class CachedImageResult(BaseModel):
+    """
+    The completed ImageRequest a cache key resolves to.
+    """
+
+    request_id: str
+    image_url: str
+
+
+def result_cache_key(
+    text_description: str,
+    ai_model: prisma.enums.AIModel,
+    theme: Optional[str],
+    style: Optional[str],
+    customization_options: Optional[Dict[str, str]] = None,
+) -> str:
+    """
+    Returns the content hash identifying a generation request. Free-text inputs are
+    canonicalized first, so spelling variants of the same request share a key.
+    """
+    normalized = "\x1f".join(
+        [
+            project.prompt_canonicalizer.canonicalize_prompt(text_description),
+            str(prisma.enums.AIModel(ai_model).value),
+            project.prompt_canonicalizer.canonicalize_prompt(theme),
+            project.prompt_canonicalizer.canonicalize_prompt(style),
+        ]
+        + [
+            f"{option}={value}"
+            for option, value in sorted((customization_options or {}).items())
+        ]
+    )
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+
+class ResultCacheTier(ABC):
+    """
+    A slower, persistent cache tier consulted after the in-memory LRU misses.
+    """
+
+    @abstractmethod
+    async def get(self, key: str) -> Optional[CachedImageResult]:
+        pass
+
+    @abstractmethod
+    async def set(self, key: str, result: CachedImageResult) -> None:
+        pass
+
+
+class PostgresResultCacheTier(ResultCacheTier):
+    """
+    Looks up the most recent COMPLETED ImageRequest with the same promptHash. Writes are free,
+    because the hash is stored on the ImageRequest row when it is created.
+    """
+
+    def __init__(self, ttl: float = IMAGE_RESULT_CACHE_TTL) -> None:
+        self.ttl = ttl
+
+    async def get(self, key: str) -> Optional[CachedImageResult]:
+        image_request = await prisma.models.ImageRequest.prisma().find_first(
+            where={
+                "promptHash": key,
+                "status": prisma.enums.ImageRequestStatus.COMPLETED,
+            },
+            order={"createdAt": "desc"},
+        )
+        if not image_request or not image_request.imageUrl:
+            return None
+        if time.time() - image_request.updatedAt.timestamp() > self.ttl:
+            return None
+        return CachedImageResult(
+            request_id=image_request.id, image_url=image_request.imageUrl
+        )
+
+    async def set(self, key: str, result: CachedImageResult) -> None:
+        pass
+
+
+class DiskResultCacheTier(ResultCacheTier):
+    """
+    Stores one small JSON file per key; entries older than the TTL are treated as missing.
+    """
+
+    def __init__(
+        self, directory: str = IMAGE_RESULT_CACHE_DIR, ttl: float = IMAGE_RESULT_CACHE_TTL
+    ) -> None:
+        self.directory = directory
+        self.ttl = ttl
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], f"{key}.json")
+
+    def _read(self, key: str) -> Optional[CachedImageResult]:
+        path = self._path(key)
+        try:
+            if time.time() - os.path.getmtime(path) > self.ttl:
+                os.remove(path)
+                return None
+            with open(path, "r", encoding="utf-8") as f:
+                return CachedImageResult(**json.load(f))
+        except (OSError, ValueError):
+            return None
+
+    def _write(self, key: str, result: CachedImageResult) -> None:
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(result.model_dump(), f)
+        os.replace(tmp_path, path)
+
+    async def get(self, key: str) -> Optional[CachedImageResult]:
+        return await asyncio.to_thread(self._read, key)
+
+    async def set(self, key: str, result: CachedImageResult) -> None:
+        await asyncio.to_thread(self._write, key, result)
+
+
+class _ComputeCancelled(Exception):
+    """
+    Set on an in-flight entry whose compute was cancelled, so the callers waiting on it compute again.
+    """
+
+
+class ImageResultCache:
+    """
+    Two-tier cache of completed generations keyed by result_cache_key, with single-flight
+    coalescing: while one caller computes a key, concurrent callers for the same key wait
+    for its result instead of starting their own backend call.
+    """
+
+    def __init__(
+        self,
+        memory: TTLLRUCache[CachedImageResult],
+        tier2: Optional[ResultCacheTier] = None,
+    ) -> None:
+        self.memory = memory
+        self.tier2 = tier2
+        self.tier2_hits = 0
+        self.coalesced = 0
+        self._in_flight: Dict[str, asyncio.Future] = {}
+
+    async def get(self, key: str) -> Optional[CachedImageResult]:
+        """
+        Returns the cached result from the fastest tier that has it.
+        """
+        result = self.memory.get(key)
+        if result is not None or self.tier2 is None:
+            return result
+        try:
+            result = await self.tier2.get(key)
+        except Exception:
+            logger.exception("Result cache tier-2 lookup failed")
+            return None
+        if result is not None:
+            self.tier2_hits += 1
+            self.memory.set(key, result)
+        return result
+
+    async def set(self, key: str, result: CachedImageResult) -> None:
+        self.memory.set(key, result)
+        if self.tier2 is not None:
+            try:
+                await self.tier2.set(key, result)
+            except Exception:
+                logger.exception("Result cache tier-2 write failed")
+
+    async def get_or_compute(
+        self, key: str, compute: Callable[[], Awaitable[CachedImageResult]]
+    ) -> "tuple[CachedImageResult, bool]":
+        """
+        Returns (result, hit). On a miss exactly one caller per key runs compute; the others share its outcome.
+
+        If the caller running compute is cancelled, one of the waiting callers runs it instead.
+        """
+        result = await self.get(key)
+        if result is not None:
+            return result, True
+        in_flight = self._in_flight.get(key)
+        if in_flight is not None:
+            self.coalesced += 1
+        while in_flight is not None:
+            try:
+                return await asyncio.shield(in_flight), True
+            except _ComputeCancelled:
+                # The caller running compute went away; the first waiter to get here takes over.
+                in_flight = self._in_flight.get(key)
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = future
+        try:
+            result = await compute()
+            await self.set(key, result)
+            future.set_result(result)
+            return result, False
+        except asyncio.CancelledError:
+            # Not future.cancel(): that would cancel the waiters too, instead of letting them retry.
+            future.set_exception(_ComputeCancelled())
+            future.exception()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Mark the exception as retrieved in case nobody else was waiting.
+            future.exception()
+            raise
+        finally:
+            del self._in_flight[key]
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Returns the hit/miss/eviction counters.
+        """
+        return {
+            "hits": self.memory.hits,
+            "misses": self.memory.misses,
+            "evictions": self.memory.evictions,
+            "expirations": self.memory.expirations,
+            "tier2_hits": self.tier2_hits,
+            "coalesced": self.coalesced,
+            "entries": len(self.memory),
+            "bytes": self.memory.size,
+        }
+
+
+def create_image_result_cache(tier2: str = IMAGE_RESULT_CACHE_TIER2) -> ImageResultCache:
+    """
+    Builds the cache configured by the IMAGE_RESULT_CACHE_* environment variables.
+    """
+    memory: TTLLRUCache[CachedImageResult] = TTLLRUCache(
+        max_entries=IMAGE_RESULT_CACHE_ENTRIES,
+        ttl=IMAGE_RESULT_CACHE_TTL,
+        max_size=IMAGE_RESULT_CACHE_BYTES,
+        size_of=lambda result: len(result.image_url) + len(result.request_id),
+    )
+    if tier2 == "none":
+        return ImageResultCache(memory)
+    if tier2 == "postgres":
+        return ImageResultCache(memory, PostgresResultCacheTier())
+    if tier2 == "disk":
+        return ImageResultCache(memory, DiskResultCacheTier())
+    raise ValueError(f"Unknown image result cache tier: {tier2}")
+
+
+image_result_cache = create_image_result_cache()
+project.metrics.register_cache("image-result", image_result_cache.memory)
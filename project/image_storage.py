@@ -0,0 +1,368 @@
+import asyncio
+import hashlib
+import io
+import logging
+import os
+import re
+import tempfile
+from abc import ABC, abstractmethod
+from typing import AsyncIterator, Dict, Optional, Set
+
+import project.image_postprocessing
+from project.ttl_lru_cache import TTLLRUCache
+from pydantic import BaseModel
+
+logger = logging.getLogger(__name__)
+
+# Only "local" ships here; an S3-compatible store implements the same BlobStore interface.
+IMAGE_STORE_BACKEND = os.environ.get("IMAGE_STORE_BACKEND", "local")
+IMAGE_STORE_PATH = os.environ.get("IMAGE_STORE_PATH", "./image_store")
+# Prefix of the URLs stored in imageUrl, e.g. "https://api.example.com"; relative when empty.
+IMAGE_FILE_BASE_URL = os.environ.get("IMAGE_FILE_BASE_URL", "")
+IMAGE_THUMBNAIL_SIZE = int(os.environ.get("IMAGE_THUMBNAIL_SIZE", "256"))
+IMAGE_WEBP_QUALITY = int(os.environ.get("IMAGE_WEBP_QUALITY", "80"))
+
+ORIGINAL = "original"
+VARIANTS = {"thumbnail", "webp"}
+
+_REF_NAME = re.compile(r"^[A-Za-z0-9_-]+(/[A-Za-z0-9_-]+)*$")
+
+
+def sniff_content_type(data: bytes) -> str:
+    """
+    Detects the image format from its magic bytes, so blobs need no metadata besides their content.
+    """
+    if data.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if data.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    if data[:6] in (b"GIF87a", b"GIF89a"):
+        return "image/gif"
+    return "application/octet-stream"
+
+
+class StoredBlob(BaseModel):
+    """
+    An immutable blob addressed by the sha256 of its bytes. path is set when the store keeps it on the local filesystem.
+    """
+
+    key: str
+    size: int
+    content_type: str
+    path: Optional[str] = None
+
+    @property
+    def etag(self) -> str:
+        return f'"{self.key}"'
+
+
+class BlobStore(ABC):
+    """
+    Content-addressed blob storage plus named references to blobs.
+
+    Identical bytes are stored once; refs such as "requests/<id>" map a name to a blob key.
+    """
+
+    @abstractmethod
+    async def put(self, data: bytes) -> StoredBlob:
+        """
+        Stores the bytes unless a blob with the same content already exists.
+        """
+
+    @abstractmethod
+    async def stat(self, key: str) -> Optional[StoredBlob]:
+        pass
+
+    @abstractmethod
+    def read(self, key: str, start: int = 0, end: Optional[int] = None) -> AsyncIterator[bytes]:
+        """
+        Yields the bytes [start, end) of a blob in chunks.
+        """
+
+    @abstractmethod
+    async def link(self, name: str, key: str) -> None:
+        pass
+
+    @abstractmethod
+    async def resolve(self, name: str) -> Optional[str]:
+        """
+        Returns the blob key a ref points to, or None.
+        """
+
+    async def read_all(self, key: str) -> bytes:
+        return b"".join([chunk async for chunk in self.read(key)])
+
+
+class LocalBlobStore(BlobStore):
+    """
+    Stores blobs under <root>/blobs/<key[:2]>/<key> and refs under <root>/refs/<name>.
+
+    Writes go to a temporary file that is renamed into place, so readers never see a partial blob.
+    """
+
+    chunk_size = 64 * 1024
+
+    def __init__(self, root: str = IMAGE_STORE_PATH) -> None:
+        self.root = os.path.abspath(root)
+        self.writes = 0
+        self.deduplicated = 0
+        # Refs never change once written, so resolved keys can be cached without expiry.
+        self._refs: TTLLRUCache[str] = TTLLRUCache(max_entries=100000, ttl=None)
+
+    def _blob_path(self, key: str) -> str:
+        if not re.fullmatch(r"[0-9a-f]{64}", key):
+            raise ValueError(f"Invalid blob key: {key}")
+        return os.path.join(self.root, "blobs", key[:2], key)
+
+    def _ref_path(self, name: str) -> str:
+        if not _REF_NAME.match(name):
+            raise ValueError(f"Invalid ref name: {name}")
+        return os.path.join(self.root, "refs", name)
+
+    @staticmethod
+    def _write_atomically(path: str, data: bytes) -> None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def _put(self, data: bytes) -> StoredBlob:
+        key = hashlib.sha256(data).hexdigest()
+        path = self._blob_path(key)
+        if os.path.exists(path):
+            self.deduplicated += 1
+        else:
+            self._write_atomically(path, data)
+            self.writes += 1
+        return StoredBlob(
+            key=key, size=len(data), content_type=sniff_content_type(data), path=path
+        )
+
+    async def put(self, data: bytes) -> StoredBlob:
+        return await asyncio.to_thread(self._put, data)
+
+    def _stat(self, key: str) -> Optional[StoredBlob]:
+        path = self._blob_path(key)
+        try:
+            with open(path, "rb") as f:
+                head = f.read(16)
+                size = os.fstat(f.fileno()).st_size
+        except FileNotFoundError:
+            return None
+        return StoredBlob(key=key, size=size, content_type=sniff_content_type(head), path=path)
+
+    async def stat(self, key: str) -> Optional[StoredBlob]:
+        return await asyncio.to_thread(self._stat, key)
+
+    async def read(
+        self, key: str, start: int = 0, end: Optional[int] = None
+    ) -> AsyncIterator[bytes]:
+        f = await asyncio.to_thread(open, self._blob_path(key), "rb")
+        try:
+            await asyncio.to_thread(f.seek, start)
+            remaining = None if end is None else end - start
+            while remaining is None or remaining > 0:
+                size = self.chunk_size if remaining is None else min(self.chunk_size, remaining)
+                chunk = await asyncio.to_thread(f.read, size)
+                if not chunk:
+                    break
+                if remaining is not None:
+                    remaining -= len(chunk)
+                yield chunk
+        finally:
+            f.close()
+
+    async def link(self, name: str, key: str) -> None:
+        await asyncio.to_thread(
+            self._write_atomically, self._ref_path(name), key.encode("ascii")
+        )
+        self._refs.set(name, key)
+
+    def _resolve(self, name: str) -> Optional[str]:
+        try:
+            with open(self._ref_path(name), "rb") as f:
+                return f.read().decode("ascii").strip()
+        except FileNotFoundError:
+            return None
+
+    async def resolve(self, name: str) -> Optional[str]:
+        key = self._refs.get(name)
+        if key is None:
+            key = await asyncio.to_thread(self._resolve, name)
+            if key is not None:
+                self._refs.set(name, key)
+        return key
+
+
+def render_variant(data: bytes, variant: str) -> bytes:
+    """
+    Encodes a variant of an image: "thumbnail" is a PNG downscaled to fit IMAGE_THUMBNAIL_SIZE, "webp" a lossy WebP.
+
+    Requires the `Pillow` package, which is not installed by default.
+    """
+    try:
+        from PIL import Image
+    except ImportError as e:
+        raise RuntimeError("Image variants require the 'Pillow' package") from e
+    with Image.open(io.BytesIO(data)) as image:
+        output = io.BytesIO()
+        if variant == "thumbnail":
+            image.thumbnail((IMAGE_THUMBNAIL_SIZE, IMAGE_THUMBNAIL_SIZE))
+            image.save(output, format="PNG", optimize=True)
+        elif variant == "webp":
+            image.save(output, format="WEBP", quality=IMAGE_WEBP_QUALITY, method=4)
+        else:
+            raise ValueError(f"Unknown image variant: {variant}")
+        return output.getvalue()
+
+
+class ImageVariantProcessor:
+    """
+    Produces thumbnails and WebP encodings of stored images in the image process pool.
+
+    Variants are generated in the background right after an image is stored, and on
+    demand if one is requested before it exists. Concurrent requests for the same
+    variant share one encode, and the result is linked as variants/<key>/<variant>, so
+    identical originals also share their variants.
+    """
+
+    def __init__(self, store: BlobStore) -> None:
+        self.store = store
+        self._in_flight: Dict[str, asyncio.Future] = {}
+        self._background: Set[asyncio.Task] = set()
+
+    async def _render(self, key: str, variant: str) -> Optional[StoredBlob]:
+        data = await self.store.read_all(key)
+        encoded = await project.image_postprocessing.run_in_process_pool(
+            render_variant, data, variant
+        )
+        blob = await self.store.put(encoded)
+        await self.store.link(f"variants/{key}/{variant}", blob.key)
+        return blob
+
+    async def get(self, key: str, variant: str) -> Optional[StoredBlob]:
+        """
+        Returns a variant of the blob, generating it if needed. None when variants cannot be produced here.
+        """
+        if variant not in VARIANTS:
+            raise ValueError(f"Unknown image variant: {variant}")
+        variant_key = await self.store.resolve(f"variants/{key}/{variant}")
+        if variant_key is not None:
+            return await self.store.stat(variant_key)
+        if not project.image_postprocessing.imaging_available():
+            return None
+        name = f"{key}/{variant}"
+        future = self._in_flight.get(name)
+        if future is None:
+            future = asyncio.ensure_future(self._render(key, variant))
+            self._in_flight[name] = future
+            future.add_done_callback(lambda _: self._in_flight.pop(name, None))
+        return await asyncio.shield(future)
+
+    def schedule(self, key: str) -> None:
+        """
+        Starts generating every variant of a freshly stored blob without waiting for them.
+        """
+        if not project.image_postprocessing.imaging_available():
+            return
+        for variant in VARIANTS:
+            task = asyncio.ensure_future(self.get(key, variant))
+            self._background.add(task)
+            task.add_done_callback(self._finished)
+
+    def _finished(self, task: asyncio.Task) -> None:
+        self._background.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Failed to generate an image variant", exc_info=task.exception())
+
+    async def aclose(self) -> None:
+        for task in list(self._background):
+            task.cancel()
+        await asyncio.gather(*self._background, return_exceptions=True)
+
+
+def create_blob_store(backend: str = IMAGE_STORE_BACKEND) -> BlobStore:
+    if backend == "local":
+        return LocalBlobStore()
+    raise ValueError(f"Unknown image store backend: {backend}")
+
+
+_blob_store: Optional[BlobStore] = None
+_variants: Optional[ImageVariantProcessor] = None
+
+
+def get_blob_store() -> BlobStore:
+    """
+    Returns the process-wide blob store selected by IMAGE_STORE_BACKEND.
+    """
+    global _blob_store
+    if _blob_store is None:
+        _blob_store = create_blob_store()
+    return _blob_store
+
+
+def get_variant_processor() -> ImageVariantProcessor:
+    global _variants
+    if _variants is None:
+        _variants = ImageVariantProcessor(get_blob_store())
+    return _variants
+
+
+async def close_image_storage() -> None:
+    global _variants
+    if _variants is not None:
+        await _variants.aclose()
+        _variants = None
+
+
+def image_file_url(request_id: str) -> str:
+    return f"{IMAGE_FILE_BASE_URL}/image/{request_id}/file"
+
+
+async def store_image(request_id: str, data: bytes) -> str:
+    """
+    Stores the generated bytes of an image request and queues its variants.
+
+    Args:
+        request_id (str): The ImageRequest the image belongs to.
+        data (bytes): The encoded image.
+
+    Returns:
+        str: The URL that serves the image, to be stored as imageUrl.
+    """
+    store = get_blob_store()
+    blob = await store.put(data)
+    await store.link(f"requests/{request_id}", blob.key)
+    get_variant_processor().schedule(blob.key)
+    return image_file_url(request_id)
+
+
+async def open_image(request_id: str, variant: str = ORIGINAL) -> Optional[StoredBlob]:
+    """
+    Looks up the stored image of a request without touching the database.
+
+    Args:
+        request_id (str): The ImageRequest id.
+        variant (str): "original", "thumbnail" or "webp". Falls back to the original when variants cannot be produced.
+
+    Returns:
+        Optional[StoredBlob]: The blob to serve, or None if the request has no stored image.
+    """
+    if variant != ORIGINAL and variant not in VARIANTS:
+        raise ValueError(f"Unknown image variant: {variant}")
+    store = get_blob_store()
+    key = await store.resolve(f"requests/{request_id}")
+    if key is None:
+        return None
+    if variant != ORIGINAL:
+        blob = await get_variant_processor().get(key, variant)
+        if blob is not None:
+            return blob
+    return await store.stat(key)
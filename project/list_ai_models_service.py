@@ -1,7 +1,22 @@
-from typing import List
+import hashlib
+import json
+import logging
+import os
+import time
+from typing import Dict, List, Optional
 
+import project.image_backends
 from pydantic import BaseModel
 
+logger = logging.getLogger(__name__)
+
+# Optional JSON file mapping AIModel names to AIModelDetail fields; re-read when it changes.
+AI_MODELS_CATALOGUE_PATH = os.environ.get("AI_MODELS_CATALOGUE_PATH", "")
+AI_MODELS_CATALOGUE_RELOAD_INTERVAL = float(
+    os.environ.get("AI_MODELS_CATALOGUE_RELOAD_INTERVAL", "5")
+)
+AI_MODELS_CACHE_CONTROL = os.environ.get("AI_MODELS_CACHE_CONTROL", "public, max-age=60")
+
 
 class AIModelDetail(BaseModel):
     """
@@ -22,12 +37,122 @@ class ListModelResponse(BaseModel):
     ai_models: List[AIModelDetail]
 
 
+DEFAULT_AI_MODEL_DETAILS: Dict[str, AIModelDetail] = {
+    "DALLE2": AIModelDetail(
+        name="DALL·E 2",
+        description="A sophisticated AI by OpenAI for generating digital images from natural language descriptions.",
+        supported_styles=["cartoon", "realistic", "fantasy"],
+        limitations=["May produce unrealistic images for complex queries."],
+    ),
+    "IMAGEN": AIModelDetail(
+        name="Imagen",
+        description="Google's state-of-the-art text-to-image AI model offering photorealistic image generation.",
+        supported_styles=["photorealism", "painting"],
+        limitations=["Limited to certain styles and subjects."],
+    ),
+    "MIDJOURNEY": AIModelDetail(
+        name="Midjourney",
+        description="An independent research lab’s AI specializing in creating vivid images and art.",
+        supported_styles=["abstract", "conceptual art"],
+        limitations=["Generates images with a distinctive stylistic signature."],
+    ),
+    "STABLEDIFFUSION": AIModelDetail(
+        name="Stable Diffusion",
+        description="An AI model by Stability AI that excels at generating highly detailed images.",
+        supported_styles=["digital art", "concept art"],
+        limitations=["Occasional artifacts in generated images."],
+    ),
+}
+
+
+class ModelCatalogue(BaseModel):
+    """
+    The serialized model catalogue together with its strong ETag.
+    """
+
+    response: ListModelResponse
+    body: bytes
+    etag: str
+
+
+class _CatalogueState:
+    catalogue: Optional[ModelCatalogue] = None
+    backends_version = -1
+    file_mtime: Optional[float] = None
+    next_check = 0.0
+
+
+def _load_catalogue_file() -> Dict[str, AIModelDetail]:
+    with open(AI_MODELS_CATALOGUE_PATH, "r", encoding="utf-8") as f:
+        return {name: AIModelDetail(**detail) for name, detail in json.load(f).items()}
+
+
+def build_ai_models_catalogue(details: Dict[str, AIModelDetail]) -> ModelCatalogue:
+    """
+    Builds the catalogue for every model that currently has a backend and serializes it once.
+
+    Args:
+        details (Dict[str, AIModelDetail]): Known details by AIModel name. Models without an entry get a minimal one.
+
+    Returns:
+        ModelCatalogue: The response, its JSON bytes and a strong ETag over those bytes.
+    """
+    response = ListModelResponse(
+        ai_models=[
+            details.get(
+                str(ai_model.value),
+                AIModelDetail(
+                    name=str(ai_model.value),
+                    description="",
+                    supported_styles=[],
+                    limitations=[],
+                ),
+            )
+            for ai_model in project.image_backends.available_ai_models()
+        ]
+    )
+    body = response.model_dump_json().encode("utf-8")
+    etag = f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+    return ModelCatalogue(response=response, body=body, etag=etag)
+
+
+def get_ai_models_catalogue() -> ModelCatalogue:
+    """
+    Returns the prebuilt catalogue, rebuilding it only when the backend registry changed or
+    the catalogue file was modified (checked at most every AI_MODELS_CATALOGUE_RELOAD_INTERVAL seconds).
+    """
+    state = _CatalogueState
+    rebuild = (
+        state.catalogue is None
+        or state.backends_version != project.image_backends.backends_version
+    )
+    now = time.monotonic()
+    if AI_MODELS_CATALOGUE_PATH and now >= state.next_check:
+        state.next_check = now + AI_MODELS_CATALOGUE_RELOAD_INTERVAL
+        try:
+            mtime = os.path.getmtime(AI_MODELS_CATALOGUE_PATH)
+        except OSError:
+            mtime = None
+        rebuild = rebuild or mtime != state.file_mtime
+        state.file_mtime = mtime
+    if rebuild:
+        details = DEFAULT_AI_MODEL_DETAILS
+        if AI_MODELS_CATALOGUE_PATH and state.file_mtime is not None:
+            try:
+                details = {**DEFAULT_AI_MODEL_DETAILS, **_load_catalogue_file()}
+            except (OSError, ValueError):
+                logger.exception("Could not load %s", AI_MODELS_CATALOGUE_PATH)
+        state.catalogue = build_ai_models_catalogue(details)
+        state.backends_version = project.image_backends.backends_version
+    return state.catalogue
+
+
 async def list_ai_models() -> ListModelResponse:
     """
     Provides a list of available AI models for image generation.
 
-    This function queries the database to find all available AI models, then structures
-    and returns the data in a formatted response including details about each model.
+    The catalogue is built once from the registered image backends and the optional
+    catalogue file, and only rebuilt when either changes.
 
     Args:
 
@@ -35,31 +160,4 @@ async def list_ai_models() -> ListModelResponse:
     Returns:
     ListModelResponse: Response model that provides detailed information about each available AI model for image generation.
     """
-    ai_models_info = {
-        "DALLE2": AIModelDetail(
-            name="DALL·E 2",
-            description="A sophisticated AI by OpenAI for generating digital images from natural language descriptions.",
-            supported_styles=["cartoon", "realistic", "fantasy"],
-            limitations=["May produce unrealistic images for complex queries."],
-        ),
-        "IMAGEN": AIModelDetail(
-            name="Imagen",
-            description="Google's state-of-the-art text-to-image AI model offering photorealistic image generation.",
-            supported_styles=["photorealism", "painting"],
-            limitations=["Limited to certain styles and subjects."],
-        ),
-        "MIDJOURNEY": AIModelDetail(
-            name="Midjourney",
-            description="An independent research lab’s AI specializing in creating vivid images and art.",
-            supported_styles=["abstract", "conceptual art"],
-            limitations=["Generates images with a distinctive stylistic signature."],
-        ),
-        "STABLEDIFFUSION": AIModelDetail(
-            name="Stable Diffusion",
-            description="An AI model by Stability AI that excels at generating highly detailed images.",
-            supported_styles=["digital art", "concept art"],
-            limitations=["Occasional artifacts in generated images."],
-        ),
-    }
-    list_model_response = ListModelResponse(ai_models=list(ai_models_info.values()))
-    return list_model_response
+    return get_ai_models_catalogue().response
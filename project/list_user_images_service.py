@@ -0,0 +1,127 @@
+import base64
+import json
+from datetime import datetime
+from typing import List, Optional
+
+import prisma
+import prisma.enums
+from pydantic import BaseModel
+
+MAX_PAGE_SIZE = 200
+
+# Columns a client may ask for; id and createdAt are always returned because the cursor needs them.
+SELECTABLE_FIELDS = {
+    "updatedAt": '"updatedAt"',
+    "status": '"status"',
+    "AIModel": '"AIModel"',
+    "imageUrl": '"imageUrl"',
+    "theme": '"theme"',
+    "style": '"style"',
+    "textDescription": '"textDescription"',
+}
+
+
+class ImageRequestSummary(BaseModel):
+    """
+    One past image request. Fields that were not selected are left out of the response.
+    """
+
+    id: str
+    createdAt: datetime
+    updatedAt: Optional[datetime] = None
+    status: Optional[prisma.enums.ImageRequestStatus] = None
+    AIModel: Optional[prisma.enums.AIModel] = None
+    imageUrl: Optional[str] = None
+    theme: Optional[str] = None
+    style: Optional[str] = None
+    textDescription: Optional[str] = None
+
+
+class UserImagesResponse(BaseModel):
+    """
+    A page of a user's image requests, newest first. Pass next_cursor back to get the following page; it is null on the last page.
+    """
+
+    images: List[ImageRequestSummary]
+    next_cursor: Optional[str] = None
+
+
+def encode_cursor(created_at: datetime, id: str) -> str:
+    payload = json.dumps([created_at.isoformat(), id]).encode("utf-8")
+    return base64.urlsafe_b64encode(payload).decode("ascii")
+
+
+def decode_cursor(cursor: str) -> "tuple[str, str]":
+    try:
+        created_at, id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        datetime.fromisoformat(created_at)
+    except (TypeError, ValueError):
+        raise ValueError("Invalid cursor")
+    return created_at, id
+
+
+async def list_user_images(
+    user_id: str,
+    limit: int = 50,
+    cursor: Optional[str] = None,
+    status: Optional[prisma.enums.ImageRequestStatus] = None,
+    ai_model: Optional[prisma.enums.AIModel] = None,
+    fields: Optional[List[str]] = None,
+) -> UserImagesResponse:
+    """
+    Lists a user's image requests with keyset pagination on (createdAt, id).
+
+    Each page is a single index range scan on (userId, [status | AIModel,] createdAt, id)
+    starting right after the cursor, so the cost of a page does not grow with its depth
+    the way OFFSET-based skip/take does.
+
+    Args:
+        user_id (str): The owner of the image requests.
+        limit (int): The page size, at most MAX_PAGE_SIZE.
+        cursor (Optional[str]): The next_cursor of the previous page.
+        status (Optional[prisma.enums.ImageRequestStatus]): Only return requests with this status.
+        ai_model (Optional[prisma.enums.AIModel]): Only return requests for this model.
+        fields (Optional[List[str]]): The columns to return besides id and createdAt; all of them when omitted.
+
+    Returns:
+        UserImagesResponse: The page and the cursor of the next one.
+    """
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        raise ValueError(f"limit must be between 1 and {MAX_PAGE_SIZE}")
+    fields = list(SELECTABLE_FIELDS) if fields is None else fields
+    unknown = set(fields) - set(SELECTABLE_FIELDS)
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(sorted(unknown))}")
+    columns = ['"id"', '"createdAt"'] + [SELECTABLE_FIELDS[field] for field in fields]
+    conditions = ['"userId" = $1']
+    args: list = [user_id]
+    if status is not None:
+        args.append(prisma.enums.ImageRequestStatus(status).value)
+        conditions.append(f'"status" = ${len(args)}::"ImageRequestStatus"')
+    if ai_model is not None:
+        args.append(prisma.enums.AIModel(ai_model).value)
+        conditions.append(f'"AIModel" = ${len(args)}::"AIModel"')
+    if cursor is not None:
+        created_at, id = decode_cursor(cursor)
+        args.extend([created_at, id])
+        conditions.append(
+            f'("createdAt", "id") < (${len(args) - 1}::timestamp(3), ${len(args)})'
+        )
+    args.append(limit + 1)
+    query = (
+        f'SELECT {", ".join(columns)} FROM "ImageRequest" '
+        f'WHERE {" AND ".join(conditions)} '
+        f'ORDER BY "createdAt" DESC, "id" DESC LIMIT ${len(args)}'
+    )
+    rows = await prisma.get_client().query_raw(query, *args)  # type: ignore[arg-type]
+    images = [
+        ImageRequestSummary(
+            **{key: value for key, value in row.items() if value is not None}
+        )
+        for row in rows[:limit]
+    ]
+    next_cursor = None
+    if len(rows) > limit:
+        last = images[-1]
+        next_cursor = encode_cursor(last.createdAt, last.id)
+    return UserImagesResponse(images=images, next_cursor=next_cursor)
@@ -0,0 +1,435 @@
+import asyncio
+import bisect
+import contextvars
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter as StackCounter
+from collections import deque
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from prisma import Prisma
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+logger = logging.getLogger(__name__)
+
+# Requests slower than this many seconds get their sampled stacks written to
+# SLOW_REQUEST_PROFILE_DIR in folded format (flamegraph.pl, speedscope); disabled when empty.
+SLOW_REQUEST_PROFILE_THRESHOLD = os.environ.get("SLOW_REQUEST_PROFILE_THRESHOLD", "")
+SLOW_REQUEST_PROFILE_DIR = os.environ.get("SLOW_REQUEST_PROFILE_DIR", "./profiles")
+SLOW_REQUEST_PROFILE_INTERVAL = float(
+    os.environ.get("SLOW_REQUEST_PROFILE_INTERVAL", "0.005")
+)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+LabelValues = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+class Metric:
+    """
+    A named family of samples keyed by label values, rendered in the Prometheus text format.
+    """
+
+    type = "untyped"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        REGISTRY.append(self)
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def samples(self) -> Iterator[Tuple[str, str, float]]:
+        """
+        Yields (suffix, formatted labels, value) triples.
+        """
+        return iter(())
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        for suffix, labels, value in self.samples():
+            lines.append(f"{self.name}{suffix}{labels} {value:g}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()) -> None:
+        super().__init__(name, help, labels)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    def samples(self) -> Iterator[Tuple[str, str, float]]:
+        for key, value in list(self._values.items()):
+            yield "", _format_labels(self.labels, key), value
+
+
+class Gauge(Metric):
+    """
+    A value that is set directly or read from a function at scrape time.
+    """
+
+    type = "gauge"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()) -> None:
+        super().__init__(name, help, labels)
+        self._values: Dict[LabelValues, float] = {}
+        self._functions: Dict[LabelValues, Callable[[], float]] = {}
+
+    def set(self, value: float, **labels: str) -> None:
+        self._values[self._key(labels)] = value
+
+    def set_function(self, function: Callable[[], float], **labels: str) -> None:
+        self._functions[self._key(labels)] = function
+
+    def samples(self) -> Iterator[Tuple[str, str, float]]:
+        for key, value in list(self._values.items()):
+            yield "", _format_labels(self.labels, key), value
+        for key, function in list(self._functions.items()):
+            try:
+                value = float(function())
+            except Exception:
+                logger.exception("Failed to collect %s", self.name)
+                continue
+            yield "", _format_labels(self.labels, key), value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ) -> None:
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+        # Per label set: non-cumulative bucket counts (the last one is +Inf), sum and count.
+        self._values: Dict[LabelValues, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        entry = self._values.get(key)
+        if entry is None:
+            entry = self._values[key] = ([0] * (len(self.buckets) + 1), [0.0, 0.0])
+        counts, totals = entry
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        totals[0] += value
+        totals[1] += 1
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self) -> Iterator[Tuple[str, str, float]]:
+        names = self.labels + ("le",)
+        for key, (counts, totals) in list(self._values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                yield "_bucket", _format_labels(names, key + (le,)), cumulative
+            yield "_sum", _format_labels(self.labels, key), totals[0]
+            yield "_count", _format_labels(self.labels, key), totals[1]
+
+
+REGISTRY: List[Metric] = []
+
+
+def render_metrics() -> str:
+    """
+    Renders every registered metric in the Prometheus text exposition format (version 0.0.4).
+    """
+    return "\n".join(metric.render() for metric in REGISTRY) + "\n"
+
+
+http_request_seconds = Histogram(
+    "http_request_duration_seconds",
+    "Time from receiving a request to sending the end of its response.",
+    ("method", "route", "status"),
+)
+http_request_db_queries = Histogram(
+    "http_request_db_queries",
+    "Prisma queries issued while handling a request.",
+    ("route",),
+    buckets=(0, 1, 2, 3, 5, 8, 13, 21, 50),
+)
+http_request_db_seconds = Histogram(
+    "http_request_db_seconds",
+    "Time spent waiting on Prisma queries while handling a request.",
+    ("route",),
+)
+db_query_seconds = Histogram(
+    "db_query_duration_seconds",
+    "Latency of individual Prisma queries, by query engine method.",
+    ("method",),
+)
+password_hash_seconds = Histogram(
+    "password_hash_duration_seconds",
+    "Wall time of bcrypt operations, including waiting for a hashing worker.",
+    ("operation",),
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0),
+)
+image_backend_seconds = Histogram(
+    "image_backend_duration_seconds",
+    "Latency of image backend calls, including retries and waiting for a concurrency slot.",
+    ("ai_model", "outcome"),
+)
+image_backend_in_flight = Gauge(
+    "image_backend_in_flight",
+    "Generations holding a backend concurrency slot.",
+    ("ai_model",),
+)
+image_backend_circuit_state = Gauge(
+    "image_backend_circuit_state",
+    "Circuit breaker state of each backend: 0 closed, 1 half-open, 2 open.",
+    ("ai_model",),
+)
+image_backend_hedges = Counter(
+    "image_backend_hedges_total",
+    "Second attempts started because the first one was slower than the hedging percentile.",
+    ("ai_model",),
+)
+image_backend_failovers = Counter(
+    "image_backend_failovers_total",
+    "Generations moved to a substitute model after the requested one failed.",
+    ("from_model", "to_model"),
+)
+image_requests_reaped = Counter(
+    "image_requests_reaped_total",
+    "PROCESSING image requests whose lease expired, by whether they were requeued or failed.",
+    ("action",),
+)
+image_queue_depth = Gauge(
+    "image_queue_depth", "Image requests waiting for a queue worker in this process."
+)
+event_buffer_pending = Gauge(
+    "event_buffer_pending", "Rows buffered for the next batched insert.", ("buffer",)
+)
+event_buffer_dropped = Counter(
+    "event_buffer_dropped_total",
+    "Rows dropped because an event buffer was full or the row could not be written.",
+    ("buffer", "reason"),
+)
+moderation_rejections = Counter(
+    "moderation_rejections_total", "Generation requests rejected by the moderation blocklist."
+)
+startup_phase_seconds = Gauge(
+    "startup_phase_seconds", "Duration of each startup phase of this process.", ("phase",)
+)
+cache_hits = Gauge("cache_hits", "Lookups answered by an in-process cache.", ("cache",))
+cache_misses = Gauge("cache_misses", "Lookups an in-process cache could not answer.", ("cache",))
+cache_hit_ratio = Gauge("cache_hit_ratio", "Hits divided by lookups of an in-process cache.", ("cache",))
+
+
+def register_cache(name: str, cache) -> None:
+    """
+    Exposes the hit/miss counters of a TTLLRUCache under cache="<name>".
+    """
+    cache_hits.set_function(lambda: cache.hits, cache=name)
+    cache_misses.set_function(lambda: cache.misses, cache=name)
+    cache_hit_ratio.set_function(cache.hit_ratio, cache=name)
+
+
+class RequestStats:
+    def __init__(self) -> None:
+        self.db_queries = 0
+        self.db_seconds = 0.0
+
+
+_request_stats: contextvars.ContextVar[Optional[RequestStats]] = contextvars.ContextVar(
+    "request_stats", default=None
+)
+
+
+class InstrumentedPrisma(Prisma):
+    """
+    A Prisma client that times every query and attributes it to the request being handled.
+
+    Queries sent as part of a batch_() transaction go through the engine directly and are not counted.
+    """
+
+    async def _execute(self, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await super()._execute(**kwargs)
+        finally:
+            elapsed = time.perf_counter() - started
+            db_query_seconds.observe(elapsed, method=kwargs.get("method", "unknown"))
+            stats = _request_stats.get()
+            if stats is not None:
+                stats.db_queries += 1
+                stats.db_seconds += elapsed
+
+
+class SamplingProfiler:
+    """
+    Samples the event loop thread's stack at a fixed interval while requests are in flight.
+
+    Samples are kept in a ring buffer with their timestamps, so the stacks seen during a slow
+    request can be written out after the fact. Everything the loop ran in that window is
+    included, which is what matters when one request is slow because another blocked the loop.
+    """
+
+    def __init__(
+        self, interval: float = SLOW_REQUEST_PROFILE_INTERVAL, max_samples: int = 100000
+    ) -> None:
+        self.interval = interval
+        self._samples: deque = deque(maxlen=max_samples)
+        self._active = 0
+        self._target: Optional[int] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    def start(self) -> None:
+        """
+        Starts sampling the calling thread.
+        """
+        if self._thread is not None:
+            return
+        self._target = threading.get_ident()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def begin(self) -> None:
+        self._active += 1
+
+    def end(self) -> None:
+        self._active -= 1
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            if not self._active:
+                continue
+            frame = sys._current_frames().get(self._target)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            if stack:
+                self._samples.append((time.monotonic(), ";".join(reversed(stack))))
+
+    def folded(self, since: float, until: float) -> str:
+        """
+        Returns the stacks sampled between two time.monotonic() values, one "stack count" line each.
+        """
+        counts = StackCounter(
+            stack for at, stack in list(self._samples) if since <= at <= until
+        )
+        return "".join(f"{stack} {count}\n" for stack, count in counts.most_common())
+
+    def dump(self, path: str, since: float, until: float) -> None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(self.folded(since, until))
+
+
+profiler: Optional[SamplingProfiler] = (
+    SamplingProfiler() if SLOW_REQUEST_PROFILE_THRESHOLD else None
+)
+
+
+def start_profiler() -> None:
+    if profiler is not None:
+        profiler.start()
+
+
+def stop_profiler() -> None:
+    if profiler is not None:
+        profiler.stop()
+
+
+class RequestMetricsMiddleware:
+    """
+    Records the latency and database usage of every request by route template, and profiles slow requests when enabled.
+    """
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+        self.threshold = (
+            float(SLOW_REQUEST_PROFILE_THRESHOLD) if SLOW_REQUEST_PROFILE_THRESHOLD else None
+        )
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        status = 500
+
+        async def send_with_status(message: Message) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        stats = RequestStats()
+        token = _request_stats.set(stats)
+        if profiler is not None:
+            profiler.begin()
+        started = time.monotonic()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            ended = time.monotonic()
+            _request_stats.reset(token)
+            if profiler is not None:
+                profiler.end()
+            route = scope.get("route")
+            # Unmatched paths are collapsed so scanners cannot blow up the label cardinality.
+            route_path = route.path if route is not None else "unmatched"
+            http_request_seconds.observe(
+                ended - started, method=scope["method"], route=route_path, status=str(status)
+            )
+            http_request_db_queries.observe(stats.db_queries, route=route_path)
+            http_request_db_seconds.observe(stats.db_seconds, route=route_path)
+            if (
+                profiler is not None
+                and self.threshold is not None
+                and ended - started >= self.threshold
+            ):
+                route_name = route_path.strip("/").replace("/", "_") or "root"
+                name = f"{int(time.time() * 1000)}-{scope['method']}-{route_name}.folded"
+                try:
+                    await asyncio.to_thread(
+                        profiler.dump,
+                        os.path.join(SLOW_REQUEST_PROFILE_DIR, name),
+                        started,
+                        ended,
+                    )
+                except OSError:
+                    logger.exception("Could not write slow request profile")
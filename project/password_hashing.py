@@ -0,0 +1,99 @@
+import asyncio
+import os
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Optional
+
+import bcrypt
+import project.metrics
+
+BCRYPT_ROUNDS = int(os.environ.get("BCRYPT_ROUNDS", "12"))
+PASSWORD_HASH_WORKERS = int(
+    os.environ.get("PASSWORD_HASH_WORKERS", str(min(os.cpu_count() or 1, 8)))
+)
+# "thread" is enough because bcrypt releases the GIL; "process" isolates the work completely.
+PASSWORD_HASH_EXECUTOR = os.environ.get("PASSWORD_HASH_EXECUTOR", "thread")
+
+_executor: Optional[Executor] = None
+
+
+def _hashpw(password: bytes, rounds: int) -> bytes:
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds))
+
+
+def _checkpw(password: bytes, hashed: bytes) -> bool:
+    return bcrypt.checkpw(password, hashed)
+
+
+def get_password_executor() -> Executor:
+    """
+    Returns the executor that runs bcrypt, creating it on first use.
+    """
+    global _executor
+    if _executor is None:
+        if PASSWORD_HASH_EXECUTOR == "process":
+            _executor = ProcessPoolExecutor(max_workers=PASSWORD_HASH_WORKERS)
+        elif PASSWORD_HASH_EXECUTOR == "thread":
+            _executor = ThreadPoolExecutor(
+                max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="bcrypt"
+            )
+        else:
+            raise ValueError(f"Unknown password hash executor: {PASSWORD_HASH_EXECUTOR}")
+    return _executor
+
+
+def shutdown_password_executor() -> None:
+    """
+    Stops the bcrypt workers. A new executor is created if hashing is needed again.
+    """
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+async def hash_password(password: str, rounds: int = BCRYPT_ROUNDS) -> str:
+    """
+    Hashes a password with bcrypt without blocking the event loop.
+
+    Args:
+        password (str): The plain-text password.
+        rounds (int): The bcrypt cost factor.
+
+    Returns:
+        str: The bcrypt hash, including its salt and cost.
+    """
+    with project.metrics.password_hash_seconds.time(operation="hash"):
+        hashed = await asyncio.get_running_loop().run_in_executor(
+            get_password_executor(), _hashpw, password.encode("utf-8"), rounds
+        )
+    return hashed.decode("utf-8")
+
+
+async def verify_password(password: str, hashed: str) -> bool:
+    """
+    Checks a password against a bcrypt hash without blocking the event loop.
+    """
+    with project.metrics.password_hash_seconds.time(operation="verify"):
+        return await asyncio.get_running_loop().run_in_executor(
+            get_password_executor(),
+            _checkpw,
+            password.encode("utf-8"),
+            hashed.encode("utf-8"),
+        )
+
+
+def hash_rounds(hashed: str) -> Optional[int]:
+    """
+    Returns the cost factor encoded in a bcrypt hash ("$2b$12$..."), or None if it cannot be parsed.
+    """
+    parts = hashed.split("$")
+    if len(parts) < 4 or not parts[2].isdigit():
+        return None
+    return int(parts[2])
+
+
+def needs_rehash(hashed: str, rounds: int = BCRYPT_ROUNDS) -> bool:
+    """
+    Tells whether a stored hash uses a different cost factor than the configured one.
+    """
+    return hash_rounds(hashed) != rounds
@@ -0,0 +1,132 @@
+import asyncio
+import logging
+import os
+from typing import Awaitable, Callable, Dict, Optional
+
+import project.metrics
+import project.shared_state
+from project.ttl_lru_cache import TTLLRUCache
+from pydantic import BaseModel
+
+logger = logging.getLogger(__name__)
+
+PROFILE_CACHE_ENTRIES = int(os.environ.get("PROFILE_CACHE_ENTRIES", "50000"))
+PROFILE_CACHE_TTL = float(os.environ.get("PROFILE_CACHE_TTL", "60"))
+
+INVALIDATION_CHANNEL = "profile-cache-invalidate"
+
+
+class ReadThroughCache:
+    """
+    A per-process TTL+LRU cache of pydantic models, optionally backed by a shared state backend.
+
+    Reads try the local LRU, then the shared backend, then the loader. invalidate() removes
+    the key everywhere and broadcasts it, so every worker drops its local copy. Each
+    invalidation also bumps a per-key generation, and a read only caches what it loaded if
+    the generation did not change meanwhile, so a load that started before an update cannot
+    store the old value after it.
+    """
+
+    def __init__(
+        self,
+        namespace: str,
+        model: type,
+        shared: Optional[project.shared_state.SharedStateBackend] = None,
+        max_entries: int = PROFILE_CACHE_ENTRIES,
+        ttl: float = PROFILE_CACHE_TTL,
+    ) -> None:
+        self.namespace = namespace
+        self.model = model
+        self.shared = shared
+        self.ttl = ttl
+        self.local: TTLLRUCache[BaseModel] = TTLLRUCache(max_entries=max_entries, ttl=ttl)
+        project.metrics.register_cache(namespace, self.local)
+        self.shared_hits = 0
+        self._listener: Optional[asyncio.Task] = None
+        # Generations are only kept for keys with a read in progress.
+        self._generations: Dict[str, int] = {}
+        self._reads: Dict[str, int] = {}
+
+    def _bump_generation(self, key: str) -> None:
+        if key in self._generations:
+            self._generations[key] += 1
+
+    def _shared_key(self, key: str) -> str:
+        return f"{self.namespace}:{key}"
+
+    async def get(self, key: str, load: Callable[[], Awaitable[BaseModel]]) -> BaseModel:
+        """
+        Returns the cached value for key, calling load on a miss.
+        """
+        value = self.local.get(key)
+        if value is not None:
+            return value
+        generation = self._generations.setdefault(key, 0)
+        self._reads[key] = self._reads.get(key, 0) + 1
+        try:
+            return await self._read_through(key, load, generation)
+        finally:
+            self._reads[key] -= 1
+            if not self._reads[key]:
+                del self._reads[key]
+                del self._generations[key]
+
+    async def _read_through(
+        self, key: str, load: Callable[[], Awaitable[BaseModel]], generation: int
+    ) -> BaseModel:
+        if self.shared is not None:
+            raw = await self.shared.get(self._shared_key(key))
+            if raw is not None:
+                self.shared_hits += 1
+                value = self.model.model_validate_json(raw)
+                if self._generations[key] == generation:
+                    self.local.set(key, value)
+                return value
+        value = await load()
+        if self._generations[key] != generation:
+            # Invalidated while loading, so the value may predate the change.
+            return value
+        self.local.set(key, value)
+        if self.shared is not None:
+            await self.shared.set(
+                self._shared_key(key), value.model_dump_json().encode("utf-8"), self.ttl
+            )
+        return value
+
+    async def invalidate(self, key: str) -> None:
+        """
+        Drops key from this process, the shared backend and every other worker.
+        """
+        self._bump_generation(key)
+        self.local.delete(key)
+        if self.shared is not None:
+            await self.shared.delete(self._shared_key(key))
+            await self.shared.publish(f"{INVALIDATION_CHANNEL}:{self.namespace}", key)
+
+    async def _listen(self) -> None:
+        async for key in self.shared.subscribe(f"{INVALIDATION_CHANNEL}:{self.namespace}"):
+            self._bump_generation(key)
+            self.local.delete(key)
+
+    def start(self) -> None:
+        """
+        Starts listening for invalidations from other workers.
+        """
+        if self.shared is not None and self._listener is None:
+            self._listener = asyncio.create_task(self._listen())
+
+    async def stop(self) -> None:
+        if self._listener is not None:
+            self._listener.cancel()
+            await asyncio.gather(self._listener, return_exceptions=True)
+            self._listener = None
+
+
+def create_read_through_cache(namespace: str, model: type, **kwargs) -> ReadThroughCache:
+    """
+    Builds a cache that uses the shared state backend only when it is actually shared between processes.
+    """
+    shared = project.shared_state.get_shared_state()
+    return ReadThroughCache(
+        namespace, model, shared=shared if shared.is_shared else None, **kwargs
+    )
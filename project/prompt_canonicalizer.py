@@ -0,0 +1,27 @@
+import re
+import unicodedata
+from typing import List, Optional
+
+# Articles rarely change what gets drawn but often differ between otherwise identical prompts.
+IGNORED_WORDS = frozenset({"a", "an", "the"})
+
+_PUNCTUATION = re.compile(r"[^\w\s]|_")
+
+
+def prompt_tokens(text: Optional[str]) -> List[str]:
+    """
+    Splits a prompt into case-folded, NFKC-normalized words, dropping punctuation and articles.
+    """
+    text = unicodedata.normalize("NFKC", text or "").casefold()
+    return [word for word in _PUNCTUATION.sub(" ", text).split() if word not in IGNORED_WORDS]
+
+
+def canonicalize_prompt(text: Optional[str]) -> str:
+    """
+    Returns the canonical form of a prompt: its words sorted, so prompts differing only in
+    whitespace, casing, punctuation, articles or word order share one cache key.
+
+    Example:
+        canonicalize_prompt("A Red  car, at night!") == canonicalize_prompt("night at red car") == "at car night red"
+    """
+    return " ".join(sorted(prompt_tokens(text)))
@@ -0,0 +1,393 @@
+import asyncio
+import hashlib
+import logging
+import os
+import uuid
+from collections import deque
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import prisma
+import prisma.enums
+import prisma.models
+import project.event_ingestion
+import project.image_request_store
+import project.metrics
+import project.prompt_canonicalizer
+from project.ttl_lru_cache import TTLLRUCache
+from pydantic import BaseModel
+
+logger = logging.getLogger(__name__)
+
+# Text file with one blocked word or phrase per line ("#" starts a comment); re-read when it changes.
+MODERATION_BLOCKLIST_PATH = os.environ.get("MODERATION_BLOCKLIST_PATH", "")
+MODERATION_BLOCKLIST_RELOAD_INTERVAL = float(
+    os.environ.get("MODERATION_BLOCKLIST_RELOAD_INTERVAL", "5")
+)
+MODERATION_VERDICT_CACHE_ENTRIES = int(
+    os.environ.get("MODERATION_VERDICT_CACHE_ENTRIES", "100000")
+)
+MODERATION_VERDICT_CACHE_TTL = float(os.environ.get("MODERATION_VERDICT_CACHE_TTL", "3600"))
+
+MODERATION_REASON = "BLOCKLIST"
+
+
+class ModerationVerdict(BaseModel):
+    """
+    Whether a prompt may be generated, and the blocklist entry that matched if not.
+    """
+
+    allowed: bool
+    term: Optional[str] = None
+
+
+ALLOWED = ModerationVerdict(allowed=True)
+
+
+class PromptRejected(Exception):
+    """
+    Raised when a prompt matches the moderation blocklist.
+
+    The request is recorded as FAILED under request_id by the next flush of
+    moderation_report_buffer, so the id is not in the database yet and is not shown to clients.
+    """
+
+    def __init__(self, request_id: str, term: str) -> None:
+        super().__init__("The prompt was rejected by content moderation")
+        self.request_id = request_id
+        self.term = term
+
+
+class BlocklistMatcher:
+    """
+    An Aho-Corasick automaton over the canonical words of the blocklist terms.
+
+    Terms and prompts are tokenized with project.prompt_canonicalizer.prompt_tokens, so a
+    term only matches whole words, in order, regardless of casing and punctuation. Matching
+    is a single pass over the prompt's words, whatever the number of terms.
+    """
+
+    def __init__(self, terms: Iterable[str]) -> None:
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        # The term ending at a state, or at the longest proper suffix state that ends one.
+        self._output: List[Optional[str]] = [None]
+        self.size = 0
+        for term in terms:
+            self._add(term)
+        self._link()
+
+    def __len__(self) -> int:
+        return self.size
+
+    def _add(self, term: str) -> None:
+        words = project.prompt_canonicalizer.prompt_tokens(term)
+        if not words:
+            return
+        state = 0
+        for word in words:
+            next_state = self._goto[state].get(word)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append(None)
+                self._goto[state][word] = next_state
+            state = next_state
+        if self._output[state] is None:
+            self._output[state] = " ".join(words)
+            self.size += 1
+
+    def _link(self) -> None:
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for word, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fallback = self._fail[state]
+                while fallback and word not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                target = self._goto[fallback].get(word, 0)
+                self._fail[next_state] = target if target != next_state else 0
+                if self._output[next_state] is None:
+                    self._output[next_state] = self._output[self._fail[next_state]]
+
+    def first_match(self, words: List[str]) -> Optional[str]:
+        """
+        Returns the first blocklist term found in a sequence of canonical words, or None.
+        """
+        goto, fail, output = self._goto, self._fail, self._output
+        state = 0
+        for word in words:
+            while state and word not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(word, 0)
+            if output[state] is not None:
+                return output[state]
+        return None
+
+
+def load_blocklist(path: str) -> BlocklistMatcher:
+    """
+    Builds a matcher from a blocklist file.
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        terms = [line.split("#", 1)[0].strip() for line in f]
+    return BlocklistMatcher(term for term in terms if term)
+
+
+class _BlocklistState:
+    matcher = BlocklistMatcher(())
+    # Part of every verdict cache key, so a reload makes verdicts of the previous list unreachable.
+    version = 0
+    file_mtime: Optional[float] = None
+
+
+verdict_cache: TTLLRUCache[ModerationVerdict] = TTLLRUCache(
+    max_entries=MODERATION_VERDICT_CACHE_ENTRIES, ttl=MODERATION_VERDICT_CACHE_TTL
+)
+project.metrics.register_cache("moderation-verdicts", verdict_cache)
+
+_reload_task: Optional[asyncio.Task] = None
+
+
+def prompt_fields_hash(
+    text_description: str,
+    theme: Optional[str],
+    style: Optional[str],
+    customization_options: Optional[Dict[str, str]] = None,
+) -> str:
+    """
+    Hashes every free-text field of a request exactly as submitted; hashing is much cheaper than tokenizing.
+    """
+    fields = [text_description, theme or "", style or ""] + [
+        f"{option}\x1e{value}" for option, value in sorted((customization_options or {}).items())
+    ]
+    return hashlib.blake2b("\x1f".join(fields).encode("utf-8"), digest_size=16).hexdigest()
+
+
+def moderate_prompt(
+    text_description: str,
+    theme: Optional[str],
+    style: Optional[str],
+    customization_options: Optional[Dict[str, str]] = None,
+) -> ModerationVerdict:
+    """
+    Checks the prompt, theme, style and customization options of a request against the blocklist.
+
+    Verdicts are cached by a hash of the fields, so a repeated prompt costs one hash and one
+    dictionary lookup; a new one costs one pass over its words.
+
+    Args:
+        text_description (str): The prompt.
+        theme (Optional[str]): Optional theme preference.
+        style (Optional[str]): Optional style preference.
+        customization_options (Optional[Dict[str, str]]): Optional option/value pairs; both sides are checked.
+
+    Returns:
+        ModerationVerdict: Whether the request may be generated, and the matching term if not.
+    """
+    state = _BlocklistState
+    if not len(state.matcher):
+        return ALLOWED
+    key = (
+        state.version,
+        prompt_fields_hash(text_description, theme, style, customization_options),
+    )
+    verdict = verdict_cache.get(key)
+    if verdict is not None:
+        return verdict
+    verdict = ALLOWED
+    for field in [text_description, theme, style] + [
+        f"{option} {value}" for option, value in (customization_options or {}).items()
+    ]:
+        term = state.matcher.first_match(project.prompt_canonicalizer.prompt_tokens(field))
+        if term is not None:
+            verdict = ModerationVerdict(allowed=False, term=term)
+            break
+    verdict_cache.set(key, verdict)
+    return verdict
+
+
+Rejection = Tuple[Dict[str, Any], Optional[Dict[str, str]], Dict[str, Any]]
+
+
+def add_rejections_to_batch(batcher: Any, rejections: List[Rejection]) -> None:
+    """
+    Adds the FAILED ImageRequests of rejections, their CustOption rows and their ModerationReports to a batch_() transaction.
+    """
+    # The reports reference the requests, so both go through one transaction.
+    project.image_request_store.add_image_requests_to_batch(
+        batcher,
+        [row for row, _, _ in rejections],
+        {row["id"]: options for row, options, _ in rejections if options},
+    )
+    batcher.moderationreport.create_many(data=[report for _, _, report in rejections])
+
+
+async def _write_rejections(batch: List[Rejection]) -> None:
+    async with prisma.get_client().batch_() as batcher:
+        add_rejections_to_batch(batcher, batch)
+
+
+moderation_report_buffer: project.event_ingestion.BatchingBuffer[Rejection] = (
+    project.event_ingestion.BatchingBuffer("ModerationReport", _write_rejections)
+)
+
+
+def build_rejection(
+    user_id: str,
+    text_description: str,
+    ai_model: prisma.enums.AIModel,
+    theme: Optional[str],
+    style: Optional[str],
+    customization_options: Optional[Dict[str, str]],
+    term: str,
+    prompt_hash: Optional[str] = None,
+) -> Rejection:
+    """
+    Builds the FAILED ImageRequest row, its customization options and its ModerationReport for a rejected request.
+    """
+    request_id = str(uuid.uuid4())
+    now = datetime.now()
+    project.metrics.moderation_rejections.inc()
+    return (
+        {
+            "id": request_id,
+            "userId": user_id,
+            "textDescription": text_description,
+            "AIModel": ai_model,
+            "theme": theme,
+            "style": style,
+            "status": prisma.enums.ImageRequestStatus.FAILED,
+            "promptHash": prompt_hash,
+            "claimedAt": now,
+        },
+        customization_options,
+        {
+            "userId": user_id,
+            "reportedAt": now,
+            "reason": MODERATION_REASON,
+            "description": f'Prompt matched blocklist term "{term}"',
+            "imageRequestId": request_id,
+        },
+    )
+
+
+def record_rejection(
+    user_id: str,
+    text_description: str,
+    ai_model: prisma.enums.AIModel,
+    theme: Optional[str],
+    style: Optional[str],
+    customization_options: Optional[Dict[str, str]],
+    term: str,
+    prompt_hash: Optional[str] = None,
+) -> str:
+    """
+    Buffers a FAILED ImageRequest and its ModerationReport for the next batched flush.
+
+    Returns:
+        str: The id the ImageRequest will be stored under once the buffer is flushed.
+    """
+    rejection = build_rejection(
+        user_id,
+        text_description,
+        ai_model,
+        theme,
+        style,
+        customization_options,
+        term,
+        prompt_hash,
+    )
+    moderation_report_buffer.offer(rejection)
+    return rejection[0]["id"]
+
+
+def check_prompt(
+    user_id: str,
+    text_description: str,
+    ai_model: prisma.enums.AIModel,
+    theme: Optional[str],
+    style: Optional[str],
+    customization_options: Optional[Dict[str, str]] = None,
+    prompt_hash: Optional[str] = None,
+) -> None:
+    """
+    Rejects a request that matches the blocklist before it reaches a cache or a backend.
+
+    Raises:
+        PromptRejected: If the request matched; it is buffered to be recorded as FAILED with a ModerationReport.
+    """
+    verdict = moderate_prompt(text_description, theme, style, customization_options)
+    if verdict.allowed:
+        return
+    request_id = record_rejection(
+        user_id,
+        text_description,
+        ai_model,
+        theme,
+        style,
+        customization_options,
+        verdict.term,
+        prompt_hash,
+    )
+    raise PromptRejected(request_id, verdict.term)
+
+
+async def reload_blocklist() -> bool:
+    """
+    Rebuilds the matcher in a worker thread if the blocklist file changed, and swaps it in.
+
+    Returns:
+        bool: Whether a new blocklist was loaded.
+    """
+    state = _BlocklistState
+    try:
+        mtime = os.path.getmtime(MODERATION_BLOCKLIST_PATH)
+    except OSError:
+        mtime = None
+    if mtime == state.file_mtime:
+        return False
+    matcher = (
+        await asyncio.to_thread(load_blocklist, MODERATION_BLOCKLIST_PATH)
+        if mtime is not None
+        else BlocklistMatcher(())
+    )
+    state.matcher = matcher
+    state.version += 1
+    state.file_mtime = mtime
+    logger.info("Loaded a moderation blocklist with %d terms", len(matcher))
+    return True
+
+
+async def _watch_blocklist() -> None:
+    while True:
+        await asyncio.sleep(MODERATION_BLOCKLIST_RELOAD_INTERVAL)
+        try:
+            await reload_blocklist()
+        except Exception:
+            logger.exception("Failed to reload the moderation blocklist")
+
+
+async def start_prompt_moderation() -> None:
+    """
+    Loads the blocklist, watches it for changes and starts the report flusher.
+    """
+    global _reload_task
+    moderation_report_buffer.start()
+    if MODERATION_BLOCKLIST_PATH and _reload_task is None:
+        await reload_blocklist()
+        _reload_task = asyncio.create_task(_watch_blocklist())
+
+
+async def stop_prompt_moderation() -> None:
+    """
+    Stops watching the blocklist and writes every buffered rejection.
+    """
+    global _reload_task
+    if _reload_task is not None:
+        _reload_task.cancel()
+        await asyncio.gather(_reload_task, return_exceptions=True)
+        _reload_task = None
+    await moderation_report_buffer.stop()
@@ -0,0 +1,368 @@
+import asyncio
+import json
+import logging
+import os
+import random
+import zlib
+from collections import OrderedDict
+from typing import Dict, FrozenSet, List, Optional, Set, Tuple
+
+import prisma
+import prisma.enums
+import prisma.models
+import project.image_result_cache
+import project.metrics
+import project.prompt_canonicalizer
+import project.shared_state
+from pydantic import BaseModel
+
+logger = logging.getLogger(__name__)
+
+# "off", "suggest" (attach the closest earlier image to the response) or "serve" (return it
+# instead of generating a new one).
+PROMPT_SIMILARITY_MODE = os.environ.get("PROMPT_SIMILARITY_MODE", "suggest")
+PROMPT_SIMILARITY_THRESHOLD = float(os.environ.get("PROMPT_SIMILARITY_THRESHOLD", "0.8"))
+PROMPT_INDEX_MAX_ENTRIES = int(os.environ.get("PROMPT_INDEX_MAX_ENTRIES", "100000"))
+# Completed requests loaded from the database at startup, newest first.
+PROMPT_INDEX_WARM_ROWS = int(os.environ.get("PROMPT_INDEX_WARM_ROWS", "20000"))
+
+# Completions are published here so every worker's index sees them.
+INDEX_CHANNEL = "prompt-index"
+
+_PRIME = (1 << 31) - 1
+_WARM_PAGE_SIZE = 2000
+
+# Imported on first use, so processes that never query the index do not pay for it at startup.
+_numpy = None
+
+
+def _import_numpy():
+    """
+    Returns the numpy module, or None if it is not installed.
+    """
+    global _numpy
+    if _numpy is None:
+        try:
+            import numpy
+        except ImportError:
+            numpy = False
+        _numpy = numpy
+    return _numpy or None
+
+
+class SimilarImage(BaseModel):
+    """
+    The image of an earlier completed request whose prompt is a near-duplicate of the current one.
+
+    The request may belong to another user, so its id and prompt are not part of it.
+    """
+
+    image_url: str
+    similarity: float
+
+
+def prompt_shingles(text: Optional[str]) -> FrozenSet[str]:
+    """
+    Returns the canonical words of a prompt plus their character trigrams, so plurals and small typos still overlap.
+    """
+    shingles = set()
+    for word in project.prompt_canonicalizer.prompt_tokens(text):
+        shingles.add(word)
+        padded = f"#{word}#"
+        shingles.update(padded[i : i + 3] for i in range(len(padded) - 2))
+    return frozenset(shingles)
+
+
+class _Entry:
+    __slots__ = ("request_id", "image_url", "shingles", "band_keys")
+
+    def __init__(self, request_id, image_url, shingles, band_keys) -> None:
+        self.request_id = request_id
+        self.image_url = image_url
+        self.shingles = shingles
+        self.band_keys = band_keys
+
+
+BandKey = Tuple[str, int, Tuple[int, ...]]
+
+
+class PromptSimilarityIndex:
+    """
+    A MinHash/LSH index of completed prompts, partitioned by model, theme, style and customization options.
+
+    Each prompt's shingle set gets a MinHash signature that is split into bands. Prompts
+    sharing any band with the query are candidates, and a candidate matches if the exact
+    Jaccard similarity of the shingle sets reaches the threshold. Signatures are computed
+    with NumPy when it is installed and in pure Python otherwise.
+    """
+
+    def __init__(
+        self,
+        threshold: float = PROMPT_SIMILARITY_THRESHOLD,
+        max_entries: int = PROMPT_INDEX_MAX_ENTRIES,
+        num_permutations: int = 64,
+        bands: int = 16,
+        seed: int = 1,
+    ) -> None:
+        if num_permutations % bands:
+            raise ValueError("num_permutations must be a multiple of bands")
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.bands = bands
+        self.rows = num_permutations // bands
+        rng = random.Random(seed)
+        self._a = [rng.randrange(1, _PRIME) for _ in range(num_permutations)]
+        self._b = [rng.randrange(0, _PRIME) for _ in range(num_permutations)]
+        self._np_a = self._np_b = None
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._buckets: Dict[BandKey, Set[str]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def hit_ratio(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def _signature(self, shingles: FrozenSet[str]) -> List[int]:
+        hashes = [zlib.crc32(shingle.encode("utf-8")) % _PRIME for shingle in shingles]
+        numpy = _import_numpy()
+        if numpy is not None:
+            if self._np_a is None:
+                self._np_a = numpy.array(self._a, dtype=numpy.uint64)[:, None]
+                self._np_b = numpy.array(self._b, dtype=numpy.uint64)[:, None]
+            # a, b and the hashes are below 2**31, so a * h + b fits in 64 bits.
+            values = numpy.array(hashes, dtype=numpy.uint64)[None, :]
+            return ((self._np_a * values + self._np_b) % _PRIME).min(axis=1).tolist()
+        return [min((a * h + b) % _PRIME for h in hashes) for a, b in zip(self._a, self._b)]
+
+    def _band_keys(self, context: str, shingles: FrozenSet[str]) -> List[BandKey]:
+        signature = self._signature(shingles)
+        return [
+            (context, band, tuple(signature[band * self.rows : (band + 1) * self.rows]))
+            for band in range(self.bands)
+        ]
+
+    @staticmethod
+    def _context(
+        ai_model: prisma.enums.AIModel,
+        theme: Optional[str],
+        style: Optional[str],
+        customization_options: Optional[Dict[str, str]],
+    ) -> str:
+        return project.image_result_cache.result_cache_key(
+            "", ai_model, theme, style, customization_options
+        )
+
+    def add(
+        self,
+        request_id: str,
+        image_url: str,
+        text_description: str,
+        ai_model: prisma.enums.AIModel,
+        theme: Optional[str],
+        style: Optional[str],
+        customization_options: Optional[Dict[str, str]] = None,
+    ) -> None:
+        """
+        Indexes a completed request, evicting the oldest entries beyond max_entries.
+        """
+        shingles = prompt_shingles(text_description)
+        if not shingles or request_id in self._entries:
+            return
+        band_keys = self._band_keys(
+            self._context(ai_model, theme, style, customization_options), shingles
+        )
+        self._entries[request_id] = _Entry(request_id, image_url, shingles, band_keys)
+        for key in band_keys:
+            self._buckets.setdefault(key, set()).add(request_id)
+        while len(self._entries) > self.max_entries:
+            _, evicted = self._entries.popitem(last=False)
+            for key in evicted.band_keys:
+                bucket = self._buckets.get(key)
+                if bucket is not None:
+                    bucket.discard(evicted.request_id)
+                    if not bucket:
+                        del self._buckets[key]
+
+    def query(
+        self,
+        text_description: str,
+        ai_model: prisma.enums.AIModel,
+        theme: Optional[str],
+        style: Optional[str],
+        customization_options: Optional[Dict[str, str]] = None,
+    ) -> Optional[SimilarImage]:
+        """
+        Returns the most similar indexed request with the same model, theme, style and options, if it reaches the threshold.
+        """
+        shingles = prompt_shingles(text_description)
+        best: Optional[SimilarImage] = None
+        if shingles:
+            context = self._context(ai_model, theme, style, customization_options)
+            candidates: Set[str] = set()
+            for key in self._band_keys(context, shingles):
+                candidates.update(self._buckets.get(key, ()))
+            for request_id in candidates:
+                entry = self._entries[request_id]
+                similarity = len(shingles & entry.shingles) / len(shingles | entry.shingles)
+                if similarity >= self.threshold and (
+                    best is None or similarity > best.similarity
+                ):
+                    best = SimilarImage(
+                        image_url=entry.image_url,
+                        similarity=round(similarity, 4),
+                    )
+        if best is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return best
+
+    async def load_recent(self, limit: int = PROMPT_INDEX_WARM_ROWS) -> int:
+        """
+        Indexes the most recent completed requests, a page at a time so the event loop stays responsive.
+        """
+        loaded = 0
+        cursor: Optional[str] = None
+        pages = []
+        while loaded < limit:
+            page = await prisma.models.ImageRequest.prisma().find_many(
+                where={
+                    "status": prisma.enums.ImageRequestStatus.COMPLETED,
+                    "imageUrl": {"not": None},
+                },
+                include={"customizationOptions": True},
+                order=[{"createdAt": "desc"}, {"id": "desc"}],
+                take=min(_WARM_PAGE_SIZE, limit - loaded),
+                **({"cursor": {"id": cursor}, "skip": 1} if cursor else {}),
+            )
+            if not page:
+                break
+            pages.append(page)
+            loaded += len(page)
+            cursor = page[-1].id
+        # Oldest first, so the newest requests are the last to be evicted.
+        rows = [row for page in reversed(pages) for row in reversed(page)]
+        for i, row in enumerate(rows):
+            if i % 200 == 0:
+                await asyncio.sleep(0)
+            self.add(
+                row.id,
+                row.imageUrl,
+                row.textDescription,
+                row.AIModel,
+                row.theme,
+                row.style,
+                {option.option: option.value for option in row.customizationOptions or []},
+            )
+        return loaded
+
+
+prompt_similarity_index = PromptSimilarityIndex()
+project.metrics.register_cache("prompt-similarity", prompt_similarity_index)
+
+_warm_task: Optional[asyncio.Task] = None
+_listener: Optional[asyncio.Task] = None
+
+
+def find_similar_image(
+    text_description: str,
+    ai_model: prisma.enums.AIModel,
+    theme: Optional[str],
+    style: Optional[str],
+    customization_options: Optional[Dict[str, str]] = None,
+) -> Optional[SimilarImage]:
+    """
+    Looks up a near-duplicate of the request unless PROMPT_SIMILARITY_MODE is "off".
+    """
+    if PROMPT_SIMILARITY_MODE == "off":
+        return None
+    return prompt_similarity_index.query(
+        text_description, ai_model, theme, style, customization_options
+    )
+
+
+async def record_completed_image(
+    request_id: str,
+    image_url: str,
+    text_description: str,
+    ai_model: prisma.enums.AIModel,
+    theme: Optional[str],
+    style: Optional[str],
+    customization_options: Optional[Dict[str, str]] = None,
+) -> None:
+    """
+    Adds a freshly completed request to the index, and to the other workers' indexes when the shared state backend is shared.
+    """
+    if PROMPT_SIMILARITY_MODE == "off":
+        return
+    prompt_similarity_index.add(
+        request_id, image_url, text_description, ai_model, theme, style, customization_options
+    )
+    shared = project.shared_state.get_shared_state()
+    if shared.is_shared:
+        await shared.publish(
+            INDEX_CHANNEL,
+            json.dumps(
+                {
+                    "request_id": request_id,
+                    "image_url": image_url,
+                    "text_description": text_description,
+                    "ai_model": prisma.enums.AIModel(ai_model).value,
+                    "theme": theme,
+                    "style": style,
+                    "customization_options": customization_options,
+                }
+            ),
+        )
+
+
+async def _listen() -> None:
+    async for message in project.shared_state.get_shared_state().subscribe(INDEX_CHANNEL):
+        try:
+            entry = json.loads(message)
+            # add() ignores requests that are already indexed, including this worker's own.
+            prompt_similarity_index.add(
+                entry["request_id"],
+                entry["image_url"],
+                entry["text_description"],
+                prisma.enums.AIModel(entry["ai_model"]),
+                entry["theme"],
+                entry["style"],
+                entry["customization_options"],
+            )
+        except (KeyError, ValueError):
+            logger.warning("Ignoring malformed prompt index message")
+
+
+async def _warm() -> None:
+    try:
+        loaded = await prompt_similarity_index.load_recent()
+        logger.info("Prompt similarity index warmed with %d requests", loaded)
+    except Exception:
+        logger.exception("Failed to warm the prompt similarity index")
+
+
+def start_prompt_similarity_index() -> None:
+    """
+    Loads recent completed requests into the index in the background, and follows the completions of other workers.
+    """
+    global _warm_task, _listener
+    if PROMPT_SIMILARITY_MODE == "off":
+        return
+    if _warm_task is None and PROMPT_INDEX_WARM_ROWS > 0:
+        _warm_task = asyncio.create_task(_warm())
+    if _listener is None and project.shared_state.get_shared_state().is_shared:
+        _listener = asyncio.create_task(_listen())
+
+
+async def stop_prompt_similarity_index() -> None:
+    global _warm_task, _listener
+    for task in (_warm_task, _listener):
+        if task is not None:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+    _warm_task = _listener = None
@@ -0,0 +1,121 @@
+from typing import Mapping, Optional, Tuple
+
+import anyio
+from starlette.responses import Response
+from starlette.types import Receive, Scope, Send
+
+
+def parse_range(range_header: str, size: int) -> Optional[Tuple[int, int]]:
+    """
+    Parses a single-range "bytes=" header into a [start, end) pair.
+
+    Returns None if the range cannot be satisfied. Multi-range requests are answered
+    with the whole file, which RFC 9110 allows, so they come back as (0, size), as do
+    invalid ranges such as bytes=5-2, which RFC 9110 says to ignore.
+    """
+    unit, _, spec = range_header.partition("=")
+    if unit.strip() != "bytes" or "," in spec:
+        return 0, size
+    first, _, last = spec.strip().partition("-")
+    try:
+        if not first:
+            suffix = int(last)
+            if suffix <= 0:
+                return None
+            return max(size - suffix, 0), size
+        start = int(first)
+        if last and int(last) < start:
+            # Syntactically invalid (RFC 9110 section 14.1.1), so the header is ignored.
+            return 0, size
+        end = min(int(last) + 1, size) if last else size
+    except ValueError:
+        return 0, size
+    if start >= size:
+        return None
+    return start, end
+
+
+class RangeFileResponse(Response):
+    """
+    Serves a file with Range, If-Range and HEAD support.
+
+    The body goes out through the ASGI zero-copy send extension (sendfile) when the
+    server offers it, and in fixed-size chunks read off the event loop otherwise.
+    """
+
+    chunk_size = 64 * 1024
+
+    def __init__(
+        self,
+        path: str,
+        size: int,
+        media_type: str,
+        etag: str,
+        range_header: Optional[str] = None,
+        if_range: Optional[str] = None,
+        headers: Optional[Mapping[str, str]] = None,
+    ) -> None:
+        self.path = path
+        self.media_type = media_type
+        self.background = None
+        self.start, self.end = 0, size
+        self.status_code = 200
+        if range_header and (if_range is None or if_range == etag):
+            byte_range = parse_range(range_header, size)
+            if byte_range is None:
+                self.status_code = 416
+                self.start = self.end = 0
+            elif byte_range != (0, size):
+                self.status_code = 206
+                self.start, self.end = byte_range
+        self.init_headers(headers)
+        self.headers["etag"] = etag
+        self.headers["accept-ranges"] = "bytes"
+        self.headers["content-length"] = str(self.end - self.start)
+        if self.status_code == 206:
+            self.headers["content-range"] = f"bytes {self.start}-{self.end - 1}/{size}"
+        elif self.status_code == 416:
+            self.headers["content-range"] = f"bytes */{size}"
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        await send(
+            {
+                "type": "http.response.start",
+                "status": self.status_code,
+                "headers": self.raw_headers,
+            }
+        )
+        count = self.end - self.start
+        if scope["method"] == "HEAD" or count == 0:
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+            return
+        if "http.response.zerocopysend" in scope.get("extensions", {}):
+            with open(self.path, "rb") as f:
+                await send(
+                    {
+                        "type": "http.response.zerocopysend",
+                        "file": f,
+                        "offset": self.start,
+                        "count": count,
+                        "more_body": False,
+                    }
+                )
+            return
+        async with await anyio.open_file(self.path, "rb") as f:
+            await f.seek(self.start)
+            remaining = count
+            while remaining > 0:
+                chunk = await f.read(min(self.chunk_size, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                await send(
+                    {
+                        "type": "http.response.body",
+                        "body": chunk,
+                        "more_body": remaining > 0,
+                    }
+                )
+            if remaining > 0:
+                # The file shrank underneath us; end the response rather than hang.
+                await send({"type": "http.response.body", "body": b"", "more_body": False})
@@ -0,0 +1,192 @@
+import asyncio
+import math
+import os
+from datetime import datetime
+from typing import Dict, Optional
+
+import prisma
+import prisma.enums
+import prisma.models
+import project.profile_cache
+import project.session_tokens
+import project.shared_state
+from fastapi import Depends, HTTPException
+from pydantic import BaseModel
+
+USER_PLAN_CACHE_TTL = float(os.environ.get("USER_PLAN_CACHE_TTL", "300"))
+
+# (images per minute, burst, scheduler weight); a rate of None means unlimited.
+DEFAULT_PLAN_QUOTAS = {
+    "FREE": (5, 5, 1),
+    "BASIC": (20, 10, 2),
+    "PREMIUM": (60, 30, 4),
+    "ADMIN": (None, 0, 4),
+}
+
+
+class GenerationQuota(BaseModel):
+    """
+    How many images a plan may request and how much of the worker pool it gets under contention.
+    """
+
+    per_minute: Optional[float] = None
+    burst: int
+    weight: float
+
+
+def _quota(plan: str) -> GenerationQuota:
+    """
+    Reads RATE_LIMIT_<PLAN>_{PER_MINUTE,BURST,WEIGHT}, falling back to DEFAULT_PLAN_QUOTAS.
+    """
+    per_minute, burst, weight = DEFAULT_PLAN_QUOTAS[plan]
+    per_minute = os.environ.get(f"RATE_LIMIT_{plan}_PER_MINUTE", per_minute)
+    return GenerationQuota(
+        per_minute=float(per_minute) if per_minute not in (None, "") else None,
+        burst=int(os.environ.get(f"RATE_LIMIT_{plan}_BURST", burst)),
+        weight=float(os.environ.get(f"RATE_LIMIT_{plan}_WEIGHT", weight)),
+    )
+
+
+PLAN_QUOTAS: Dict[str, GenerationQuota] = {plan: _quota(plan) for plan in DEFAULT_PLAN_QUOTAS}
+
+
+class UserPlan(BaseModel):
+    """
+    The role and active subscription tier of a user, which select their generation quota.
+    """
+
+    user_id: str
+    role: prisma.enums.UserRole
+    tier: Optional[prisma.enums.SubscriptionTier] = None
+
+    @property
+    def name(self) -> str:
+        if self.role == prisma.enums.UserRole.ADMIN:
+            return "ADMIN"
+        if self.tier is not None:
+            return prisma.enums.SubscriptionTier(self.tier).value
+        return "FREE"
+
+    @property
+    def quota(self) -> GenerationQuota:
+        return PLAN_QUOTAS[self.name]
+
+
+class RateLimitExceeded(Exception):
+    """
+    Raised when a user has used up their generation quota for now.
+    """
+
+    def __init__(self, plan: UserPlan, retry_after: float) -> None:
+        super().__init__(
+            f"Generation rate limit of the {plan.name} plan exceeded; retry in {retry_after:.1f}s"
+        )
+        self.plan = plan
+        self.retry_after = retry_after
+
+
+user_plan_cache = project.profile_cache.create_read_through_cache(
+    "user-plan", UserPlan, ttl=USER_PLAN_CACHE_TTL
+)
+
+
+async def _load_user_plan(user_id: str) -> UserPlan:
+    user = await prisma.models.User.prisma().find_unique(
+        where={"id": user_id},
+        include={
+            "Subscription": {
+                "where": {"expiresAt": {"gt": datetime.now()}},
+                # PREMIUM sorts after BASIC in the enum, so the best active tier comes first.
+                "order_by": {"tier": "desc"},
+                "take": 1,
+            }
+        },
+    )
+    if not user:
+        raise ValueError("User not found")
+    return UserPlan(
+        user_id=user.id,
+        role=user.role,
+        tier=user.Subscription[0].tier if user.Subscription else None,
+    )
+
+
+async def get_user_plan(user_id: str) -> UserPlan:
+    """
+    Returns the plan of a user from the read-through cache, so checking a quota does not query the database.
+    """
+    return await user_plan_cache.get(user_id, lambda: _load_user_plan(user_id))
+
+
+async def acquire_generation_tokens(user_id: str, cost: int = 1) -> UserPlan:
+    """
+    Charges cost image generations against the user's token bucket.
+
+    Buckets live in the shared state backend, so the limit holds across workers when it is
+    Redis-backed and per process otherwise.
+
+    Args:
+        user_id (str): The user requesting the images.
+        cost (int): The number of images requested.
+
+    Returns:
+        UserPlan: The plan of the user, whose quota.weight the scheduler uses.
+
+    Raises:
+        RateLimitExceeded: If the bucket does not hold enough tokens.
+        ValueError: If cost exceeds the burst of the plan, so it could never be granted.
+    """
+    plan = await get_user_plan(user_id)
+    quota = plan.quota
+    if quota.per_minute is None:
+        return plan
+    if cost > quota.burst:
+        raise ValueError(
+            f"The {plan.name} plan allows at most {quota.burst} images per request"
+        )
+    retry_after = await project.shared_state.get_shared_state().take_token(
+        f"rate-limit:generate:{user_id}", quota.per_minute / 60, quota.burst, cost
+    )
+    if retry_after > 0:
+        raise RateLimitExceeded(plan, retry_after)
+    return plan
+
+
+async def wait_for_generation_token(user_id: str) -> None:
+    """
+    Charges one image against the user's token bucket, waiting for it to refill when it is empty.
+
+    Batches charge their prompts this way one at a time, so a batch larger than the burst
+    of the plan runs at the plan's rate instead of being refused.
+
+    Raises:
+        ValueError: If the plan's burst is 0, so no image could ever be granted.
+    """
+    while True:
+        try:
+            await acquire_generation_tokens(user_id)
+            return
+        except RateLimitExceeded as e:
+            await asyncio.sleep(e.retry_after)
+
+
+def rate_limit_response(e: RateLimitExceeded) -> HTTPException:
+    return HTTPException(
+        status_code=429,
+        detail=str(e),
+        headers={"Retry-After": str(math.ceil(e.retry_after))},
+    )
+
+
+async def limit_generation(
+    session: project.session_tokens.SessionClaims = Depends(
+        project.session_tokens.require_session
+    ),
+) -> UserPlan:
+    """
+    FastAPI dependency charging one image to the caller; responds 429 with Retry-After when the quota is used up.
+    """
+    try:
+        return await acquire_generation_tokens(session.sub)
+    except RateLimitExceeded as e:
+        raise rate_limit_response(e)
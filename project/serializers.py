@@ -0,0 +1,47 @@
+import json
+from typing import Any, Mapping, Optional
+
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def dumps(content: Any) -> bytes:
+    """
+    Encodes JSON-compatible data with orjson when it is installed, and the standard library otherwise.
+    """
+    if orjson is not None:
+        return orjson.dumps(content)
+    return json.dumps(content, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+class ModelResponse(JSONResponse):
+    """
+    A JSON response rendered directly by the pydantic model's compiled serializer.
+
+    When an endpoint returns a model, FastAPI validates it again against response_model and
+    walks it with jsonable_encoder before encoding it. Returning a ModelResponse skips both
+    steps; the route's response_model still documents the schema. Content that is not a
+    model is encoded with dumps().
+    """
+
+    def __init__(
+        self,
+        content: Any,
+        status_code: int = 200,
+        headers: Optional[Mapping[str, str]] = None,
+        exclude_unset: bool = False,
+    ) -> None:
+        self.exclude_unset = exclude_unset
+        super().__init__(content, status_code=status_code, headers=headers)
+
+    def render(self, content: Any) -> bytes:
+        if isinstance(content, BaseModel):
+            return content.__pydantic_serializer__.to_json(
+                content, exclude_unset=self.exclude_unset
+            )
+        return dumps(content)
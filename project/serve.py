@@ -0,0 +1,99 @@
+"""
+Runs the app with one or more uvicorn worker processes:
+
+    python -m project.serve --workers 4 --host 0.0.0.0 --port 8000
+
+Each worker is a separate process with its own event loop, Prisma query engine and
+in-process caches. The workers share state through SHARED_STATE_BACKEND, the job queue
+through IMAGE_QUEUE_BACKEND, the result cache through IMAGE_RESULT_CACHE_TIER2 and
+progress events through IMAGE_EVENTS_FANOUT; with the single-process defaults each worker
+only sees its own. The database connections of every worker together are bounded by
+DATABASE_MAX_CONNECTIONS (see project.database).
+"""
+
+import argparse
+import logging
+import os
+import sys
+
+import uvicorn
+
+logger = logging.getLogger(__name__)
+
+# Settings that only cover the process they run in, with the value that does and what breaks otherwise.
+PROCESS_LOCAL_SETTINGS = {
+    "SHARED_STATE_BACKEND": (
+        "memory",
+        "redis",
+        "rate limits are per worker and a logout only revokes the token in the worker that handled it",
+    ),
+    "IMAGE_QUEUE_BACKEND": (
+        "local",
+        "postgres",
+        "queued requests are only run by the worker that accepted them",
+    ),
+    "IMAGE_RESULT_CACHE_TIER2": (
+        "none",
+        "postgres",
+        "identical requests are only deduplicated within a worker",
+    ),
+    "IMAGE_EVENTS_FANOUT": (
+        "none",
+        "postgres",
+        "progress events only reach clients connected to the worker that generates the image",
+    ),
+}
+
+
+def check_multi_worker_settings(workers: int) -> None:
+    """
+    Refuses to start several workers without a common session secret, and warns about state that will not be shared.
+
+    Raises:
+        SystemExit: If workers > 1 and SESSION_SECRET is unset, since each worker would reject the others' tokens.
+    """
+    if workers <= 1:
+        return
+    if not os.environ.get("SESSION_SECRET"):
+        raise SystemExit("SESSION_SECRET must be set when running more than one worker")
+    for name, (local, shared, consequence) in PROCESS_LOCAL_SETTINGS.items():
+        if os.environ.get(name, local) == local:
+            logger.warning(
+                "%s=%s is per worker, so %s; set it to %s to share it between the %d workers",
+                name,
+                local,
+                consequence,
+                shared,
+                workers,
+            )
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=int(os.environ.get("WEB_CONCURRENCY", "1")),
+        help="Worker processes (default: WEB_CONCURRENCY or 1)",
+    )
+    parser.add_argument("--host", default=os.environ.get("HOST", "127.0.0.1"))
+    parser.add_argument("--port", type=int, default=int(os.environ.get("PORT", "8000")))
+    parser.add_argument("--log-level", default="info")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=args.log_level.upper(), format="%(levelname)s:     %(message)s")
+
+    workers = max(1, args.workers)
+    check_multi_worker_settings(workers)
+    # Read by project.database in every worker to split DATABASE_MAX_CONNECTIONS between them.
+    os.environ["WEB_CONCURRENCY"] = str(workers)
+    uvicorn.run(
+        "project.server:app",
+        host=args.host,
+        port=args.port,
+        workers=workers,
+        log_level=args.log_level,
+    )
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,31 +1,114 @@
 import logging
+import time
 from contextlib import asynccontextmanager
-from typing import Optional
+from typing import Dict, Optional
 
 import prisma
 import prisma.enums
+import project.bulk_delete_user_accounts_service
 import project.create_user_account_service
+import project.database
 import project.delete_user_account_service
+import project.event_ingestion
+import project.export_users_service
+import project.generate_image_batch_service
 import project.generate_image_service
+import project.generation_accounting
+import project.get_image_request_service
 import project.get_user_profile_service
+import project.image_backends
+import project.image_events
+import project.image_job_queue
+import project.image_postprocessing
+import project.image_storage
 import project.list_ai_models_service
+import project.list_user_images_service
+import project.metrics
+import project.password_hashing
+import project.prompt_moderation
+import project.prompt_similarity_index
+import project.range_response
+import project.rate_limiting
+import project.serializers
+import project.session_tokens
+import project.shared_state
+import project.startup
 import project.update_user_profile_service
 import project.user_login_service
 import project.user_logout_service
-from fastapi import FastAPI
+from fastapi import (
+    Depends,
+    FastAPI,
+    Header,
+    HTTPException,
+    Request,
+    WebSocket,
+    WebSocketDisconnect,
+)
 from fastapi.encoders import jsonable_encoder
-from fastapi.responses import Response
+from fastapi.responses import Response, StreamingResponse
 from prisma import Prisma
+from starlette.datastructures import Headers
+from starlette.types import ASGIApp, Receive, Scope, Send
 
 logger = logging.getLogger(__name__)
 
-db_client = Prisma(auto_register=True)
+MAX_IDEMPOTENCY_KEY_LENGTH = 255
+
+db_client = project.metrics.InstrumentedPrisma(
+    auto_register=True, **project.database.client_options()
+)
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    project.startup.startup_timer.mark("import")
     await db_client.connect()
+    project.startup.startup_timer.mark("connect")
+    await project.startup.warm_up_database(db_client)
+    for ai_model in project.image_backends.available_ai_models():
+        project.image_backends.get_backend(ai_model)
+    await project.image_postprocessing.start_image_processing()
+    project.startup.startup_timer.mark("warmup")
+    project.metrics.start_profiler()
+    project.list_ai_models_service.get_ai_models_catalogue()
+    image_worker_pool = project.image_job_queue.ImageWorkerPool(
+        project.image_job_queue.get_image_job_queue(),
+        project.generate_image_service.process_image_request,
+    )
+    image_worker_pool.start()
+    project.event_ingestion.start_event_ingestion()
+    project.generation_accounting.start_generation_accounting()
+    project.get_user_profile_service.user_profile_cache.start()
+    project.rate_limiting.user_plan_cache.start()
+    project.session_tokens.start_session_revocations()
+    await project.image_events.image_event_hub.start()
+    project.image_job_queue.start_lease_reaper()
+    project.prompt_similarity_index.start_prompt_similarity_index()
+    await project.prompt_moderation.start_prompt_moderation()
+    project.startup.startup_timer.mark("start")
+    logger.info(
+        "Ready %.3fs after import (%s)",
+        project.startup.startup_timer.total(),
+        project.startup.startup_timer.report(),
+    )
     yield
+    await project.prompt_moderation.stop_prompt_moderation()
+    await project.image_events.image_event_hub.stop()
+    await project.prompt_similarity_index.stop_prompt_similarity_index()
+    await project.get_user_profile_service.user_profile_cache.stop()
+    await project.rate_limiting.user_plan_cache.stop()
+    await project.session_tokens.stop_session_revocations()
+    await project.image_job_queue.stop_lease_reaper()
+    await image_worker_pool.stop()
+    project.generation_accounting.stop_generation_accounting()
+    await project.event_ingestion.stop_event_ingestion()
+    await project.image_backends.close_backends()
+    await project.image_storage.close_image_storage()
+    await project.image_postprocessing.close_image_processing()
+    project.password_hashing.shutdown_password_executor()
+    await project.shared_state.close_shared_state()
+    project.metrics.stop_profiler()
     await db_client.disconnect()
 
 
@@ -36,6 +119,48 @@ app = FastAPI(
 )
 
 
+class AccessLogMiddleware:
+    """
+    Buffers an AccessLog row for every request; rows are written in batches by event_ingestion.
+
+    A plain ASGI middleware rather than @app.middleware("http"), so responses keep using
+    server extensions such as zero-copy file sends.
+    """
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            response_time_ms = int((time.perf_counter() - started) * 1000)
+            route = scope.get("route")
+            user_id = None
+            authorization = Headers(scope=scope).get("authorization", "")
+            if authorization.lower().startswith("bearer "):
+                try:
+                    user_id = project.session_tokens.verify_session_token(
+                        authorization[7:]
+                    ).sub
+                except project.session_tokens.InvalidSessionToken:
+                    pass
+            project.event_ingestion.record_access(
+                route.path if route is not None else scope["path"],
+                scope["method"],
+                user_id,
+                response_time_ms,
+            )
+
+
+app.add_middleware(AccessLogMiddleware)
+app.add_middleware(project.metrics.RequestMetricsMiddleware)
+
+
 @app.post("/auth/login/", response_model=project.user_login_service.UserLoginResponse)
 async def api_post_user_login(
     email: str, password: str
@@ -45,7 +170,7 @@ async def api_post_user_login(
     """
     try:
         res = await project.user_login_service.user_login(email, password)
-        return res
+        return project.serializers.ModelResponse(res)
     except Exception as e:
         logger.exception("Error processing request")
         res = dict()
@@ -58,13 +183,27 @@ async def api_post_user_login(
 
 
 @app.get("/ai/models/", response_model=project.list_ai_models_service.ListModelResponse)
-async def api_get_list_ai_models() -> project.list_ai_models_service.ListModelResponse | Response:
+async def api_get_list_ai_models(request: Request) -> Response:
     """
     Provides a list of available AI models for image generation.
+
+    The catalogue is served as pre-serialized bytes with a strong ETag; a matching
+    If-None-Match gets an empty 304.
     """
     try:
-        res = await project.list_ai_models_service.list_ai_models()
-        return res
+        catalogue = project.list_ai_models_service.get_ai_models_catalogue()
+        headers = {
+            "ETag": catalogue.etag,
+            "Cache-Control": project.list_ai_models_service.AI_MODELS_CACHE_CONTROL,
+        }
+        if_none_match = request.headers.get("if-none-match", "")
+        if catalogue.etag in [tag.strip() for tag in if_none_match.split(",")] or (
+            if_none_match.strip() == "*"
+        ):
+            return Response(status_code=304, headers=headers)
+        return Response(
+            content=catalogue.body, media_type="application/json", headers=headers
+        )
     except Exception as e:
         logger.exception("Error processing request")
         res = dict()
@@ -126,13 +265,103 @@ async def api_delete_delete_user_account(
         )
 
 
+@app.post(
+    "/admin/users/delete",
+    response_model=project.bulk_delete_user_accounts_service.BulkDeleteUsersResponse,
+)
+async def api_post_bulk_delete_user_accounts(
+    request: project.bulk_delete_user_accounts_service.BulkDeleteUsersRequest,
+    session: project.session_tokens.SessionClaims = Depends(
+        project.session_tokens.require_admin
+    ),
+) -> project.bulk_delete_user_accounts_service.BulkDeleteUsersResponse | Response:
+    """
+    Deletes many user accounts in one transaction and reports the outcome for each id. Admins only.
+    """
+    try:
+        res = await project.bulk_delete_user_accounts_service.bulk_delete_user_accounts(
+            request.ids
+        )
+        return res
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.exception("Error processing request")
+        res = dict()
+        res["error"] = str(e)
+        return Response(
+            content=jsonable_encoder(res),
+            status_code=500,
+            media_type="application/json",
+        )
+
+
+@app.get("/admin/users/export")
+async def api_get_export_users(
+    format: project.export_users_service.ExportFormat = project.export_users_service.ExportFormat.NDJSON,
+    session: project.session_tokens.SessionClaims = Depends(
+        project.session_tokens.require_admin
+    ),
+) -> StreamingResponse:
+    """
+    Streams every user with their profile and image request count as NDJSON or CSV. Admins only.
+    """
+    media_type = (
+        "text/csv"
+        if format == project.export_users_service.ExportFormat.CSV
+        else "application/x-ndjson"
+    )
+    return StreamingResponse(
+        project.export_users_service.export_users(format),
+        media_type=media_type,
+        headers={
+            "Content-Disposition": f'attachment; filename="users.{format.value}"'
+        },
+    )
+
+
+@app.get(
+    "/admin/capacity",
+    response_model=project.generation_accounting.CapacityReport,
+)
+async def api_get_capacity_report(
+    window_minutes: int = 60,
+    source: project.generation_accounting.CapacitySource = project.generation_accounting.CapacitySource.CLUSTER,
+    session: project.session_tokens.SessionClaims = Depends(
+        project.session_tokens.require_admin
+    ),
+) -> project.generation_accounting.CapacityReport | Response:
+    """
+    Reports sustained and peak images per minute, backend latency and the concurrency they imply for each model. Admins only.
+
+    source=cluster (the default) combines the rollups persisted by every worker;
+    source=worker reads this worker's live in-memory aggregates.
+    """
+    try:
+        res = await project.generation_accounting.get_capacity_report(window_minutes, source)
+        return project.serializers.ModelResponse(res)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.exception("Error processing request")
+        res = dict()
+        res["error"] = str(e)
+        return Response(
+            content=jsonable_encoder(res),
+            status_code=500,
+            media_type="application/json",
+        )
+
+
 @app.post("/auth/logout/", response_model=project.user_logout_service.LogoutResponse)
-async def api_post_user_logout() -> project.user_logout_service.LogoutResponse | Response:
+async def api_post_user_logout(
+    session_token: str = Depends(project.session_tokens.get_session_token),
+) -> project.user_logout_service.LogoutResponse | Response:
     """
     Terminates an authenticated session.
     """
     try:
-        res = await project.user_logout_service.user_logout()
+        res = await project.user_logout_service.user_logout(session_token)
         return res
     except Exception as e:
         logger.exception("Error processing request")
@@ -157,7 +386,7 @@ async def api_put_update_user_profile(
     """
     try:
         res = await project.update_user_profile_service.update_user_profile(
-            firstName, lastName, id, email, bio
+            id, email, firstName, lastName, bio
         )
         return res
     except Exception as e:
@@ -183,7 +412,7 @@ async def api_get_get_user_profile(
     """
     try:
         res = await project.get_user_profile_service.get_user_profile(id)
-        return res
+        return project.serializers.ModelResponse(res)
     except Exception as e:
         logger.exception("Error processing request")
         res = dict()
@@ -204,15 +433,145 @@ async def api_post_generate_image(
     ai_model: prisma.enums.AIModel,
     theme: Optional[str],
     style: Optional[str],
+    queued: bool = False,
+    customization_options: Optional[Dict[str, str]] = None,
+    allow_substitution: bool = False,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
+    session: project.session_tokens.SessionClaims = Depends(
+        project.session_tokens.require_session
+    ),
 ) -> project.generate_image_service.GenerateImageResponse | Response:
     """
     Generates an image based on user input using the selected AI model.
+
+    With queued=true the request is handed to the worker pool and its id is returned
+    immediately; poll GET /image/{id} for the result. Requests count against the rate
+    limit of the caller's plan and get 429 once it is used up. Prompts matching the
+    moderation blocklist get 422; the FAILED request recorded for them is written in bulk
+    afterwards, so its id is not returned.
+    With allow_substitution=true a synchronous request may be served by the failover model
+    configured for the selected one; ai_model_used names the model that produced the image.
+    The width, height, crop, format and quality customization options are applied to the
+    generated image (400 if invalid or if the server lacks Pillow and numpy), and plans in
+    IMAGE_WATERMARK_PLANS get a watermark (503 if the server cannot apply it).
+    A request repeated with the same Idempotency-Key header returns the request the key
+    first created, in its current state, instead of generating again and without counting
+    against the rate limit; reusing a key for a different request gets 422.
     """
+    if idempotency_key is not None and not 1 <= len(idempotency_key) <= MAX_IDEMPOTENCY_KEY_LENGTH:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Idempotency-Key must be 1 to {MAX_IDEMPOTENCY_KEY_LENGTH} characters",
+        )
+    plan = await project.rate_limiting.get_user_plan(session.sub)
     try:
-        res = await project.generate_image_service.generate_image(
-            text_description, ai_model, theme, style
+        customization_options = project.image_postprocessing.apply_plan_options(
+            customization_options, plan.name
         )
-        return res
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except project.image_postprocessing.PostProcessingUnavailable as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    try:
+        if idempotency_key is not None:
+            replay = await project.generate_image_service.replay_idempotent_request(
+                plan.user_id,
+                idempotency_key,
+                text_description,
+                ai_model,
+                theme,
+                style,
+                customization_options,
+            )
+            if replay is not None:
+                return project.serializers.ModelResponse(replay)
+        await project.rate_limiting.acquire_generation_tokens(plan.user_id)
+        if queued:
+            res = await project.generate_image_service.enqueue_generate_image(
+                plan.user_id,
+                text_description,
+                ai_model,
+                theme,
+                style,
+                customization_options,
+                weight=plan.quota.weight,
+                idempotency_key=idempotency_key,
+            )
+        else:
+            res = await project.generate_image_service.generate_image(
+                plan.user_id,
+                text_description,
+                ai_model,
+                theme,
+                style,
+                customization_options,
+                allow_substitution=allow_substitution,
+                idempotency_key=idempotency_key,
+            )
+        return project.serializers.ModelResponse(res)
+    except project.rate_limiting.RateLimitExceeded as e:
+        raise project.rate_limiting.rate_limit_response(e)
+    except project.prompt_moderation.PromptRejected as e:
+        raise HTTPException(status_code=422, detail={"error": str(e)})
+    except project.generate_image_service.IdempotencyKeyReused as e:
+        raise HTTPException(
+            status_code=422, detail={"error": str(e), "request_id": e.request_id}
+        )
+    except Exception as e:
+        logger.exception("Error processing request")
+        res = dict()
+        res["error"] = str(e)
+        return Response(
+            content=jsonable_encoder(res),
+            status_code=500,
+            media_type="application/json",
+        )
+
+
+async def authorize_image_request(
+    id: str,
+    session: project.session_tokens.SessionClaims,
+    allow_served: bool = False,
+) -> None:
+    """
+    Lets admins and the owner of an image request through; answers 404 for an unknown request and 403 otherwise.
+
+    Args:
+        id (str): The id of the ImageRequest.
+        session (SessionClaims): The caller.
+        allow_served (bool): Also let through users who were served this request's image.
+    """
+    if session.role == prisma.enums.UserRole.ADMIN:
+        return
+    owner = await project.get_image_request_service.get_image_request_owner(id)
+    if owner is None:
+        raise HTTPException(status_code=404, detail="Image request not found")
+    if owner == session.sub:
+        return
+    if allow_served and await project.get_image_request_service.was_served_image(
+        id, session.sub
+    ):
+        return
+    raise HTTPException(status_code=403, detail="Not allowed")
+
+
+@app.get(
+    "/image/{id}",
+    response_model=project.get_image_request_service.ImageRequestStatusResponse,
+)
+async def api_get_get_image_request(
+    id: str,
+    session: project.session_tokens.SessionClaims = Depends(
+        project.session_tokens.require_session
+    ),
+) -> project.get_image_request_service.ImageRequestStatusResponse | Response:
+    """
+    Retrieves the status of an image request. Only its owner and admins may see it.
+    """
+    await authorize_image_request(id, session)
+    try:
+        res = await project.get_image_request_service.get_image_request(id)
+        return project.serializers.ModelResponse(res)
     except Exception as e:
         logger.exception("Error processing request")
         res = dict()
@@ -222,3 +581,237 @@ async def api_post_generate_image(
             status_code=500,
             media_type="application/json",
         )
+
+
+@app.post("/image/generate/batch")
+async def api_post_generate_image_batch(
+    request: project.generate_image_batch_service.GenerateImageBatchRequest,
+    session: project.session_tokens.SessionClaims = Depends(
+        project.session_tokens.require_session
+    ),
+) -> Response:
+    """
+    Generates images for many prompts in one call, streaming one NDJSON line per prompt as soon as it finishes.
+
+    Every prompt that is generated counts against the rate limit of the caller's plan. It is
+    charged when its generation starts, so a batch larger than the plan's burst is paced at
+    the plan's rate rather than refused. An empty batch, or one with more than
+    IMAGE_BATCH_MAX_PROMPTS prompts, gets 400.
+    """
+    try:
+        plan = await project.rate_limiting.get_user_plan(session.sub)
+        for prompt in request.prompts:
+            prompt.customization_options = project.image_postprocessing.apply_plan_options(
+                prompt.customization_options, plan.name
+            )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except project.image_postprocessing.PostProcessingUnavailable as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    try:
+        batch = await project.generate_image_batch_service.start_image_batch(
+            session.sub, request.prompts, rate_limited=True
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.exception("Error processing request")
+        res = dict()
+        res["error"] = str(e)
+        return Response(
+            content=jsonable_encoder(res),
+            status_code=500,
+            media_type="application/json",
+        )
+
+    async def stream_results():
+        async for item in batch.results():
+            yield item.model_dump_json() + "\n"
+
+    return StreamingResponse(stream_results(), media_type="application/x-ndjson")
+
+
+@app.get(
+    "/user/{id}/images",
+    response_model=project.list_user_images_service.UserImagesResponse,
+    response_model_exclude_unset=True,
+)
+async def api_get_list_user_images(
+    id: str,
+    limit: int = 50,
+    cursor: Optional[str] = None,
+    status: Optional[prisma.enums.ImageRequestStatus] = None,
+    ai_model: Optional[prisma.enums.AIModel] = None,
+    fields: Optional[str] = None,
+    session: project.session_tokens.SessionClaims = Depends(
+        project.session_tokens.require_session
+    ),
+) -> project.list_user_images_service.UserImagesResponse | Response:
+    """
+    Lists a user's past image requests, newest first, one cursor page at a time.
+
+    fields is a comma-separated list of columns to return, e.g. "status,imageUrl". An
+    invalid cursor, an out-of-range limit or an unknown field gets 400.
+    """
+    if session.sub != id and session.role != prisma.enums.UserRole.ADMIN:
+        raise HTTPException(status_code=403, detail="Not allowed")
+    try:
+        res = await project.list_user_images_service.list_user_images(
+            id,
+            limit,
+            cursor,
+            status,
+            ai_model,
+            [field.strip() for field in fields.split(",")] if fields else None,
+        )
+        return project.serializers.ModelResponse(res, exclude_unset=True)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.exception("Error processing request")
+        res = dict()
+        res["error"] = str(e)
+        return Response(
+            content=jsonable_encoder(res),
+            status_code=500,
+            media_type="application/json",
+        )
+
+
+@app.api_route("/image/{id}/file", methods=["GET", "HEAD"])
+async def api_get_image_file(
+    id: str,
+    request: Request,
+    variant: str = project.image_storage.ORIGINAL,
+    session: project.session_tokens.SessionClaims = Depends(
+        project.session_tokens.require_session
+    ),
+) -> Response:
+    """
+    Serves the stored image of a request, or its "thumbnail" or "webp" variant, with ETag and Range support.
+
+    Besides the owner and admins, users whose own request was answered with this image
+    (a result cache or near-duplicate hit) may fetch it.
+    """
+    await authorize_image_request(id, session, allow_served=True)
+    try:
+        blob = await project.image_storage.open_image(id, variant)
+        if blob is None:
+            raise HTTPException(status_code=404, detail="Image file not found")
+        headers = {"Cache-Control": "private, max-age=31536000, immutable"}
+        if request.headers.get("if-none-match") == blob.etag:
+            return Response(status_code=304, headers={**headers, "ETag": blob.etag})
+        if blob.path is None:
+            return StreamingResponse(
+                project.image_storage.get_blob_store().read(blob.key),
+                media_type=blob.content_type,
+                headers={**headers, "ETag": blob.etag},
+            )
+        return project.range_response.RangeFileResponse(
+            blob.path,
+            blob.size,
+            blob.content_type,
+            blob.etag,
+            range_header=request.headers.get("range"),
+            if_range=request.headers.get("if-range"),
+            headers=headers,
+        )
+    except HTTPException:
+        raise
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.exception("Error processing request")
+        res = dict()
+        res["error"] = str(e)
+        return Response(
+            content=jsonable_encoder(res),
+            status_code=500,
+            media_type="application/json",
+        )
+
+
+@app.get("/image/{id}/events")
+async def api_get_stream_image_request(
+    id: str,
+    session: project.session_tokens.SessionClaims = Depends(
+        project.session_tokens.require_session
+    ),
+) -> Response:
+    """
+    Streams the status transitions and preview frames of an image request as Server-Sent Events, ending once it is COMPLETED or FAILED.
+    """
+    await authorize_image_request(id, session)
+    try:
+        events = project.get_image_request_service.stream_image_request(id)
+        first = await anext(events)
+    except Exception as e:
+        logger.exception("Error processing request")
+        res = dict()
+        res["error"] = str(e)
+        return Response(
+            content=jsonable_encoder(res),
+            status_code=500,
+            media_type="application/json",
+        )
+
+    async def stream_events():
+        event = first
+        while True:
+            if event is None:
+                yield ": keepalive\n\n"
+            else:
+                yield f"event: {event.status.value}\ndata: {event.model_dump_json()}\n\n"
+            try:
+                event = await anext(events)
+            except StopAsyncIteration:
+                return
+
+    return StreamingResponse(
+        stream_events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.websocket("/image/{id}/ws")
+async def api_websocket_stream_image_request(websocket: WebSocket, id: str) -> None:
+    """
+    Same events as GET /image/{id}/events, sent as JSON messages over a WebSocket.
+
+    The session token goes in the Authorization header or the token query parameter; the
+    handshake is refused with 1008 without a valid one or for another user's request.
+    """
+    try:
+        session = await project.session_tokens.authenticate_websocket(websocket)
+        await authorize_image_request(id, session)
+    except (project.session_tokens.InvalidSessionToken, HTTPException):
+        await websocket.close(code=1008)
+        return
+    await websocket.accept()
+    events = project.get_image_request_service.stream_image_request(id)
+    try:
+        async for event in events:
+            if event is None:
+                await websocket.send_json({"keepalive": True})
+            else:
+                await websocket.send_text(event.model_dump_json())
+        await websocket.close()
+    except WebSocketDisconnect:
+        pass
+    except Exception as e:
+        logger.exception("Error processing request")
+        await websocket.close(code=1011, reason=str(e)[:120])
+    finally:
+        await events.aclose()
+
+
+@app.get("/metrics")
+async def api_get_metrics() -> Response:
+    """
+    Exposes request latency, database, bcrypt, backend, queue and cache metrics in the Prometheus text format.
+    """
+    return Response(
+        content=project.metrics.render_metrics(),
+        media_type="text/plain; version=0.0.4",
+    )
@@ -0,0 +1,295 @@
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import os
+import secrets
+import time
+from typing import Dict, Optional, Tuple
+
+import prisma
+import prisma.enums
+import project.metrics
+import project.shared_state
+from fastapi import Depends, HTTPException, WebSocket
+from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
+from project.ttl_lru_cache import TTLLRUCache
+from pydantic import BaseModel
+
+logger = logging.getLogger(__name__)
+
+SESSION_TTL = int(os.environ.get("SESSION_TTL", str(24 * 60 * 60)))
+SESSION_VERIFIED_CACHE_ENTRIES = int(
+    os.environ.get("SESSION_VERIFIED_CACHE_ENTRIES", "100000")
+)
+SESSION_VERIFIED_CACHE_TTL = float(os.environ.get("SESSION_VERIFIED_CACHE_TTL", "300"))
+SESSION_SECRET = os.environ.get("SESSION_SECRET", "")
+if not SESSION_SECRET:
+    logger.warning(
+        "SESSION_SECRET is not set; using a random per-process secret, "
+        "so tokens will not survive restarts or work across workers"
+    )
+    SESSION_SECRET = secrets.token_hex(32)
+
+# Revocations are published here so the other workers add them to their denylists.
+REVOCATION_CHANNEL = "session-revocations"
+
+
+class SessionClaims(BaseModel):
+    """
+    The verified contents of a session token.
+    """
+
+    sub: str
+    role: prisma.enums.UserRole
+    jti: str
+    exp: int
+
+
+class InvalidSessionToken(ValueError):
+    """
+    Raised when a token is malformed, has a bad signature, has expired or has been revoked.
+    """
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+def _b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+def _sign(payload: str) -> str:
+    digest = hmac.new(
+        SESSION_SECRET.encode("utf-8"), payload.encode("utf-8"), hashlib.sha256
+    ).digest()
+    return _b64encode(digest)
+
+
+class RevokedTokenDenylist:
+    """
+    The ids (jti) of revoked tokens that have not expired yet. Membership checks are a dict lookup;
+    entries are dropped once the token would have expired anyway, which keeps the list small.
+    """
+
+    def __init__(self) -> None:
+        self._revoked: Dict[str, int] = {}
+        self._next_purge = 0.0
+
+    def __contains__(self, jti: str) -> bool:
+        return jti in self._revoked
+
+    def __len__(self) -> int:
+        return len(self._revoked)
+
+    def add(self, jti: str, exp: int) -> None:
+        self._revoked[jti] = exp
+        self.purge()
+
+    def purge(self) -> None:
+        now = time.time()
+        if now < self._next_purge:
+            return
+        self._next_purge = now + 60
+        self._revoked = {jti: exp for jti, exp in self._revoked.items() if exp > now}
+
+
+revoked_tokens = RevokedTokenDenylist()
+verified_tokens: TTLLRUCache[SessionClaims] = TTLLRUCache(
+    max_entries=SESSION_VERIFIED_CACHE_ENTRIES, ttl=SESSION_VERIFIED_CACHE_TTL
+)
+project.metrics.register_cache("verified-session-tokens", verified_tokens)
+
+
+def issue_session_token(
+    user_id: str, role: prisma.enums.UserRole, ttl: int = SESSION_TTL
+) -> str:
+    """
+    Creates a signed session token for a user.
+
+    Args:
+        user_id (str): The id of the authenticated user.
+        role (prisma.enums.UserRole): The user's role, embedded so authorization checks need no DB lookup.
+        ttl (int): Lifetime of the token in seconds.
+
+    Returns:
+        str: "<payload>.<signature>", both base64url encoded.
+    """
+    claims = SessionClaims(
+        sub=user_id, role=role, jti=secrets.token_hex(16), exp=int(time.time()) + ttl
+    )
+    payload = _b64encode(
+        json.dumps(claims.model_dump(mode="json"), separators=(",", ":")).encode("utf-8")
+    )
+    return f"{payload}.{_sign(payload)}"
+
+
+def _revoked_key(jti: str) -> str:
+    return f"session-revoked:{jti}"
+
+
+def verify_session_token(token: str) -> SessionClaims:
+    """
+    Returns the claims of a valid token.
+
+    Recently verified tokens are served from an in-process LRU, so the HMAC is only computed
+    once per token and cache period. The denylist is consulted on every call.
+
+    Raises:
+        InvalidSessionToken: If the token is malformed, forged, expired or revoked.
+    """
+    return _verify(token)[0]
+
+
+def _verify(token: str) -> Tuple[SessionClaims, bool]:
+    """
+    Returns the claims of a valid token and whether they came from the verified-token cache.
+    """
+    claims = verified_tokens.get(token)
+    cached = claims is not None
+    if claims is None:
+        payload, _, signature = token.partition(".")
+        if not signature or not hmac.compare_digest(_sign(payload), signature):
+            raise InvalidSessionToken("Invalid session token")
+        try:
+            claims = SessionClaims(**json.loads(_b64decode(payload)))
+        except ValueError:
+            raise InvalidSessionToken("Invalid session token")
+        if claims.exp > time.time():
+            verified_tokens.set(
+                token,
+                claims,
+                ttl=min(SESSION_VERIFIED_CACHE_TTL, claims.exp - time.time()),
+            )
+    if claims.exp <= time.time():
+        raise InvalidSessionToken("Session token has expired")
+    if claims.jti in revoked_tokens:
+        raise InvalidSessionToken("Session token has been revoked")
+    return claims, cached
+
+
+async def authenticate_session_token(token: str) -> SessionClaims:
+    """
+    Like verify_session_token, but also honours revocations made by other workers before this one started.
+
+    Revocations made while this worker runs reach its denylist through REVOCATION_CHANNEL.
+    Older ones are looked up in the shared backend whenever a token is not in the
+    verified-token cache, so that costs one lookup per token and cache period, not one per request.
+
+    Raises:
+        InvalidSessionToken: If the token is malformed, forged, expired or revoked.
+    """
+    claims, cached = _verify(token)
+    shared_state = project.shared_state.get_shared_state()
+    if (
+        not cached
+        and shared_state.is_shared
+        and await shared_state.get(_revoked_key(claims.jti)) is not None
+    ):
+        revoked_tokens.add(claims.jti, claims.exp)
+        verified_tokens.delete(token)
+        raise InvalidSessionToken("Session token has been revoked")
+    return claims
+
+
+async def revoke_session_token(token: str) -> SessionClaims:
+    """
+    Invalidates a token for the rest of its lifetime, in every worker when SHARED_STATE_BACKEND is shared.
+    """
+    claims = verify_session_token(token)
+    revoked_tokens.add(claims.jti, claims.exp)
+    verified_tokens.delete(token)
+    shared_state = project.shared_state.get_shared_state()
+    if shared_state.is_shared:
+        await shared_state.set(
+            _revoked_key(claims.jti), b"1", ttl=max(claims.exp - time.time(), 1)
+        )
+        await shared_state.publish(
+            REVOCATION_CHANNEL, json.dumps({"jti": claims.jti, "exp": claims.exp})
+        )
+    return claims
+
+
+async def _listen() -> None:
+    async for message in project.shared_state.get_shared_state().subscribe(REVOCATION_CHANNEL):
+        try:
+            revocation = json.loads(message)
+            # The denylist is checked after the verified-token cache, so cached entries of the token are rejected too.
+            revoked_tokens.add(revocation["jti"], int(revocation["exp"]))
+        except (KeyError, ValueError):
+            logger.warning("Ignoring malformed session revocation message")
+
+
+_listener: Optional[asyncio.Task] = None
+
+
+def start_session_revocations() -> None:
+    """
+    Follows the logouts handled by other workers, if the shared state backend is shared.
+    """
+    global _listener
+    if _listener is None and project.shared_state.get_shared_state().is_shared:
+        _listener = asyncio.create_task(_listen())
+
+
+async def stop_session_revocations() -> None:
+    global _listener
+    if _listener is not None:
+        _listener.cancel()
+        await asyncio.gather(_listener, return_exceptions=True)
+        _listener = None
+
+
+_bearer = HTTPBearer(auto_error=False)
+
+
+async def get_session_token(
+    credentials: Optional[HTTPAuthorizationCredentials] = Depends(_bearer),
+) -> str:
+    """
+    FastAPI dependency returning the bearer token of a request after checking it is valid.
+    """
+    if credentials is None:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    try:
+        await authenticate_session_token(credentials.credentials)
+    except InvalidSessionToken as e:
+        raise HTTPException(status_code=401, detail=str(e))
+    return credentials.credentials
+
+
+async def require_session(token: str = Depends(get_session_token)) -> SessionClaims:
+    """
+    FastAPI dependency returning the claims of the authenticated caller; responds 401 otherwise.
+    """
+    return verify_session_token(token)
+
+
+async def authenticate_websocket(websocket: WebSocket) -> SessionClaims:
+    """
+    Returns the claims of a WebSocket client.
+
+    Browsers cannot set headers on a WebSocket handshake, so the token may be sent as the
+    token query parameter instead of a bearer Authorization header.
+
+    Raises:
+        InvalidSessionToken: If there is no token, or it is not valid.
+    """
+    scheme, _, token = websocket.headers.get("authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        token = websocket.query_params.get("token", "")
+    if not token:
+        raise InvalidSessionToken("Not authenticated")
+    return await authenticate_session_token(token)
+
+
+async def require_admin(session: SessionClaims = Depends(require_session)) -> SessionClaims:
+    """
+    FastAPI dependency like require_session that also responds 403 unless the caller is an ADMIN.
+    """
+    if session.role != prisma.enums.UserRole.ADMIN:
+        raise HTTPException(status_code=403, detail="Not allowed")
+    return session
@@ -0,0 +1,221 @@
+import asyncio
+import logging
+import os
+import time
+from abc import ABC, abstractmethod
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+from project.ttl_lru_cache import TTLLRUCache
+
+logger = logging.getLogger(__name__)
+
+# "memory" keeps everything inside this process; "redis" shares it between uvicorn workers.
+SHARED_STATE_BACKEND = os.environ.get("SHARED_STATE_BACKEND", "memory")
+REDIS_URL = os.environ.get("REDIS_URL", "redis://localhost:6379/0")
+
+
+class SharedStateBackend(ABC):
+    """
+    A key/value store with expiry plus a broadcast channel, used to keep per-process caches coherent across workers.
+    """
+
+    @abstractmethod
+    async def get(self, key: str) -> Optional[bytes]:
+        pass
+
+    @abstractmethod
+    async def set(self, key: str, value: bytes, ttl: Optional[float] = None) -> None:
+        pass
+
+    @abstractmethod
+    async def delete(self, key: str) -> None:
+        pass
+
+    @abstractmethod
+    async def take_token(
+        self, key: str, rate: float, burst: float, cost: float = 1.0
+    ) -> float:
+        """
+        Atomically takes cost tokens from the token bucket at key, which refills at rate tokens
+        per second up to burst. Returns 0 if they were taken, otherwise the seconds until they
+        will be available.
+        """
+
+    @abstractmethod
+    async def publish(self, channel: str, message: str) -> None:
+        """
+        Delivers a message to every subscriber of the channel, in every process sharing the backend.
+        """
+
+    @abstractmethod
+    def subscribe(self, channel: str) -> AsyncIterator[str]:
+        """
+        Yields the messages published on a channel from now on.
+        """
+
+    @property
+    def is_shared(self) -> bool:
+        """
+        Whether other processes see the same state.
+        """
+        return True
+
+    async def aclose(self) -> None:
+        pass
+
+
+class InMemorySharedState(SharedStateBackend):
+    """
+    Single-process implementation; only coherent when the app runs with one worker.
+    """
+
+    def __init__(self, max_entries: int = 100000) -> None:
+        self._values: TTLLRUCache[bytes] = TTLLRUCache(max_entries=max_entries, ttl=None)
+        self._buckets: TTLLRUCache[Tuple[float, float]] = TTLLRUCache(
+            max_entries=max_entries, ttl=None
+        )
+        self._subscribers: Dict[str, List[asyncio.Queue]] = {}
+
+    @property
+    def is_shared(self) -> bool:
+        return False
+
+    async def get(self, key: str) -> Optional[bytes]:
+        return self._values.get(key)
+
+    async def set(self, key: str, value: bytes, ttl: Optional[float] = None) -> None:
+        self._values.set(key, value, ttl=ttl)
+
+    async def delete(self, key: str) -> None:
+        self._values.delete(key)
+
+    async def take_token(
+        self, key: str, rate: float, burst: float, cost: float = 1.0
+    ) -> float:
+        now = time.monotonic()
+        tokens, updated = self._buckets.get(key) or (burst, now)
+        tokens = min(burst, tokens + (now - updated) * rate)
+        wait = 0.0
+        if tokens >= cost:
+            tokens -= cost
+        else:
+            wait = (cost - tokens) / rate
+        # A bucket that has been idle long enough to refill is the same as a missing one.
+        self._buckets.set(key, (tokens, now), ttl=burst / rate)
+        return wait
+
+    async def publish(self, channel: str, message: str) -> None:
+        for queue in self._subscribers.get(channel, []):
+            queue.put_nowait(message)
+
+    async def subscribe(self, channel: str) -> AsyncIterator[str]:
+        queue: asyncio.Queue = asyncio.Queue()
+        self._subscribers.setdefault(channel, []).append(queue)
+        try:
+            while True:
+                yield await queue.get()
+        finally:
+            self._subscribers[channel].remove(queue)
+
+
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(bucket[1]) or burst
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(now - updated, 0) * rate)
+local wait = 0
+if tokens >= cost then
+    tokens = tokens - cost
+else
+    wait = (cost - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000))
+return tostring(wait)
+"""
+
+
+class RedisSharedState(SharedStateBackend):
+    """
+    Redis implementation. Requires the `redis` package, which is not installed by default.
+    """
+
+    def __init__(self, url: str = REDIS_URL, prefix: str = "image-maker:") -> None:
+        try:
+            import redis.asyncio
+        except ImportError as e:
+            raise RuntimeError(
+                "SHARED_STATE_BACKEND=redis requires the 'redis' package"
+            ) from e
+        self.prefix = prefix
+        self.client = redis.asyncio.Redis.from_url(url)
+        self._take_token = self.client.register_script(TOKEN_BUCKET_SCRIPT)
+
+    async def get(self, key: str) -> Optional[bytes]:
+        return await self.client.get(self.prefix + key)
+
+    async def set(self, key: str, value: bytes, ttl: Optional[float] = None) -> None:
+        await self.client.set(
+            self.prefix + key, value, px=int(ttl * 1000) if ttl is not None else None
+        )
+
+    async def delete(self, key: str) -> None:
+        await self.client.delete(self.prefix + key)
+
+    async def take_token(
+        self, key: str, rate: float, burst: float, cost: float = 1.0
+    ) -> float:
+        # Runs as one Lua script on the server, so concurrent workers cannot overdraw the bucket.
+        wait = await self._take_token(keys=[self.prefix + key], args=[rate, burst, cost])
+        return float(wait)
+
+    async def publish(self, channel: str, message: str) -> None:
+        await self.client.publish(self.prefix + channel, message)
+
+    async def subscribe(self, channel: str) -> AsyncIterator[str]:
+        pubsub = self.client.pubsub()
+        await pubsub.subscribe(self.prefix + channel)
+        try:
+            async for message in pubsub.listen():
+                if message["type"] == "message":
+                    data = message["data"]
+                    yield data.decode("utf-8") if isinstance(data, bytes) else data
+        finally:
+            await pubsub.unsubscribe(self.prefix + channel)
+            await pubsub.aclose()
+
+    async def aclose(self) -> None:
+        await self.client.aclose()
+
+
+def create_shared_state(backend: str = SHARED_STATE_BACKEND) -> SharedStateBackend:
+    if backend == "memory":
+        return InMemorySharedState()
+    if backend == "redis":
+        return RedisSharedState()
+    raise ValueError(f"Unknown shared state backend: {backend}")
+
+
+_shared_state: Optional[SharedStateBackend] = None
+
+
+def get_shared_state() -> SharedStateBackend:
+    """
+    Returns the process-wide shared state backend selected by SHARED_STATE_BACKEND.
+    """
+    global _shared_state
+    if _shared_state is None:
+        _shared_state = create_shared_state()
+    return _shared_state
+
+
+async def close_shared_state() -> None:
+    global _shared_state
+    if _shared_state is not None:
+        await _shared_state.aclose()
+        _shared_state = None
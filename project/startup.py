@@ -0,0 +1,124 @@
+"""
+Startup timing and the import-time report.
+
+Run `python -m project.startup` to see which modules dominate the import of project.server:
+
+    python -m project.startup --top 20
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+from typing import Dict, List
+
+import prisma
+import prisma.models
+import project
+import project.metrics
+
+logger = logging.getLogger(__name__)
+
+# Concurrent trivial queries run at startup to open that many query engine connections.
+DATABASE_WARMUP_CONNECTIONS = int(os.environ.get("DATABASE_WARMUP_CONNECTIONS", "4"))
+
+
+class StartupTimer:
+    """
+    Records how long each startup phase took, from the import of the project package until the app is ready.
+    """
+
+    def __init__(self, started: float) -> None:
+        self.started = started
+        self.phases: Dict[str, float] = {}
+        self._last = started
+
+    def mark(self, phase: str) -> None:
+        """
+        Ends a phase that started when the previous one ended.
+        """
+        now = time.perf_counter()
+        self.phases[phase] = now - self._last
+        self._last = now
+        project.metrics.startup_phase_seconds.set(self.phases[phase], phase=phase)
+
+    def total(self) -> float:
+        return self._last - self.started
+
+    def report(self) -> str:
+        return ", ".join(f"{phase} {seconds:.3f}s" for phase, seconds in self.phases.items())
+
+
+startup_timer = StartupTimer(project.IMPORT_STARTED)
+
+
+async def warm_up_database(client: prisma.Prisma, connections: int = DATABASE_WARMUP_CONNECTIONS) -> None:
+    """
+    Pays the query engine's first-request costs before traffic arrives.
+
+    Concurrent trivial queries open up to `connections` pooled connections, and lookups of
+    a missing id exercise the hottest read paths once, so the engine has built their queries.
+    """
+    await asyncio.gather(*(client.query_raw("SELECT 1") for _ in range(connections)))
+    await prisma.models.User.prisma().find_unique(where={"id": ""}, include={"profiles": True})
+    await prisma.models.ImageRequest.prisma().find_unique(
+        where={"id": ""}, include={"customizationOptions": True}
+    )
+
+
+def import_time_report(module: str = "project.server") -> List[dict]:
+    """
+    Imports a module in a fresh interpreter with -X importtime and returns one entry per imported module.
+
+    Returns:
+        List[dict]: name, self_ms and cumulative_ms of every module, in import order.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    entries = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:") :].split("|")
+        if not self_us.strip().isdigit():
+            continue
+        entries.append(
+            {
+                "name": name.strip(),
+                "self_ms": int(self_us) / 1000,
+                "cumulative_ms": int(cumulative_us) / 1000,
+            }
+        )
+    return entries
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--module", default="project.server")
+    parser.add_argument("--top", type=int, default=25)
+    args = parser.parse_args()
+    entries = import_time_report(args.module)
+    top_level = [entry for entry in entries if entry["name"] == args.module]
+    print(
+        json.dumps(
+            {
+                "module": args.module,
+                "total_ms": top_level[-1]["cumulative_ms"] if top_level else None,
+                "by_self_time": sorted(entries, key=lambda entry: -entry["self_ms"])[: args.top],
+                "by_cumulative_time": sorted(entries, key=lambda entry: -entry["cumulative_ms"])[: args.top],
+            },
+            indent=2,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
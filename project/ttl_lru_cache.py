@@ -0,0 +1,91 @@
+import time
+from collections import OrderedDict
+from typing import Callable, Generic, Hashable, Optional, Tuple, TypeVar
+
+V = TypeVar("V")
+
+
+class TTLLRUCache(Generic[V]):
+    """
+    A bounded in-memory LRU cache whose entries also expire after a fixed time to live.
+
+    Entries are evicted least-recently-used first once either max_entries or max_size
+    (measured with size_of, e.g. bytes) is exceeded. Not thread-safe; it is meant to be
+    used from the event loop.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 1024,
+        ttl: Optional[float] = 300.0,
+        max_size: Optional[int] = None,
+        size_of: Callable[[V], int] = lambda value: 1,
+    ) -> None:
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_size = max_size
+        self.size_of = size_of
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._entries: "OrderedDict[Hashable, Tuple[float, int, V]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable) -> Optional[V]:
+        """
+        Returns the cached value and marks it as recently used, or None on a miss.
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, _, value = entry
+        if expires_at < time.monotonic():
+            self._remove(key)
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: V, ttl: Optional[float] = None) -> None:
+        """
+        Stores a value, evicting the least recently used entries if the cache is over its limits.
+        """
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.monotonic() + ttl if ttl is not None else float("inf")
+        if key in self._entries:
+            self._remove(key)
+        size = self.size_of(value)
+        self._entries[key] = (expires_at, size, value)
+        self.size += size
+        while len(self._entries) > self.max_entries or (
+            self.max_size is not None and self.size > self.max_size and len(self._entries) > 1
+        ):
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def delete(self, key: Hashable) -> None:
+        """
+        Removes a key if present.
+        """
+        if key in self._entries:
+            self._remove(key)
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self.size = 0
+
+    def hit_ratio(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def _remove(self, key: Hashable) -> None:
+        _, size, _ = self._entries.pop(key)
+        self.size -= size
@@ -3,6 +3,7 @@ from typing import Optional
 
 import prisma
 import prisma.models
+import project.get_user_profile_service
 from pydantic import BaseModel
 
 
@@ -34,21 +35,35 @@ async def update_user_profile(
 
     Returns:
     UserProfileUpdateResponse: The response model for the update user profile endpoint. It contains the updated information of the user profile to confirm the changes applied.
+
+    Raises:
+    ValueError: If there is no user with this id.
     """
-    await prisma.models.User.prisma().update(where={"id": id}, data={"email": email})
-    updated_profile = await prisma.models.Profile.prisma().update(
+    user = await prisma.models.User.prisma().update(where={"id": id}, data={"email": email})
+    if not user:
+        raise ValueError("User not found")
+    updated_at = datetime.now()
+    # userId is not unique on Profile, so the user's profiles are updated as a set and one
+    # is created for a user that has none yet.
+    updated = await prisma.models.Profile.prisma().update_many(
         where={"userId": id},
-        data={
-            "firstName": firstName,
-            "lastName": lastName,
-            "updatedAt": datetime.now(),
-        },
+        data={"firstName": firstName, "lastName": lastName, "updatedAt": updated_at},
     )
+    if not updated:
+        await prisma.models.Profile.prisma().create(
+            data={
+                "userId": id,
+                "firstName": firstName,
+                "lastName": lastName,
+                "updatedAt": updated_at,
+            }
+        )
+    await project.get_user_profile_service.user_profile_cache.invalidate(id)
     return UserProfileUpdateResponse(
         id=id,
         email=email,
         firstName=firstName,
         lastName=lastName,
         bio=bio,
-        updatedAt=updated_profile.updatedAt,
+        updatedAt=updated_at,
     )
@@ -1,7 +1,8 @@
-import bcrypt
 import prisma
 import prisma.enums
 import prisma.models
+import project.password_hashing
+import project.session_tokens
 from pydantic import BaseModel
 
 
@@ -35,14 +36,26 @@ async def user_login(email: str, password: str) -> UserLoginResponse:
     Returns:
         UserLoginResponse: The response sent back to the user upon a successful login. Includes a session token and potentially user profile information.
     """
-    user = await prisma.models.User.prisma().find_unique(where={"email": email})
+    user = await prisma.models.User.prisma().find_unique(
+        where={"email": email}, include={"profiles": True}
+    )
     if not user:
         raise ValueError("User not found")
-    password_match = bcrypt.checkpw(
-        password.encode("utf-8"), user.password.encode("utf-8")
+    password_match = await project.password_hashing.verify_password(
+        password, user.password
     )
     if not password_match:
         raise ValueError("Invalid password")
-    session_token = "generated_session_token"
-    user_info = prisma.models.User.parse_obj(user)
+    if project.password_hashing.needs_rehash(user.password):
+        # The password was hashed with an older cost factor; upgrade it while we know the plain text.
+        await prisma.models.User.prisma().update(
+            where={"id": user.id},
+            data={"password": await project.password_hashing.hash_password(password)},
+        )
+    session_token = project.session_tokens.issue_session_token(user.id, user.role)
+    profile = user.profiles[0] if user.profiles else None
+    name = " ".join(
+        part for part in [profile and profile.firstName, profile and profile.lastName] if part
+    )
+    user_info = UserInfo(name=name or user.email, email=user.email, role=user.role)
     return UserLoginResponse(session_token=session_token, user_info=user_info)
@@ -1,7 +1,6 @@
 from typing import Optional
 
-import prisma
-import prisma.models
+import project.session_tokens
 from pydantic import BaseModel
 
 
@@ -14,32 +13,21 @@ class LogoutResponse(BaseModel):
     message: Optional[str] = None
 
 
-async def user_logout() -> LogoutResponse:
+async def user_logout(session_token: str) -> LogoutResponse:
     """
-    Terminates an authenticated session by performing necessary clean-up in the database
-    and potentially invalidating any authentication tokens. This function simulates a
-    logout process by marking the latest access log entry with a note indicating logout,
-    assuming in a fully implemented scenario there would be a more direct mechanism
-    for invalidating a user's active session or authentication token.
+    Terminates an authenticated session by revoking its session token. The token is added
+    to the revocation denylist and dropped from the verified-token cache, so any further
+    request presenting it is rejected; with a shared SHARED_STATE_BACKEND, by every worker.
 
     Args:
-        None
+        session_token (str): The bearer token of the session to terminate.
 
     Returns:
     LogoutResponse: Indicates the result of the logout request, primarily signaling whether
                      the session was terminated successfully.
     """
     try:
-        user_id = "example-user-id"
-        last_access_log = await prisma.models.AccessLog.prisma().find_many(
-            where={"userId": user_id}, order={"accessedAt": "desc"}, take=1
-        )
-        if last_access_log:
-            access_log_entry = last_access_log[0]
-            await prisma.models.AccessLog.prisma().update(
-                where={"id": access_log_entry.id},
-                data={"endpoint": f"{access_log_entry.endpoint} - User logged out."},
-            )
+        await project.session_tokens.revoke_session_token(session_token)
         return LogoutResponse(success=True, message="User logged out successfully.")
-    except Exception as e:
+    except project.session_tokens.InvalidSessionToken as e:
         return LogoutResponse(success=False, message=f"Failed to log out: {str(e)}")
@@ -0,0 +1,41 @@
+import os
+import uuid
+
+import prisma
+import pytest
+
+_client = None
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture
+async def database():
+    """
+    A connected, registered Prisma client on emptied tables. Skips the test unless DATABASE_URL
+    points at a Postgres database with the schema pushed.
+    """
+    global _client
+    if not os.environ.get("DATABASE_URL"):
+        pytest.skip("needs DATABASE_URL pointing at a disposable Postgres database")
+    if _client is None:
+        # A process can only register one client, so every test reuses it.
+        _client = prisma.Prisma(auto_register=True)
+    await _client.connect()
+    await _client.execute_raw(
+        'TRUNCATE "User", "ImageRequest", "AnalyticsEvent", "AccessLog" CASCADE'
+    )
+    try:
+        yield _client
+    finally:
+        await _client.disconnect()
+
+
+@pytest.fixture
+async def user(database):
+    return await database.user.create(
+        data={"email": f"{uuid.uuid4()}@example.com", "password": "not a hash"}
+    )
@@ -0,0 +1,37 @@
+"""
+Batched writes of BatchingBuffer when some rows cannot be written.
+"""
+
+import project.metrics
+import pytest
+from project.event_ingestion import BatchingBuffer
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_a_bad_row_only_drops_itself():
+    written = []
+
+    async def flush(rows):
+        if "bad" in rows:
+            raise ValueError("bad row")
+        written.extend(rows)
+
+    buffer = BatchingBuffer("test-bad-row", flush, capacity=16, batch_size=8)
+    for row in ["a", "b", "bad", "c", "d", "e"]:
+        buffer.offer(row)
+    await buffer.flush_once()
+    assert written == ["a", "b", "c", "d", "e"]
+    assert buffer.stats()["dropped"] == 1
+    assert project.metrics.event_buffer_dropped._values[("test-bad-row", "write_failed")] == 1
+
+
+async def test_overflow_counts_as_full():
+    async def flush(rows):
+        pass
+
+    buffer = BatchingBuffer("test-overflow", flush, capacity=2, batch_size=8)
+    for row in range(5):
+        buffer.offer(row)
+    assert len(buffer) == 2
+    assert project.metrics.event_buffer_dropped._values[("test-overflow", "full")] == 3
@@ -0,0 +1,98 @@
+"""
+Chunked keyset export of the user table, with a fake client and against Postgres (see the database fixture).
+"""
+
+import csv
+import io
+import json
+import types
+from datetime import datetime
+
+import prisma
+import prisma.enums
+import project.export_users_service
+import pytest
+from project.export_users_service import ExportFormat, export_users, iter_user_export_chunks
+
+pytestmark = pytest.mark.anyio
+
+
+def user_row(i: int) -> dict:
+    return {
+        "id": f"user-{i}",
+        "email": f"user-{i}@example.com",
+        "role": prisma.enums.UserRole.USER,
+        "firstName": "First" if i % 2 else None,
+        "lastName": "Last" if i % 2 else None,
+        "imageRequestCount": i,
+        "createdAt": datetime(2024, 1, 1),
+        "updatedAt": datetime(2024, 1, 2),
+    }
+
+
+@pytest.fixture
+def users(monkeypatch):
+    """
+    Serves EXPORT_CHUNK_QUERY from a list of rows and records the arguments of each query.
+    """
+    rows = []
+    queries = []
+
+    async def query_raw(query, after, limit):
+        queries.append((after, limit))
+        return [row for row in rows if row["id"] > after][:limit]
+
+    monkeypatch.setattr(prisma, "get_client", lambda: types.SimpleNamespace(query_raw=query_raw))
+    return types.SimpleNamespace(rows=rows, queries=queries)
+
+
+@pytest.mark.parametrize("count, sizes", [(5, [2, 2, 1]), (4, [2, 2]), (0, [])])
+async def test_chunks_continue_after_the_last_id(users, count, sizes):
+    users.rows.extend(user_row(i) for i in range(count))
+    chunks = [chunk async for chunk in iter_user_export_chunks(chunk_size=2)]
+    assert [len(chunk) for chunk in chunks] == sizes
+    assert [row.user_id for chunk in chunks for row in chunk] == [f"user-{i}" for i in range(count)]
+    # A full last chunk costs one more, empty, query.
+    expected_afters = [""] + [chunk[-1].user_id for chunk in chunks if len(chunk) == 2]
+    assert users.queries == [(after, 2) for after in expected_afters]
+
+
+async def test_ndjson_has_one_object_per_user(users, monkeypatch):
+    monkeypatch.setattr(project.export_users_service, "ADMIN_EXPORT_CHUNK_SIZE", 2)
+    users.rows.extend(user_row(i) for i in range(3))
+    text = "".join([part async for part in export_users(ExportFormat.NDJSON)])
+    lines = [json.loads(line) for line in text.splitlines()]
+    assert [line["user_id"] for line in lines] == ["user-0", "user-1", "user-2"]
+    assert lines[1]["imageRequestCount"] == 1
+
+
+async def test_csv_has_a_header_and_empty_cells_for_missing_profiles(users):
+    users.rows.extend(user_row(i) for i in range(2))
+    parts = [part async for part in export_users(ExportFormat.CSV)]
+    rows = list(csv.DictReader(io.StringIO("".join(parts))))
+    assert list(rows[0]) == project.export_users_service.CSV_COLUMNS
+    assert [(row["user_id"], row["firstName"]) for row in rows] == [("user-0", ""), ("user-1", "First")]
+
+
+async def test_export_counts_requests_and_takes_the_first_profile(database, user):
+    await database.profile.create(
+        data={"userId": user.id, "firstName": "Old", "createdAt": datetime(2024, 1, 1)}
+    )
+    await database.profile.create(
+        data={"userId": user.id, "firstName": "New", "createdAt": datetime(2024, 6, 1)}
+    )
+    for _ in range(3):
+        await database.imagerequest.create(
+            data={
+                "userId": user.id,
+                "textDescription": "a cat",
+                "AIModel": prisma.enums.AIModel.DALLE2,
+                "status": prisma.enums.ImageRequestStatus.COMPLETED,
+            }
+        )
+    other = await database.user.create(data={"email": "other@example.com", "password": "x"})
+    rows = [row async for chunk in iter_user_export_chunks(chunk_size=1) for row in chunk]
+    by_id = {row.user_id: row for row in rows}
+    assert sorted(by_id) == sorted([user.id, other.id])
+    assert (by_id[user.id].firstName, by_id[user.id].imageRequestCount) == ("Old", 3)
+    assert (by_id[other.id].firstName, by_id[other.id].imageRequestCount) == (None, 0)
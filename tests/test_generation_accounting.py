@@ -0,0 +1,168 @@
+"""
+Per-minute generation rollups, their persistence and the capacity report built from them.
+"""
+
+import types
+from datetime import datetime, timedelta, timezone
+
+import prisma.enums
+import project.event_ingestion
+import project.generation_accounting
+import project.image_backends
+import project.rate_limiting
+import pytest
+from project.generation_accounting import (
+    CapacitySource,
+    GenerationAccounting,
+    GenerationTiming,
+    Rollup,
+    capacity_report,
+    queue_wait_ms,
+)
+
+pytestmark = pytest.mark.anyio
+
+MINUTE = 28_000_000
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [MINUTE * 60 + 1.0]
+    monkeypatch.setattr(
+        project.generation_accounting,
+        "time",
+        types.SimpleNamespace(time=lambda: now[0], perf_counter=lambda: now[0]),
+    )
+    return now
+
+
+@pytest.fixture
+def events(monkeypatch):
+    recorded = []
+
+    def record_analytics_event(type, metadata, occurred_at=None):
+        recorded.append((type, metadata, occurred_at))
+
+    monkeypatch.setattr(project.event_ingestion, "record_analytics_event", record_analytics_event)
+    return recorded
+
+
+def timing(backend_ms, queue_wait_ms=None, postprocess_ms=10, image_bytes=1000) -> GenerationTiming:
+    return GenerationTiming(
+        backend_ms=backend_ms,
+        queue_wait_ms=queue_wait_ms,
+        postprocess_ms=postprocess_ms,
+        image_bytes=image_bytes,
+    )
+
+
+def test_queue_wait_runs_until_the_claim_or_now():
+    created = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    assert queue_wait_ms(created, created + timedelta(seconds=1.5)) == 1500
+    assert queue_wait_ms(created, created - timedelta(seconds=1)) == 0
+    assert queue_wait_ms(datetime.now(timezone.utc), None) < 1000
+
+
+def test_rollups_add_merge_and_round_trip():
+    rollup = Rollup()
+    for backend_ms in (50, 150, 150, 400):
+        rollup.add(timing(backend_ms, queue_wait_ms=20), failed=False)
+    rollup.add(timing(900, image_bytes=5000), failed=True)
+    assert (rollup.images, rollup.failures, rollup.image_bytes, rollup.queued) == (4, 1, 4000, 4)
+    assert rollup.max_backend_ms == 900
+    other = Rollup.from_dict(rollup.to_dict())
+    assert other.to_dict() == rollup.to_dict()
+    other.merge(rollup)
+    assert (other.images, other.backend_ms, other.max_backend_ms) == (8, 3300, 900)
+    assert sum(other.latency_counts) == 10
+
+
+def test_percentiles_interpolate_within_a_bucket():
+    rollup = Rollup()
+    for backend_ms in (50, 150, 150, 400):
+        rollup.add(timing(backend_ms), failed=False)
+    assert rollup.backend_percentile(0.5) == 175.0
+    # Never above the slowest call seen.
+    assert rollup.backend_percentile(0.95) == 400.0
+    assert Rollup().backend_percentile(0.5) is None
+
+
+def test_finished_minutes_are_persisted_once(clock, events):
+    accounting = GenerationAccounting(window_minutes=5)
+    accounting.record(prisma.enums.AIModel.DALLE2, "FREE", timing(100))
+    clock[0] += 60
+    accounting.record(prisma.enums.AIModel.DALLE2, "FREE", timing(200))
+    assert accounting.persist() == 1
+    assert accounting.persist() == 0
+    assert accounting.persist(include_current=True) == 1
+    assert len(events) == 2
+    type, metadata, occurred_at = events[0]
+    assert type == project.generation_accounting.ROLLUP_EVENT_TYPE
+    assert (metadata["ai_model"], metadata["tier"], metadata["images"]) == ("DALLE2", "FREE", 1)
+    assert occurred_at == datetime.fromtimestamp(MINUTE * 60, timezone.utc)
+
+
+def test_minutes_outside_the_window_are_dropped(clock):
+    accounting = GenerationAccounting(window_minutes=2)
+    accounting.record(prisma.enums.AIModel.DALLE2, "FREE", timing(100))
+    clock[0] += 5 * 60
+    accounting.record(prisma.enums.AIModel.DALLE2, "FREE", timing(100))
+    assert [key[0] for key, _ in accounting.rollups()] == [MINUTE + 5]
+
+
+def test_capacity_report(monkeypatch):
+    monkeypatch.setattr(project.image_backends, "_backends", {})
+    project.image_backends.register_backend(
+        project.image_backends.StubImageBackend(prisma.enums.AIModel.DALLE2, concurrency=3)
+    )
+    busy, quiet = Rollup(), Rollup()
+    for _ in range(6):
+        busy.add(timing(30000), failed=False)
+    busy.add(timing(30000), failed=True)
+    quiet.add(timing(30000, queue_wait_ms=400), failed=False)
+    idle = Rollup()
+    report = capacity_report(
+        [
+            ((MINUTE, "DALLE2", "FREE"), busy),
+            ((MINUTE + 1, "DALLE2", "PREMIUM"), quiet),
+            ((MINUTE + 2, "DALLE2", "FREE"), idle),
+        ],
+        60,
+        CapacitySource.WORKER,
+    )
+    [model] = report.models
+    assert (model.images, model.failures, model.error_rate) == (7, 1, 0.125)
+    assert (model.active_minutes, model.sustained_images_per_minute, model.peak_images_per_minute) == (2, 3.5, 6)
+    # 8 calls of 30s over 3 minutes keep 1.33 calls in flight; the busy minute needs 3.5.
+    assert (model.mean_concurrency, model.peak_concurrency) == (1.33, 3.5)
+    assert model.configured_concurrency == 3
+    assert model.mean_queue_wait_ms == 400
+    assert [(tier.tier, tier.images) for tier in model.tiers] == [("FREE", 6), ("PREMIUM", 1)]
+
+
+async def test_generations_are_recorded_under_the_users_plan(clock, monkeypatch):
+    accounting = GenerationAccounting()
+    monkeypatch.setattr(project.generation_accounting, "generation_accounting", accounting)
+
+    async def get_user_plan(user_id):
+        if user_id == "missing":
+            raise ValueError("User not found")
+        return project.rate_limiting.UserPlan(
+            user_id=user_id, role=prisma.enums.UserRole.USER, tier=prisma.enums.SubscriptionTier.PREMIUM
+        )
+
+    monkeypatch.setattr(project.rate_limiting, "get_user_plan", get_user_plan)
+    await project.generation_accounting.record_generation("u", prisma.enums.AIModel.IMAGEN, timing(100))
+    await project.generation_accounting.record_generation(
+        "missing", prisma.enums.AIModel.IMAGEN, timing(100), failed=True
+    )
+    assert sorted(key for key, _ in accounting.rollups()) == [
+        (MINUTE, "IMAGEN", "PREMIUM"),
+        (MINUTE, "IMAGEN", "UNKNOWN"),
+    ]
+    report = await project.generation_accounting.get_capacity_report(60, CapacitySource.WORKER)
+    assert [(model.ai_model, model.images, model.failures) for model in report.models] == [
+        (prisma.enums.AIModel.IMAGEN, 1, 1)
+    ]
+    with pytest.raises(ValueError):
+        await project.generation_accounting.get_capacity_report(0, CapacitySource.WORKER)
@@ -0,0 +1,114 @@
+"""
+Only the owner of an image request, or an admin, may see it, its file and its events.
+"""
+
+import types
+from datetime import datetime
+
+import prisma.enums
+import project.get_image_request_service
+import project.image_storage
+import project.server
+import project.session_tokens
+import pytest
+from project.get_image_request_service import ImageRequestStatusResponse
+from starlette.testclient import TestClient
+from starlette.websockets import WebSocketDisconnect
+
+OWNER = "owner"
+
+
+@pytest.fixture
+def image_request(monkeypatch):
+    async def get_image_request_owner(id):
+        return OWNER if id == "mine" else None
+
+    async def was_served_image(id, user_id):
+        return user_id == "served"
+
+    async def get_image_request(id):
+        return ImageRequestStatusResponse(
+            request_id=id,
+            status=prisma.enums.ImageRequestStatus.COMPLETED,
+            image_url=f"/image/{id}/file",
+            ai_model=prisma.enums.AIModel.DALLE2,
+            text_description="a cat",
+            createdAt=datetime(2024, 1, 1),
+            updatedAt=datetime(2024, 1, 1),
+        )
+
+    async def open_image(id, variant):
+        return None
+
+    monkeypatch.setattr(
+        project.get_image_request_service, "get_image_request_owner", get_image_request_owner
+    )
+    monkeypatch.setattr(project.get_image_request_service, "was_served_image", was_served_image)
+    monkeypatch.setattr(project.get_image_request_service, "get_image_request", get_image_request)
+    monkeypatch.setattr(project.image_storage, "open_image", open_image)
+
+
+@pytest.fixture
+def client():
+    app = project.server.app
+    yield TestClient(app)
+    app.dependency_overrides.clear()
+
+
+def sign_in(client, sub, role=prisma.enums.UserRole.USER):
+    client.app.dependency_overrides[project.session_tokens.require_session] = (
+        lambda: types.SimpleNamespace(sub=sub, role=role)
+    )
+
+
+@pytest.mark.parametrize("path", ["/image/mine", "/image/mine/file", "/image/mine/events"])
+def test_endpoints_need_a_session(image_request, client, path):
+    assert client.get(path).status_code == 401
+
+
+@pytest.mark.parametrize(
+    "sub, role, status_code",
+    [
+        (OWNER, prisma.enums.UserRole.USER, 200),
+        ("someone-else", prisma.enums.UserRole.USER, 403),
+        ("someone-else", prisma.enums.UserRole.ADMIN, 200),
+    ],
+)
+def test_only_the_owner_or_an_admin_sees_a_request(image_request, client, sub, role, status_code):
+    sign_in(client, sub, role)
+    assert client.get("/image/mine").status_code == status_code
+
+
+def test_unknown_request_is_404(image_request, client):
+    sign_in(client, OWNER)
+    assert client.get("/image/unknown/file").status_code == 404
+
+
+def test_a_served_image_can_be_fetched_by_whoever_it_was_served_to(image_request, client):
+    # open_image finds no blob, so getting past the access check ends in 404.
+    sign_in(client, "served")
+    assert client.get("/image/mine/file").status_code == 404
+    assert client.get("/image/mine").status_code == 403
+    sign_in(client, "someone-else")
+    assert client.get("/image/mine/file").status_code == 403
+
+
+@pytest.mark.parametrize(
+    "query",
+    [
+        "",
+        "?token=forged.token",
+        "?token=" + project.session_tokens.issue_session_token("someone-else", prisma.enums.UserRole.USER),
+    ],
+)
+def test_websocket_refuses_other_callers(image_request, client, query):
+    with pytest.raises(WebSocketDisconnect) as exc_info:
+        with client.websocket_connect(f"/image/mine/ws{query}"):
+            pass
+    assert exc_info.value.code == 1008
+
+
+def test_websocket_streams_to_the_owner(image_request, client):
+    token = project.session_tokens.issue_session_token(OWNER, prisma.enums.UserRole.USER)
+    with client.websocket_connect(f"/image/mine/ws?token={token}") as websocket:
+        assert websocket.receive_json()["status"] == prisma.enums.ImageRequestStatus.COMPLETED
@@ -0,0 +1,296 @@
+"""
+Image backends: concurrency caps, retries, circuit breaker, hedging and failover, exercised
+with StubImageBackend and injected faults.
+"""
+
+import asyncio
+import itertools
+
+import prisma.enums
+import project.generate_image_service
+import project.generation_accounting
+import project.image_backends
+import project.image_events
+import project.image_request_store
+import project.image_storage
+import pytest
+from project.image_backends import CircuitBreaker, ImageBackendError, StubImageBackend
+
+pytestmark = pytest.mark.anyio
+
+
+def stub(ai_model=prisma.enums.AIModel.DALLE2, **kwargs) -> StubImageBackend:
+    kwargs.setdefault("latency", 0.001)
+    kwargs.setdefault("size", 8)
+    kwargs.setdefault("retries", 0)
+    kwargs.setdefault("failure_rate", 0.0)
+    kwargs.setdefault("slow_rate", 0.0)
+    return StubImageBackend(ai_model, **kwargs)
+
+
+def breaker(**kwargs) -> CircuitBreaker:
+    kwargs.setdefault("min_calls", 4)
+    kwargs.setdefault("open_seconds", 0.05)
+    return CircuitBreaker("test", **kwargs)
+
+
+async def test_concurrency_is_capped_per_backend():
+    dalle = stub(prisma.enums.AIModel.DALLE2, concurrency=2, latency=0.05)
+    imagen = stub(prisma.enums.AIModel.IMAGEN, concurrency=2)
+    peak = 0
+
+    async def watch() -> None:
+        nonlocal peak
+        while True:
+            peak = max(peak, dalle.in_flight())
+            await asyncio.sleep(0.005)
+
+    watcher = asyncio.create_task(watch())
+    busy = [asyncio.create_task(dalle.generate(f"cat {i}", None, None)) for i in range(6)]
+    await asyncio.sleep(0.01)
+    # A saturated DALLE2 does not hold up IMAGEN.
+    started = asyncio.get_running_loop().time()
+    await imagen.generate("a dog", None, None)
+    assert asyncio.get_running_loop().time() - started < 0.05
+    await asyncio.gather(*busy)
+    watcher.cancel()
+    assert peak == 2
+    assert dalle.in_flight() == 0
+
+
+async def test_failed_calls_are_retried_within_the_budget(monkeypatch):
+    backend = stub(failure_rate=0.5, retries=2, retry_backoff=0.0, breaker=breaker(min_calls=100))
+    draws = iter([0.0, 0.0, 0.99])
+    monkeypatch.setattr(project.image_backends.random, "random", lambda: next(draws))
+    assert (await backend.generate("a cat", None, None)).data
+    draws = itertools.repeat(0.0)
+    with pytest.raises(ImageBackendError, match="after 3 attempts"):
+        await backend.generate("a cat", None, None)
+
+
+async def test_slow_calls_time_out():
+    backend = stub(latency=0.5, timeout=0.01)
+    with pytest.raises(ImageBackendError):
+        await backend.generate("a cat", None, None)
+    assert backend.in_flight() == 0
+
+
+def test_stub_images_are_deterministic_pngs():
+    image = project.image_backends.render_stub_png("a cat", 8)
+    assert image.startswith(b"\x89PNG\r\n\x1a\n")
+    assert image == project.image_backends.render_stub_png("a cat", 8)
+    assert image != project.image_backends.render_stub_png("a dog", 8)
+
+
+def test_each_model_gets_its_own_default_backend(monkeypatch):
+    monkeypatch.setattr(project.image_backends, "_backends", {})
+    monkeypatch.setattr(project.image_backends, "IMAGE_BACKEND_MODE", "stub")
+    dalle = project.image_backends.get_backend(prisma.enums.AIModel.DALLE2)
+    imagen = project.image_backends.get_backend(prisma.enums.AIModel.IMAGEN)
+    assert isinstance(dalle, StubImageBackend)
+    assert (dalle.ai_model, imagen.ai_model) == (prisma.enums.AIModel.DALLE2, prisma.enums.AIModel.IMAGEN)
+    assert project.image_backends.get_backend(prisma.enums.AIModel.DALLE2) is dalle
+
+
+async def test_breaker_opens_after_failures_and_refuses_calls():
+    backend = stub(failure_rate=1.0, breaker=breaker())
+    for _ in range(4):
+        with pytest.raises(ImageBackendError):
+            await backend.generate("a cat", None, None)
+    assert backend.breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(project.image_backends.BackendUnavailable):
+        await backend.generate("a cat", None, None)
+
+
+async def test_breaker_opens_on_slow_calls():
+    backend = stub(
+        slow_rate=1.0,
+        slow_latency=0.02,
+        breaker=breaker(slow_call_seconds=0.01, slow_call_rate=0.5),
+    )
+    for _ in range(4):
+        await backend.generate("a cat", None, None)
+    assert backend.breaker.state == CircuitBreaker.OPEN
+
+
+async def test_half_open_trial_closes_the_breaker_on_success():
+    backend = stub(failure_rate=1.0, breaker=breaker())
+    for _ in range(4):
+        with pytest.raises(ImageBackendError):
+            await backend.generate("a cat", None, None)
+    await asyncio.sleep(0.06)
+    backend.failure_rate = 0.0
+    image = await backend.generate("a cat", None, None)
+    assert image.data
+    assert backend.breaker.state == CircuitBreaker.CLOSED
+
+
+async def test_failed_half_open_trial_reopens_the_breaker():
+    backend = stub(failure_rate=1.0, breaker=breaker())
+    for _ in range(4):
+        with pytest.raises(ImageBackendError):
+            await backend.generate("a cat", None, None)
+    await asyncio.sleep(0.06)
+    with pytest.raises(ImageBackendError):
+        await backend.generate("a cat", None, None)
+    assert backend.breaker.state == CircuitBreaker.OPEN
+    assert backend.breaker.times_opened == 2
+
+
+async def test_half_open_allows_one_trial_at_a_time():
+    backend = stub(failure_rate=1.0, breaker=breaker())
+    for _ in range(4):
+        with pytest.raises(ImageBackendError):
+            await backend.generate("a cat", None, None)
+    await asyncio.sleep(0.06)
+    backend.failure_rate = 0.0
+    backend.latency = 0.05
+    trial = asyncio.create_task(backend.generate("a cat", None, None))
+    await asyncio.sleep(0.01)
+    with pytest.raises(project.image_backends.BackendUnavailable):
+        await backend.generate("a cat", None, None)
+    await trial
+    assert backend.breaker.state == CircuitBreaker.CLOSED
+
+
+async def test_malformed_response_during_trial_frees_the_trial_slot(monkeypatch):
+    backend = stub(failure_rate=1.0, breaker=breaker())
+    for _ in range(4):
+        with pytest.raises(ImageBackendError):
+            await backend.generate("a cat", None, None)
+    await asyncio.sleep(0.06)
+
+    async def malformed(prompt):
+        raise ValueError("not JSON")
+
+    monkeypatch.setattr(backend, "_generate", malformed)
+    with pytest.raises(ImageBackendError):
+        await backend.generate("a cat", None, None)
+    assert backend.breaker.state == CircuitBreaker.OPEN
+    await asyncio.sleep(0.06)
+    monkeypatch.undo()
+    backend.failure_rate = 0.0
+    await backend.generate("a cat", None, None)
+    assert backend.breaker.state == CircuitBreaker.CLOSED
+
+
+async def test_hedged_attempt_wins_over_a_slow_first_attempt(monkeypatch):
+    backend = stub(
+        slow_rate=0.5,
+        slow_latency=5.0,
+        concurrency=4,
+        hedge_percentile=50.0,
+        breaker=breaker(),
+    )
+    for _ in range(4):
+        backend.breaker.record(True, 0.01)
+    # The first attempt draws a slow call, the hedge a fast one.
+    draws = itertools.chain([0.0], itertools.repeat(0.99))
+    monkeypatch.setattr(project.image_backends.random, "random", lambda: next(draws))
+    hedges = project.metrics.image_backend_hedges
+    before = dict(hedges._values)
+    started = asyncio.get_running_loop().time()
+    image = await backend.generate("a cat", None, None)
+    assert image.data
+    assert asyncio.get_running_loop().time() - started < 1.0
+    assert hedges._values != before
+    # The losing attempt is cancelled and gives its concurrency slot back.
+    await asyncio.sleep(0.01)
+    assert backend.in_flight() == 0
+
+
+async def test_no_hedge_without_enough_latency_samples():
+    backend = stub(slow_rate=1.0, slow_latency=0.05, hedge_percentile=50.0, breaker=breaker())
+    hedges = project.metrics.image_backend_hedges
+    before = dict(hedges._values)
+    await backend.generate("a cat", None, None)
+    assert hedges._values == before
+
+
+@pytest.fixture
+def failover(monkeypatch, tmp_path):
+    """
+    Registers a failing DALLE2 stub with IMAGEN as its substitute and keeps generate_image off the database.
+    """
+    dalle = stub(prisma.enums.AIModel.DALLE2, failure_rate=1.0, breaker=breaker())
+    imagen = stub(prisma.enums.AIModel.IMAGEN, breaker=breaker())
+    monkeypatch.setattr(project.image_backends, "_backends", {})
+    project.image_backends.register_backend(dalle)
+    project.image_backends.register_backend(imagen)
+    monkeypatch.setattr(
+        project.image_backends,
+        "FAILOVER_POLICY",
+        {prisma.enums.AIModel.DALLE2: [prisma.enums.AIModel.IMAGEN]},
+    )
+    rows = []
+
+    async def create_image_request(user_id, text_description, ai_model, theme, style, status, **kwargs):
+        rows.append((ai_model, status))
+
+    async def record_generation(*args, **kwargs):
+        pass
+
+    async def store_image(request_id, data):
+        return f"/image/{request_id}/file"
+
+    monkeypatch.setattr(project.image_request_store, "create_image_request", create_image_request)
+    monkeypatch.setattr(project.generation_accounting, "record_generation", record_generation)
+    monkeypatch.setattr(project.image_storage, "store_image", store_image)
+    return rows
+
+
+async def test_failover_to_the_substitute_model(failover):
+    res = await project.generate_image_service.generate_image(
+        "user", "a failover cat", prisma.enums.AIModel.DALLE2, None, None, allow_substitution=True
+    )
+    assert res.status == prisma.enums.ImageRequestStatus.COMPLETED
+    assert res.ai_model_used == prisma.enums.AIModel.IMAGEN
+    assert failover == [(prisma.enums.AIModel.IMAGEN, prisma.enums.ImageRequestStatus.COMPLETED)]
+
+
+async def test_no_failover_without_allow_substitution(failover):
+    with pytest.raises(ImageBackendError):
+        await project.generate_image_service.generate_image(
+            "user", "a lone cat", prisma.enums.AIModel.DALLE2, None, None
+        )
+    assert failover == [(prisma.enums.AIModel.DALLE2, prisma.enums.ImageRequestStatus.FAILED)]
+
+
+async def test_open_breaker_fails_over_without_calling_the_model(failover):
+    dalle = project.image_backends.get_backend(prisma.enums.AIModel.DALLE2)
+    for _ in range(4):
+        dalle.breaker.record(False, 0.001)
+    assert dalle.breaker.state == CircuitBreaker.OPEN
+    res = await project.generate_image_service.generate_image(
+        "user", "a skipped cat", prisma.enums.AIModel.DALLE2, None, None, allow_substitution=True
+    )
+    assert res.ai_model_used == prisma.enums.AIModel.IMAGEN
+
+
+async def test_sync_outcomes_are_published(failover, monkeypatch):
+    published = []
+
+    async def publish_status(request_id, status, image_url=None):
+        published.append((request_id, status))
+
+    monkeypatch.setattr(project.image_events, "publish_status", publish_status)
+    res = await project.generate_image_service.generate_image(
+        "user", "a published cat", prisma.enums.AIModel.IMAGEN, None, None
+    )
+    with pytest.raises(ImageBackendError):
+        await project.generate_image_service.generate_image(
+            "user", "a published dog", prisma.enums.AIModel.DALLE2, None, None
+        )
+    assert published[0] == (res.request_id, prisma.enums.ImageRequestStatus.COMPLETED)
+    assert [status for _, status in published] == [
+        prisma.enums.ImageRequestStatus.COMPLETED,
+        prisma.enums.ImageRequestStatus.FAILED,
+    ]
+
+
+def test_every_registration_bumps_the_backends_version(monkeypatch):
+    monkeypatch.setattr(project.image_backends, "_backends", {})
+    before = project.image_backends.backends_version
+    project.image_backends.register_backend(stub(prisma.enums.AIModel.DALLE2))
+    project.image_backends.register_backend(stub(prisma.enums.AIModel.DALLE2))
+    assert project.image_backends.backends_version == before + 2
@@ -0,0 +1,201 @@
+"""
+The local and Postgres image job queues, driven through ImageWorkerPool.
+"""
+
+import asyncio
+import collections
+from typing import Callable, List
+
+import prisma.enums
+import prisma.models
+import project.generate_image_service
+import project.image_backends
+import project.image_request_store
+import project.image_storage
+import pytest
+from project.image_job_queue import ImageWorkerPool, LocalImageJobQueue, PostgresImageJobQueue
+
+pytestmark = pytest.mark.anyio
+
+
+async def wait_for(condition: Callable[[], bool], timeout: float = 10.0) -> None:
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        assert asyncio.get_running_loop().time() < deadline, "timed out"
+        await asyncio.sleep(0.01)
+
+
+async def drain(queue: LocalImageJobQueue) -> List[str]:
+    return [await queue.claim() for _ in range(queue.depth())]
+
+
+async def test_local_queue_serves_owners_by_weight():
+    queue = LocalImageJobQueue()
+    for i in range(8):
+        await queue.submit(f"heavy-{i}", owner="heavy", weight=4.0)
+    for i in range(2):
+        await queue.submit(f"light-{i}", owner="light", weight=1.0)
+    order = await drain(queue)
+    assert [request_id.split("-")[0] for request_id in order[:5]] == ["heavy"] * 4 + ["light"]
+    assert sorted(order) == sorted([f"heavy-{i}" for i in range(8)] + ["light-0", "light-1"])
+
+
+async def test_local_queue_does_not_starve_a_newcomer():
+    queue = LocalImageJobQueue()
+    for i in range(100):
+        await queue.submit(f"backlog-{i}", owner="backlog")
+    await queue.claim()
+    await queue.submit("newcomer", owner="newcomer")
+    assert "newcomer" in [await queue.claim() for _ in range(2)]
+
+
+async def test_local_queue_pool_runs_each_job_once():
+    queue = LocalImageJobQueue()
+    handled = collections.Counter()
+
+    async def handler(request_id: str) -> None:
+        await asyncio.sleep(0.001)
+        handled[request_id] += 1
+
+    pool = ImageWorkerPool(queue, handler, concurrency=4)
+    pool.start()
+    try:
+        for i in range(50):
+            await queue.submit(f"job-{i}", owner=f"user-{i % 3}")
+        await wait_for(lambda: sum(handled.values()) == 50)
+    finally:
+        await pool.stop()
+    assert set(handled.values()) == {1}
+
+
+async def test_pool_survives_a_failing_handler():
+    queue = LocalImageJobQueue()
+    handled = []
+
+    async def handler(request_id: str) -> None:
+        if request_id == "bad":
+            raise RuntimeError("boom")
+        handled.append(request_id)
+
+    pool = ImageWorkerPool(queue, handler, concurrency=1)
+    pool.start()
+    try:
+        await queue.submit("bad")
+        await queue.submit("good")
+        await wait_for(lambda: handled == ["good"])
+    finally:
+        await pool.stop()
+
+
+async def insert_processing(user, count: int) -> List[str]:
+    ids = []
+    for i in range(count):
+        row = await project.image_request_store.create_image_request(
+            user.id,
+            f"queued prompt {i}",
+            prisma.enums.AIModel.DALLE2,
+            None,
+            None,
+            prisma.enums.ImageRequestStatus.PROCESSING,
+        )
+        ids.append(row.id)
+    return ids
+
+
+async def test_postgres_claims_hand_each_row_to_one_worker(user):
+    ids = await insert_processing(user, 40)
+    handled = collections.Counter()
+
+    async def handler(request_id: str) -> None:
+        await asyncio.sleep(0.005)
+        handled[request_id] += 1
+
+    # Three queues stand in for three worker processes polling the same table.
+    pools = [
+        ImageWorkerPool(PostgresImageJobQueue(poll_interval=0.05), handler, concurrency=4)
+        for _ in range(3)
+    ]
+    for pool in pools:
+        pool.start()
+    try:
+        await wait_for(lambda: sum(handled.values()) >= len(ids))
+        await asyncio.sleep(0.2)
+    finally:
+        for pool in pools:
+            await pool.stop()
+    assert sorted(handled) == sorted(ids)
+    assert set(handled.values()) == {1}
+    rows = await prisma.models.ImageRequest.prisma().find_many(where={"id": {"in": ids}})
+    assert all(row.claimedAt is not None for row in rows)
+
+
+@pytest.fixture
+def stub_backends(monkeypatch):
+    """
+    Registers fast stub backends (DALLE2 works, IMAGEN always fails) and keeps images off the disk.
+    """
+    monkeypatch.setattr(project.image_backends, "_backends", {})
+    project.image_backends.register_backend(
+        project.image_backends.StubImageBackend(
+            prisma.enums.AIModel.DALLE2, latency=0.001, size=8, failure_rate=0.0, slow_rate=0.0
+        )
+    )
+    project.image_backends.register_backend(
+        project.image_backends.StubImageBackend(
+            prisma.enums.AIModel.IMAGEN, latency=0.001, size=8, retries=0, failure_rate=1.0
+        )
+    )
+
+    async def store_image(request_id, data):
+        return f"/image/{request_id}/file"
+
+    monkeypatch.setattr(project.image_storage, "store_image", store_image)
+
+
+@pytest.mark.parametrize("queue_class", [LocalImageJobQueue, PostgresImageJobQueue])
+async def test_worker_pool_completes_and_fails_requests(queue_class, user, stub_backends):
+    queue = queue_class()
+    if isinstance(queue, PostgresImageJobQueue):
+        queue.poll_interval = 0.05
+    requests = {}
+    for ai_model in (prisma.enums.AIModel.DALLE2, prisma.enums.AIModel.IMAGEN):
+        row = await project.image_request_store.create_image_request(
+            user.id,
+            f"a {ai_model} cat",
+            ai_model,
+            None,
+            None,
+            prisma.enums.ImageRequestStatus.PROCESSING,
+        )
+        requests[ai_model] = row.id
+        await queue.submit(row.id, owner=user.id)
+    pool = ImageWorkerPool(queue, project.generate_image_service.process_image_request, concurrency=2)
+    pool.start()
+    statuses = {}
+
+    async def refresh() -> None:
+        rows = await prisma.models.ImageRequest.prisma().find_many(
+            where={"id": {"in": list(requests.values())}}
+        )
+        statuses.update({row.id: row for row in rows})
+
+    try:
+        deadline = asyncio.get_running_loop().time() + 10
+        while True:
+            await refresh()
+            if all(row.status != prisma.enums.ImageRequestStatus.PROCESSING for row in statuses.values()):
+                break
+            assert asyncio.get_running_loop().time() < deadline, "timed out"
+            await asyncio.sleep(0.05)
+    finally:
+        await pool.stop()
+    completed = statuses[requests[prisma.enums.AIModel.DALLE2]]
+    failed = statuses[requests[prisma.enums.AIModel.IMAGEN]]
+    assert completed.status == prisma.enums.ImageRequestStatus.COMPLETED
+    assert completed.imageUrl == f"/image/{completed.id}/file"
+    assert completed.backendMs is not None
+    # Both queues leave the claim on the row, which starts the lease.
+    assert completed.claimedAt is not None
+    assert completed.queueWaitMs is not None
+    assert failed.status == prisma.enums.ImageRequestStatus.FAILED
+    assert failed.imageUrl is None
@@ -0,0 +1,48 @@
+"""
+The image process pool and post-processing pipeline. Skipped unless Pillow and numpy are installed.
+"""
+
+import os
+from concurrent.futures.process import BrokenProcessPool
+
+import project.image_postprocessing
+import pytest
+from project.image_backends import render_stub_png
+
+pytest.importorskip("numpy")
+pytest.importorskip("PIL")
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+async def process_pool():
+    await project.image_postprocessing.start_image_processing()
+    yield
+    await project.image_postprocessing.close_image_processing()
+
+
+async def test_a_dead_worker_does_not_turn_post_processing_off(process_pool):
+    with pytest.raises(BrokenProcessPool):
+        await project.image_postprocessing.run_in_process_pool(os._exit, 1)
+    assert project.image_postprocessing.imaging_available()
+    spec = project.image_postprocessing.parse_postprocessing_options({"width": "16"})
+    data = render_stub_png("a cat", 64)
+    processed = await project.image_postprocessing.postprocess(data, spec)
+    assert processed != data
+
+
+@pytest.mark.parametrize("plans", [frozenset({"FREE"}), frozenset()])
+async def test_startup_refuses_watermark_plans_without_imaging(monkeypatch, plans):
+    async def missing(function, *args):
+        return False
+
+    monkeypatch.setattr(project.image_postprocessing, "run_in_process_pool", missing)
+    monkeypatch.setattr(project.image_postprocessing, "IMAGE_WATERMARK_PLANS", plans)
+    monkeypatch.setattr(project.image_postprocessing, "_available", None)
+    if plans:
+        with pytest.raises(RuntimeError):
+            await project.image_postprocessing.start_image_processing()
+    else:
+        await project.image_postprocessing.start_image_processing()
+    assert not project.image_postprocessing.imaging_available()
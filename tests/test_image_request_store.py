@@ -0,0 +1,40 @@
+"""
+Batched status transitions. Needs Postgres (see the database fixture).
+"""
+
+import asyncio
+
+import prisma.enums
+import prisma.models
+import project.image_request_store
+import pytest
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_one_failing_transition_does_not_fail_the_others(user):
+    rows = [
+        await project.image_request_store.create_image_request(
+            user.id,
+            f"prompt {i}",
+            prisma.enums.AIModel.DALLE2,
+            None,
+            None,
+            prisma.enums.ImageRequestStatus.PROCESSING,
+        )
+        for i in range(3)
+    ]
+    await prisma.models.ImageRequest.prisma().delete(where={"id": rows[1].id})
+    batcher = project.image_request_store.ImageStatusBatcher(max_size=10, max_delay=0.01)
+    results = await asyncio.gather(
+        *(
+            batcher.transition(row.id, prisma.enums.ImageRequestStatus.COMPLETED, f"/image/{row.id}/file")
+            for row in rows
+        ),
+        return_exceptions=True,
+    )
+    assert results[0] is None and results[2] is None
+    assert isinstance(results[1], Exception)
+    for row in (rows[0], rows[2]):
+        stored = await prisma.models.ImageRequest.prisma().find_unique(where={"id": row.id})
+        assert stored.status == prisma.enums.ImageRequestStatus.COMPLETED
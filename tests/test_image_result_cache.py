@@ -0,0 +1,147 @@
+"""
+Single-flight coalescing of the result cache, and the requests recorded for callers it answers.
+"""
+
+import asyncio
+import contextlib
+import types
+import uuid
+
+import prisma
+import prisma.enums
+import project.generate_image_batch_service
+import project.generate_image_service
+import project.image_events
+import project.image_request_store
+import project.image_result_cache
+import project.prompt_similarity_index
+import pytest
+from project.image_result_cache import CachedImageResult, ImageResultCache
+from project.ttl_lru_cache import TTLLRUCache
+
+pytestmark = pytest.mark.anyio
+
+
+def cache() -> ImageResultCache:
+    return ImageResultCache(TTLLRUCache(max_entries=16, ttl=60))
+
+
+async def test_concurrent_callers_share_one_compute():
+    results = cache()
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return CachedImageResult(request_id="r", image_url="/image/r/file")
+
+    outcomes = await asyncio.gather(*(results.get_or_compute("k", compute) for _ in range(3)))
+    assert len(calls) == 1
+    assert sorted(hit for _, hit in outcomes) == [False, True, True]
+
+
+async def test_waiters_take_over_when_the_leader_is_cancelled():
+    results = cache()
+    started = asyncio.Event()
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        started.set()
+        await asyncio.sleep(0.05 if len(calls) == 1 else 0)
+        return CachedImageResult(request_id=str(len(calls)), image_url="/image/file")
+
+    leader = asyncio.create_task(results.get_or_compute("k", compute))
+    await started.wait()
+    waiters = [asyncio.create_task(results.get_or_compute("k", compute)) for _ in range(2)]
+    await asyncio.sleep(0)
+    leader.cancel()
+    outcomes = await asyncio.gather(*waiters)
+    assert len(calls) == 2
+    assert [result.request_id for result, _ in outcomes] == ["2", "2"]
+    with pytest.raises(asyncio.CancelledError):
+        await leader
+
+
+@pytest.fixture
+def cached_elsewhere(monkeypatch):
+    """
+    Caches the result of another user's request for "a cached cat" and records created requests in a list.
+    """
+    results = cache()
+    key = project.image_result_cache.result_cache_key(
+        "a cached cat", prisma.enums.AIModel.DALLE2, None, None, None
+    )
+    results.memory.set(
+        key, CachedImageResult(request_id="other-users-request", image_url="/image/cached/file")
+    )
+    created = []
+
+    async def create_image_request(user_id, text_description, ai_model, theme, style, status, **kwargs):
+        row = types.SimpleNamespace(id=str(uuid.uuid4()), userId=user_id, status=status, **kwargs)
+        created.append(row)
+        return row
+
+    async def find_idempotent_request(user_id, idempotency_key):
+        return None
+
+    async def publish_status(*args, **kwargs):
+        pass
+
+    monkeypatch.setattr(project.image_result_cache, "image_result_cache", results)
+    monkeypatch.setattr(
+        project.image_request_store, "find_idempotent_request", find_idempotent_request
+    )
+    monkeypatch.setattr(project.image_request_store, "create_image_request", create_image_request)
+    monkeypatch.setattr(project.image_events, "publish_status", publish_status)
+    monkeypatch.setattr(project.prompt_similarity_index, "PROMPT_SIMILARITY_MODE", "off")
+    return created
+
+
+@pytest.mark.parametrize("queued", [False, True])
+async def test_a_cache_hit_records_a_request_for_the_caller(cached_elsewhere, queued):
+    if queued:
+        res = await project.generate_image_service.enqueue_generate_image(
+            "caller", "a cached cat", prisma.enums.AIModel.DALLE2, None, None, idempotency_key="k"
+        )
+    else:
+        res = await project.generate_image_service.generate_image(
+            "caller", "a cached cat", prisma.enums.AIModel.DALLE2, None, None
+        )
+    [row] = cached_elsewhere
+    assert res.request_id == row.id != "other-users-request"
+    assert (row.userId, row.status, row.image_url) == (
+        "caller",
+        prisma.enums.ImageRequestStatus.COMPLETED,
+        "/image/cached/file",
+    )
+    assert row.idempotency_key == ("k" if queued else None)
+
+
+async def test_a_cached_batch_prompt_gets_its_own_row(cached_elsewhere, monkeypatch):
+    written = []
+
+    @contextlib.asynccontextmanager
+    async def batch_():
+        yield types.SimpleNamespace(
+            imagerequest=types.SimpleNamespace(create_many=lambda data: written.extend(data)),
+            custoption=types.SimpleNamespace(create_many=lambda data: None),
+        )
+
+    monkeypatch.setattr(prisma, "get_client", lambda: types.SimpleNamespace(batch_=batch_))
+    batch = await project.generate_image_batch_service.start_image_batch(
+        "caller",
+        [
+            project.generate_image_batch_service.BatchPrompt(
+                text_description="a cached cat", ai_model=prisma.enums.AIModel.DALLE2
+            )
+        ],
+    )
+    items = [item async for item in batch.results()]
+    [row] = written
+    assert [item.request_id for item in items] == [row["id"]]
+    assert (row["userId"], row["status"], row["imageUrl"]) == (
+        "caller",
+        prisma.enums.ImageRequestStatus.COMPLETED,
+        "/image/cached/file",
+    )
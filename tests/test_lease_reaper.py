@@ -0,0 +1,130 @@
+"""
+The lease reaper's SQL against Postgres (see the database fixture).
+"""
+
+from typing import Optional
+
+import prisma.enums
+import prisma.models
+import project.image_job_queue
+import project.image_request_store
+import pytest
+from project.image_job_queue import LocalImageJobQueue, PostgresImageJobQueue, reap_expired_leases
+
+pytestmark = pytest.mark.anyio
+
+LEASE = 60.0
+
+
+@pytest.fixture
+def lease(monkeypatch):
+    monkeypatch.setattr(project.image_job_queue, "IMAGE_REQUEST_LEASE_SECONDS", LEASE)
+    monkeypatch.setattr(project.image_job_queue, "IMAGE_REQUEST_MAX_REQUEUES", 2)
+    monkeypatch.delenv("WEB_CONCURRENCY", raising=False)
+
+
+def use_queue(monkeypatch, queue):
+    monkeypatch.setattr(project.image_job_queue, "_image_job_queue", queue)
+    return queue
+
+
+async def insert(
+    database, user, claimed_ago: Optional[float], created_ago: float = 0, requeue_count: int = 0
+) -> str:
+    row = await project.image_request_store.create_image_request(
+        user.id,
+        "a cat",
+        prisma.enums.AIModel.DALLE2,
+        None,
+        None,
+        prisma.enums.ImageRequestStatus.PROCESSING,
+    )
+    await database.execute_raw(
+        """
+        UPDATE "ImageRequest"
+        SET "claimedAt" = CASE WHEN $1 THEN NOW() - make_interval(secs => $2) ELSE NULL END,
+            "createdAt" = NOW() - make_interval(secs => $3),
+            "updatedAt" = NOW() - make_interval(secs => $3),
+            "requeueCount" = $4
+        WHERE "id" = $5
+        """,
+        claimed_ago is not None,
+        claimed_ago or 0.0,
+        max(created_ago, claimed_ago or 0.0),
+        requeue_count,
+        row.id,
+    )
+    return row.id
+
+
+async def fetch(request_id: str) -> prisma.models.ImageRequest:
+    return await prisma.models.ImageRequest.prisma().find_unique(where={"id": request_id})
+
+
+async def test_expired_lease_is_requeued_for_the_postgres_queue(database, user, lease, monkeypatch):
+    queue = use_queue(monkeypatch, PostgresImageJobQueue())
+    expired = await insert(database, user, claimed_ago=2 * LEASE)
+    live = await insert(database, user, claimed_ago=LEASE / 2)
+    assert await reap_expired_leases() == (1, 0)
+    row = await fetch(expired)
+    assert row.status == prisma.enums.ImageRequestStatus.PROCESSING
+    assert row.claimedAt is None
+    assert row.requeueCount == 1
+    assert row.updatedAt > row.createdAt
+    assert (await fetch(live)).requeueCount == 0
+    # The requeued row is claimable again.
+    assert await queue.claim() == expired
+
+
+async def test_expired_lease_is_resubmitted_to_the_local_queue(database, user, lease, monkeypatch):
+    queue = use_queue(monkeypatch, LocalImageJobQueue())
+    expired = await insert(database, user, claimed_ago=2 * LEASE)
+    assert await reap_expired_leases() == (1, 0)
+    row = await fetch(expired)
+    assert row.claimedAt is not None and row.requeueCount == 1
+    assert await queue.claim() == expired
+
+
+async def test_request_is_failed_after_the_last_requeue(database, user, lease, monkeypatch):
+    use_queue(monkeypatch, PostgresImageJobQueue())
+    exhausted = await insert(database, user, claimed_ago=2 * LEASE, requeue_count=2)
+    assert await reap_expired_leases() == (0, 1)
+    row = await fetch(exhausted)
+    assert row.status == prisma.enums.ImageRequestStatus.FAILED
+    assert row.updatedAt > row.createdAt
+
+
+async def test_finished_requests_are_left_alone(database, user, lease, monkeypatch):
+    use_queue(monkeypatch, PostgresImageJobQueue())
+    done = await insert(database, user, claimed_ago=2 * LEASE)
+    await prisma.models.ImageRequest.prisma().update(
+        where={"id": done}, data={"status": prisma.enums.ImageRequestStatus.COMPLETED}
+    )
+    assert await reap_expired_leases() == (0, 0)
+
+
+async def test_startup_takes_over_orphans_of_a_single_process(database, user, lease, monkeypatch):
+    queue = use_queue(monkeypatch, LocalImageJobQueue())
+    orphan = await insert(database, user, claimed_ago=None, created_ago=2 * LEASE)
+    fresh = await insert(database, user, claimed_ago=None)
+    assert await reap_expired_leases() == (0, 0)
+    assert await reap_expired_leases(startup=True) == (1, 0)
+    assert await queue.claim() == orphan
+    assert (await fetch(fresh)).claimedAt is None
+
+
+async def test_startup_leaves_unclaimed_rows_to_other_workers(database, user, lease, monkeypatch):
+    use_queue(monkeypatch, LocalImageJobQueue())
+    monkeypatch.setenv("WEB_CONCURRENCY", "4")
+    orphan = await insert(database, user, claimed_ago=None, created_ago=2 * LEASE)
+    assert await reap_expired_leases(startup=True) == (0, 0)
+    assert (await fetch(orphan)).claimedAt is None
+
+
+async def test_startup_with_the_postgres_queue_leaves_unclaimed_rows_to_it(
+    database, user, lease, monkeypatch
+):
+    use_queue(monkeypatch, PostgresImageJobQueue())
+    orphan = await insert(database, user, claimed_ago=None, created_ago=2 * LEASE)
+    assert await reap_expired_leases(startup=True) == (0, 0)
+    assert (await fetch(orphan)).requeueCount == 0
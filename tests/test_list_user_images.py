@@ -0,0 +1,97 @@
+"""
+Keyset pagination of a user's image history.
+"""
+
+import types
+from datetime import datetime, timedelta
+
+import prisma.enums
+import project.list_user_images_service
+import project.server
+import project.session_tokens
+import pytest
+from project.list_user_images_service import decode_cursor, encode_cursor, list_user_images
+from starlette.testclient import TestClient
+
+pytestmark = pytest.mark.anyio
+
+
+async def insert(database, user, created_at, status, ai_model=prisma.enums.AIModel.DALLE2):
+    return await database.imagerequest.create(
+        data={
+            "userId": user.id,
+            "textDescription": "a cat",
+            "AIModel": ai_model,
+            "status": status,
+            "imageUrl": "/image/x/file",
+            "createdAt": created_at,
+        }
+    )
+
+
+def test_cursor_round_trip():
+    created_at = datetime(2024, 5, 1, 12, 30, 15, 123000)
+    assert decode_cursor(encode_cursor(created_at, "abc")) == (created_at.isoformat(), "abc")
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    [
+        {"limit": 0},
+        {"limit": project.list_user_images_service.MAX_PAGE_SIZE + 1},
+        {"fields": ["status", "password"]},
+        {"cursor": "not a cursor"},
+    ],
+)
+async def test_invalid_parameters_raise_value_error(kwargs):
+    with pytest.raises(ValueError):
+        await list_user_images("user", **kwargs)
+
+
+def test_invalid_parameters_get_400():
+    app = project.server.app
+    app.dependency_overrides[project.session_tokens.require_session] = lambda: types.SimpleNamespace(
+        sub="user", role=prisma.enums.UserRole.USER
+    )
+    try:
+        response = TestClient(app).get("/user/user/images", params={"cursor": "not a cursor"})
+    finally:
+        app.dependency_overrides.clear()
+    assert response.status_code == 400
+
+
+async def test_pages_follow_the_cursor(database, user):
+    start = datetime(2024, 1, 1)
+    ids = [
+        (await insert(database, user, start + timedelta(minutes=i), prisma.enums.ImageRequestStatus.COMPLETED)).id
+        for i in range(5)
+    ]
+    seen, cursor = [], None
+    while True:
+        page = await list_user_images(user.id, limit=2, cursor=cursor)
+        seen.extend(image.id for image in page.images)
+        cursor = page.next_cursor
+        if cursor is None:
+            break
+    assert seen == list(reversed(ids))
+
+
+async def test_filters_and_field_selection(database, user):
+    start = datetime(2024, 1, 1)
+    completed = await insert(database, user, start, prisma.enums.ImageRequestStatus.COMPLETED)
+    await insert(database, user, start + timedelta(minutes=1), prisma.enums.ImageRequestStatus.FAILED)
+    imagen = await insert(
+        database,
+        user,
+        start + timedelta(minutes=2),
+        prisma.enums.ImageRequestStatus.COMPLETED,
+        prisma.enums.AIModel.IMAGEN,
+    )
+    page = await list_user_images(
+        user.id, status=prisma.enums.ImageRequestStatus.COMPLETED, fields=["status"]
+    )
+    assert [image.id for image in page.images] == [imagen.id, completed.id]
+    assert page.images[0].model_dump(exclude_unset=True).keys() == {"id", "createdAt", "status"}
+    page = await list_user_images(user.id, ai_model=prisma.enums.AIModel.IMAGEN)
+    assert [image.id for image in page.images] == [imagen.id]
+    assert page.next_cursor is None
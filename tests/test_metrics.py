@@ -0,0 +1,117 @@
+"""
+Metric rendering, per-route request instrumentation and slow request profiles.
+"""
+
+import time
+
+import project.metrics
+import pytest
+from fastapi import FastAPI
+from prisma import Prisma
+from project.metrics import Counter, Gauge, Histogram, RequestMetricsMiddleware, SamplingProfiler
+from starlette.testclient import TestClient
+
+
+@pytest.fixture
+def registry(monkeypatch):
+    """
+    Metrics created by a test are registered in a throwaway registry.
+    """
+    monkeypatch.setattr(project.metrics, "REGISTRY", [])
+    return project.metrics.REGISTRY
+
+
+def test_histograms_render_cumulative_buckets(registry):
+    histogram = Histogram("test_seconds", "Test latency.", ("route",), buckets=(0.1, 1.0))
+    for value in (0.05, 0.5, 0.7, 3.0):
+        histogram.observe(value, route='/a"b')
+    assert histogram.render().splitlines() == [
+        "# HELP test_seconds Test latency.",
+        "# TYPE test_seconds histogram",
+        'test_seconds_bucket{route="/a\\"b",le="0.1"} 1',
+        'test_seconds_bucket{route="/a\\"b",le="1"} 3',
+        'test_seconds_bucket{route="/a\\"b",le="+Inf"} 4',
+        'test_seconds_sum{route="/a\\"b"} 4.25',
+        'test_seconds_count{route="/a\\"b"} 4',
+    ]
+
+
+def test_counters_and_gauges(registry):
+    counter = Counter("test_total", "Things.", ("kind",))
+    counter.inc(kind="a")
+    counter.inc(2, kind="a")
+    gauge = Gauge("test_depth", "Depth.", ("queue",))
+    gauge.set_function(lambda: 7, queue="ok")
+    gauge.set_function(lambda: 1 / 0, queue="broken")
+    rendered = project.metrics.render_metrics()
+    assert 'test_total{kind="a"} 3' in rendered
+    assert 'test_depth{queue="ok"} 7' in rendered
+    assert "broken" not in rendered
+
+
+def instrumented_app() -> FastAPI:
+    app = FastAPI()
+    app.add_middleware(RequestMetricsMiddleware)
+
+    @app.get("/items/{id}")
+    async def item(id: str):
+        client = project.metrics.InstrumentedPrisma()
+        await client._execute(method="find_unique")
+        await client._execute(method="update")
+        return {"id": id}
+
+    @app.get("/slow")
+    async def slow():
+        # Blocks the event loop, which is what the profiler is there to catch.
+        time.sleep(0.1)
+        return {}
+
+    return app
+
+
+@pytest.fixture
+def engine(monkeypatch):
+    async def execute(self, **kwargs):
+        return None
+
+    monkeypatch.setattr(Prisma, "_execute", execute)
+
+
+def test_requests_are_recorded_by_route_template_with_their_queries(engine):
+    client = TestClient(instrumented_app())
+    route_key = ("GET", "/items/{id}", "200")
+    seconds = project.metrics.http_request_seconds
+    before = seconds._values.get(route_key, ([], [0.0, 0.0]))[1][1]
+    client.get("/items/1")
+    client.get("/items/2")
+    client.get("/nowhere")
+    assert seconds._values[route_key][1][1] == before + 2
+    assert ("GET", "unmatched", "404") in seconds._values
+    queries = project.metrics.http_request_db_queries._values[("/items/{id}",)][1]
+    assert queries[0] / queries[1] == 2
+
+
+def test_folded_stacks_are_limited_to_the_window():
+    profiler = SamplingProfiler()
+    profiler._samples.extend([(1.0, "main;a"), (2.0, "main;a"), (2.5, "main;b"), (9.0, "main;c")])
+    assert profiler.folded(1.5, 3.0) == "main;a 1\nmain;b 1\n"
+
+
+def test_slow_requests_are_profiled(engine, monkeypatch, tmp_path):
+    profiler = SamplingProfiler(interval=0.001)
+    monkeypatch.setattr(project.metrics, "profiler", profiler)
+    monkeypatch.setattr(project.metrics, "SLOW_REQUEST_PROFILE_THRESHOLD", "0.05")
+    monkeypatch.setattr(project.metrics, "SLOW_REQUEST_PROFILE_DIR", str(tmp_path))
+    client = TestClient(instrumented_app())
+    with client:
+        # Sampling starts with the lifespan in the server; here the handler runs in the
+        # TestClient's portal thread, which is the one to sample.
+        client.portal.call(profiler.start)
+        try:
+            client.get("/items/1")
+            client.get("/slow")
+        finally:
+            profiler.stop()
+    [profile] = tmp_path.iterdir()
+    assert "GET-slow" in profile.name
+    assert "test_metrics.py:slow" in profile.read_text()
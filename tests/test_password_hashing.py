@@ -0,0 +1,85 @@
+"""
+bcrypt in the executor, cost factors and the rehash on login.
+"""
+
+import asyncio
+import types
+
+import prisma.enums
+import prisma.models
+import project.password_hashing
+import project.user_login_service
+import pytest
+from project.password_hashing import hash_password, hash_rounds, needs_rehash, verify_password
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def executor(monkeypatch):
+    monkeypatch.setattr(project.password_hashing, "PASSWORD_HASH_WORKERS", 2)
+    monkeypatch.setattr(project.password_hashing, "_executor", None)
+    yield
+    project.password_hashing.shutdown_password_executor()
+
+
+async def test_hashes_verify_and_carry_their_cost(executor):
+    hashed = await hash_password("secret", rounds=4)
+    assert await verify_password("secret", hashed)
+    assert not await verify_password("guess", hashed)
+    assert hash_rounds(hashed) == 4
+    assert not needs_rehash(hashed, rounds=4)
+    assert needs_rehash(hashed, rounds=5)
+    assert hash_rounds("not a hash") is None
+    assert needs_rehash("not a hash", rounds=4)
+
+
+async def test_hashing_leaves_the_event_loop_free(executor):
+    ticks = 0
+
+    async def tick() -> None:
+        nonlocal ticks
+        while True:
+            await asyncio.sleep(0.001)
+            ticks += 1
+
+    ticker = asyncio.create_task(tick())
+    await asyncio.gather(*(hash_password("secret", rounds=10) for _ in range(2)))
+    ticker.cancel()
+    assert ticks >= 5
+
+
+def test_the_executor_is_bounded_and_recreated_after_shutdown(executor):
+    first = project.password_hashing.get_password_executor()
+    assert first._max_workers == 2
+    assert project.password_hashing.get_password_executor() is first
+    project.password_hashing.shutdown_password_executor()
+    assert project.password_hashing.get_password_executor() is not first
+
+
+async def test_login_rehashes_an_outdated_hash(executor, monkeypatch):
+    user = types.SimpleNamespace(
+        id="u",
+        email="u@example.com",
+        password=await hash_password("secret", rounds=project.password_hashing.BCRYPT_ROUNDS - 1),
+        role=prisma.enums.UserRole.USER,
+        profiles=[],
+    )
+    updates = []
+
+    async def find_unique(where, include=None):
+        return user if where == {"email": user.email} else None
+
+    async def update(where, data):
+        updates.append(data)
+        user.password = data["password"]
+        return user
+
+    actions = types.SimpleNamespace(find_unique=find_unique, update=update)
+    monkeypatch.setattr(prisma.models.User, "prisma", lambda: actions)
+    await project.user_login_service.user_login(user.email, "secret")
+    assert hash_rounds(user.password) == project.password_hashing.BCRYPT_ROUNDS
+    await project.user_login_service.user_login(user.email, "secret")
+    assert len(updates) == 1
+    with pytest.raises(ValueError):
+        await project.user_login_service.user_login(user.email, "guess")
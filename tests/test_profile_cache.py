@@ -0,0 +1,54 @@
+"""
+Read-through caching racing with invalidation.
+"""
+
+import asyncio
+
+import pytest
+from project.profile_cache import ReadThroughCache
+from pydantic import BaseModel
+
+pytestmark = pytest.mark.anyio
+
+
+class Profile(BaseModel):
+    name: str
+
+
+async def test_a_load_overtaken_by_invalidate_is_not_cached():
+    cache = ReadThroughCache("test-profile-race", Profile)
+    stored = {"name": "old"}
+    loading = asyncio.Event()
+    release = asyncio.Event()
+
+    async def slow_load():
+        value = Profile(name=stored["name"])
+        loading.set()
+        await release.wait()
+        return value
+
+    read = asyncio.create_task(cache.get("u", slow_load))
+    await loading.wait()
+    stored["name"] = "new"
+    await cache.invalidate("u")
+    release.set()
+    assert (await read).name == "old"
+
+    async def load():
+        return Profile(name=stored["name"])
+
+    assert (await cache.get("u", load)).name == "new"
+    assert cache._generations == {} and cache._reads == {}
+
+
+async def test_loads_are_cached_without_invalidation():
+    cache = ReadThroughCache("test-profile-hit", Profile)
+    calls = []
+
+    async def load():
+        calls.append(1)
+        return Profile(name="a")
+
+    await cache.get("u", load)
+    await cache.get("u", load)
+    assert len(calls) == 1
@@ -0,0 +1,155 @@
+"""
+Blocklist matching, verdict caching across reloads, and what clients learn about a rejection.
+"""
+
+import contextlib
+import os
+import types
+
+import prisma
+import prisma.enums
+import project.generate_image_batch_service
+import project.prompt_canonicalizer
+import project.prompt_moderation
+import project.rate_limiting
+import project.server
+import project.session_tokens
+import pytest
+from project.prompt_moderation import BlocklistMatcher, load_blocklist, moderate_prompt, reload_blocklist
+from project.ttl_lru_cache import TTLLRUCache
+from starlette.testclient import TestClient
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def blocklist(monkeypatch, tmp_path):
+    """
+    Writes the blocklist file and returns a function that replaces its terms.
+    """
+    path = tmp_path / "blocklist.txt"
+    monkeypatch.setattr(project.prompt_moderation, "MODERATION_BLOCKLIST_PATH", str(path))
+    monkeypatch.setattr(project.prompt_moderation._BlocklistState, "matcher", BlocklistMatcher(()))
+    monkeypatch.setattr(project.prompt_moderation._BlocklistState, "version", 0)
+    monkeypatch.setattr(project.prompt_moderation._BlocklistState, "file_mtime", None)
+    monkeypatch.setattr(
+        project.prompt_moderation, "verdict_cache", TTLLRUCache(max_entries=16, ttl=60)
+    )
+    writes = []
+
+    def write(*terms: str) -> None:
+        path.write_text("\n".join(terms) + "\n", encoding="utf-8")
+        # Distinct mtimes even when the filesystem's resolution is coarser than the test.
+        writes.append(1)
+        os.utime(path, (len(writes), len(writes)))
+
+    return write
+
+
+def test_terms_match_whole_words_in_order_ignoring_case_and_punctuation():
+    matcher = BlocklistMatcher(["red panda", "blood"])
+    tokens = project.prompt_canonicalizer.prompt_tokens
+    assert matcher.first_match(tokens("A RED, panda!")) == "red panda"
+    assert matcher.first_match(tokens("a panda, red")) is None
+    assert matcher.first_match(tokens("a bloody bloodhound")) is None
+    assert len(matcher) == 2
+
+
+def test_matching_follows_failure_links():
+    matcher = BlocklistMatcher(["big red cat", "red dog", "w x y", "x"])
+    assert matcher.first_match(["big", "red", "dog"]) == "red dog"
+    # "x" is a suffix of the partial match "w x", so it is found without backtracking.
+    assert matcher.first_match(["w", "x"]) == "x"
+
+
+def test_blocklist_files_skip_comments_and_blank_lines(tmp_path):
+    path = tmp_path / "blocklist.txt"
+    path.write_text("# header\nred panda  # an animal\n\n  \nblood\n", encoding="utf-8")
+    matcher = load_blocklist(str(path))
+    assert len(matcher) == 2
+    assert matcher.first_match(["header"]) is None
+
+
+async def test_a_reload_invalidates_cached_verdicts(blocklist):
+    blocklist("blood")
+    assert await reload_blocklist()
+    assert not await reload_blocklist()
+    assert moderate_prompt("a blood moon", None, None).term == "blood"
+    assert moderate_prompt("a red panda", None, None).allowed
+    blocklist("red panda")
+    assert await reload_blocklist()
+    assert moderate_prompt("a red panda", None, None).term == "red panda"
+    assert moderate_prompt("a blood moon", None, None).allowed
+
+
+async def test_theme_style_and_options_are_checked(blocklist):
+    blocklist("blood")
+    await reload_blocklist()
+    assert not moderate_prompt("a moon", "blood", None).allowed
+    assert not moderate_prompt("a moon", None, None, {"mood": "blood"}).allowed
+    assert moderate_prompt("a moon", "night", "oil", {"mood": "calm"}).allowed
+
+
+def test_a_rejected_request_id_is_not_returned_before_it_is_written(blocklist, monkeypatch):
+    blocklist("blood")
+    project.prompt_moderation._BlocklistState.matcher = load_blocklist(
+        project.prompt_moderation.MODERATION_BLOCKLIST_PATH
+    )
+    plan = project.rate_limiting.UserPlan(user_id="u", role=prisma.enums.UserRole.ADMIN)
+
+    async def get_plan(user_id, cost=1):
+        return plan
+
+    buffered = []
+    monkeypatch.setattr(project.rate_limiting, "get_user_plan", get_plan)
+    monkeypatch.setattr(project.rate_limiting, "acquire_generation_tokens", get_plan)
+    monkeypatch.setattr(project.prompt_moderation.moderation_report_buffer, "offer", buffered.append)
+    app = project.server.app
+    app.dependency_overrides[project.session_tokens.require_session] = lambda: types.SimpleNamespace(
+        sub="u", role=prisma.enums.UserRole.ADMIN
+    )
+    try:
+        response = TestClient(app).post(
+            "/image/generate/",
+            params={"text_description": "a blood moon", "ai_model": "DALLE2", "theme": "", "style": ""},
+        )
+    finally:
+        app.dependency_overrides.clear()
+    assert response.status_code == 422
+    assert response.json() == {"detail": {"error": "The prompt was rejected by content moderation"}}
+    [(row, _, report)] = buffered
+    assert row["status"] == prisma.enums.ImageRequestStatus.FAILED
+    assert report["imageRequestId"] == row["id"]
+    assert row["id"] not in response.text
+
+
+async def test_a_rejected_batch_prompt_is_written_with_the_batch(blocklist, monkeypatch):
+    blocklist("blood")
+    await reload_blocklist()
+    written = {}
+
+    @contextlib.asynccontextmanager
+    async def batch_():
+        yield types.SimpleNamespace(
+            imagerequest=types.SimpleNamespace(
+                create_many=lambda data: written.setdefault("requests", []).extend(data)
+            ),
+            custoption=types.SimpleNamespace(create_many=lambda data: None),
+            moderationreport=types.SimpleNamespace(
+                create_many=lambda data: written.setdefault("reports", []).extend(data)
+            ),
+        )
+
+    monkeypatch.setattr(prisma, "get_client", lambda: types.SimpleNamespace(batch_=batch_))
+    batch = await project.generate_image_batch_service.start_image_batch(
+        "u",
+        [
+            project.generate_image_batch_service.BatchPrompt(
+                text_description="a blood moon", ai_model=prisma.enums.AIModel.DALLE2
+            )
+        ],
+    )
+    [item] = [item async for item in batch.results()]
+    assert item.status == prisma.enums.ImageRequestStatus.FAILED
+    assert [row["id"] for row in written["requests"]] == [item.request_id]
+    assert [report["imageRequestId"] for report in written["reports"]] == [item.request_id]
@@ -0,0 +1,89 @@
+"""
+Near-duplicate prompts in "suggest" and "serve" mode, with the database kept out of the way.
+"""
+
+import types
+import uuid
+
+import prisma.enums
+import project.generate_image_service
+import project.generation_accounting
+import project.image_events
+import project.image_request_store
+import project.image_result_cache
+import project.prompt_similarity_index
+import pytest
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def rows(monkeypatch):
+    """
+    Records created requests in a list instead of the database and indexes one earlier image of another user.
+    """
+    created = []
+
+    async def create_image_request(user_id, text_description, ai_model, theme, style, status, **kwargs):
+        row = types.SimpleNamespace(id=str(uuid.uuid4()), userId=user_id, status=status, **kwargs)
+        created.append(row)
+        return row
+
+    async def noop(*args, **kwargs):
+        pass
+
+    async def render_image(*args, **kwargs):
+        return "/image/new/file"
+
+    async def cache_miss(key):
+        return None
+
+    index = project.prompt_similarity_index.PromptSimilarityIndex(threshold=0.5)
+    index.add(
+        "other-users-request",
+        "/image/earlier/file",
+        "a small red fox sleeping in the snow",
+        prisma.enums.AIModel.DALLE2,
+        None,
+        None,
+    )
+    monkeypatch.setattr(project.prompt_similarity_index, "prompt_similarity_index", index)
+    monkeypatch.setattr(project.image_request_store, "create_image_request", create_image_request)
+    monkeypatch.setattr(project.generation_accounting, "record_generation", noop)
+    monkeypatch.setattr(project.prompt_similarity_index, "record_completed_image", noop)
+    monkeypatch.setattr(project.image_events, "publish_status", noop)
+    monkeypatch.setattr(project.generate_image_service, "render_image", render_image)
+    monkeypatch.setattr(project.image_result_cache.image_result_cache, "get", cache_miss)
+    return created
+
+
+async def test_suggest_attaches_only_the_image(rows, monkeypatch):
+    monkeypatch.setattr(project.prompt_similarity_index, "PROMPT_SIMILARITY_MODE", "suggest")
+    res = await project.generate_image_service.generate_image(
+        "caller", "a small red fox sleeping in snow", prisma.enums.AIModel.DALLE2, None, None
+    )
+    assert res.image_url == "/image/new/file"
+    assert res.similar_image.model_dump().keys() == {"image_url", "similarity"}
+    assert res.similar_image.image_url == "/image/earlier/file"
+
+
+@pytest.mark.parametrize("queued", [False, True])
+async def test_serve_records_a_request_for_the_caller(rows, monkeypatch, queued):
+    monkeypatch.setattr(project.prompt_similarity_index, "PROMPT_SIMILARITY_MODE", "serve")
+    generate = (
+        project.generate_image_service.enqueue_generate_image
+        if queued
+        else project.generate_image_service.generate_image
+    )
+    res = await generate(
+        "caller", "a small red fox sleeping in snow", prisma.enums.AIModel.DALLE2, None, None
+    )
+    assert res.image_url == "/image/earlier/file"
+    assert res.request_id != "other-users-request"
+    [row] = rows
+    assert (row.id, row.userId, row.status) == (
+        res.request_id,
+        "caller",
+        prisma.enums.ImageRequestStatus.COMPLETED,
+    )
+    assert row.image_url == "/image/earlier/file"
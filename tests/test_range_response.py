@@ -0,0 +1,30 @@
+"""
+Parsing of Range headers into byte ranges.
+"""
+
+import pytest
+from project.range_response import RangeFileResponse, parse_range
+
+
+@pytest.mark.parametrize(
+    "header, expected",
+    [
+        ("bytes=0-3", (0, 4)),
+        ("bytes=5-", (5, 10)),
+        ("bytes=-3", (7, 10)),
+        ("bytes=8-20", (8, 10)),
+        ("bytes=10-", None),
+        ("bytes=-0", None),
+        ("bytes=5-2", (0, 10)),
+        ("bytes=0-1,4-5", (0, 10)),
+        ("items=0-1", (0, 10)),
+    ],
+)
+def test_parse_range(header, expected):
+    assert parse_range(header, 10) == expected
+
+
+def test_reversed_range_serves_the_whole_file():
+    response = RangeFileResponse("unused", 10, "image/png", '"e"', range_header="bytes=5-2")
+    assert response.status_code == 200
+    assert response.headers["content-length"] == "10"
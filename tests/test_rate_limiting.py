@@ -0,0 +1,98 @@
+"""
+The generation token bucket and the quotas of each plan.
+"""
+
+import types
+
+import prisma.enums
+import project.rate_limiting
+import project.shared_state
+import pytest
+from project.rate_limiting import RateLimitExceeded, UserPlan, acquire_generation_tokens
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(project.shared_state, "time", types.SimpleNamespace(monotonic=lambda: now[0]))
+    return now
+
+
+@pytest.fixture
+def state(monkeypatch):
+    state = project.shared_state.InMemorySharedState()
+    monkeypatch.setattr(project.shared_state, "_shared_state", state)
+    return state
+
+
+@pytest.fixture
+def plan(monkeypatch):
+    plan = UserPlan(user_id="u", role=prisma.enums.UserRole.USER)
+
+    async def get_user_plan(user_id):
+        return plan
+
+    monkeypatch.setattr(project.rate_limiting, "get_user_plan", get_user_plan)
+    return plan
+
+
+async def test_bucket_allows_a_burst_then_refills_at_the_rate(clock, state):
+    takes = [await state.take_token("k", rate=1.0, burst=3) for _ in range(4)]
+    assert takes == [0, 0, 0, 1.0]
+    clock[0] += 0.5
+    assert await state.take_token("k", rate=1.0, burst=3) == pytest.approx(0.5)
+    clock[0] += 0.5
+    assert await state.take_token("k", rate=1.0, burst=3) == 0
+    clock[0] += 60
+    assert await state.take_token("k", rate=1.0, burst=3, cost=3) == 0
+
+
+@pytest.mark.parametrize(
+    "role, tier, name",
+    [
+        (prisma.enums.UserRole.USER, None, "FREE"),
+        (prisma.enums.UserRole.USER, prisma.enums.SubscriptionTier.BASIC, "BASIC"),
+        (prisma.enums.UserRole.USER, prisma.enums.SubscriptionTier.PREMIUM, "PREMIUM"),
+        (prisma.enums.UserRole.ADMIN, prisma.enums.SubscriptionTier.BASIC, "ADMIN"),
+    ],
+)
+def test_plan_follows_role_and_tier(role, tier, name):
+    plan = UserPlan(user_id="u", role=role, tier=tier)
+    assert plan.name == name
+    assert plan.quota == project.rate_limiting.PLAN_QUOTAS[name]
+
+
+def test_quotas_can_be_overridden_from_the_environment(monkeypatch):
+    monkeypatch.setenv("RATE_LIMIT_FREE_PER_MINUTE", "")
+    monkeypatch.setenv("RATE_LIMIT_BASIC_BURST", "3")
+    assert project.rate_limiting._quota("FREE").per_minute is None
+    basic = project.rate_limiting._quota("BASIC")
+    assert (basic.per_minute, basic.burst, basic.weight) == (20, 3, 2)
+
+
+async def test_a_plan_is_limited_to_its_burst(clock, state, plan):
+    quota = plan.quota
+    for _ in range(quota.burst):
+        await acquire_generation_tokens(plan.user_id)
+    with pytest.raises(RateLimitExceeded) as exc_info:
+        await acquire_generation_tokens(plan.user_id)
+    assert exc_info.value.retry_after == pytest.approx(60 / quota.per_minute)
+    response = project.rate_limiting.rate_limit_response(exc_info.value)
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == str(round(60 / quota.per_minute))
+    clock[0] += 60 / quota.per_minute
+    await acquire_generation_tokens(plan.user_id)
+
+
+async def test_a_request_larger_than_the_burst_is_refused(clock, state, plan):
+    with pytest.raises(ValueError):
+        await acquire_generation_tokens(plan.user_id, cost=plan.quota.burst + 1)
+
+
+async def test_unlimited_plans_take_no_tokens(clock, state, plan):
+    plan.role = prisma.enums.UserRole.ADMIN
+    for _ in range(100):
+        await acquire_generation_tokens(plan.user_id)
+    assert await state.take_token(f"rate-limit:generate:{plan.user_id}", 1.0, 1) == 0
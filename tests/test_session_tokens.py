@@ -0,0 +1,76 @@
+"""
+Logout revocations across workers, with an in-memory backend standing in for a shared one.
+"""
+
+import asyncio
+import json
+
+import prisma.enums
+import project.session_tokens
+import project.shared_state
+import pytest
+from project.session_tokens import InvalidSessionToken
+
+pytestmark = pytest.mark.anyio
+
+
+class SharedInMemoryState(project.shared_state.InMemorySharedState):
+    @property
+    def is_shared(self) -> bool:
+        return True
+
+
+@pytest.fixture
+def shared_state(monkeypatch):
+    state = SharedInMemoryState()
+    monkeypatch.setattr(project.shared_state, "_shared_state", state)
+    return state
+
+
+def new_worker(monkeypatch) -> None:
+    """
+    Gives this process the empty denylist and token cache of a worker that has just started.
+    """
+    monkeypatch.setattr(
+        project.session_tokens, "revoked_tokens", project.session_tokens.RevokedTokenDenylist()
+    )
+    project.session_tokens.verified_tokens.clear()
+
+
+async def test_revocation_from_before_a_worker_started_is_honoured(shared_state, monkeypatch):
+    token = project.session_tokens.issue_session_token("user", prisma.enums.UserRole.USER)
+    await project.session_tokens.revoke_session_token(token)
+    new_worker(monkeypatch)
+    with pytest.raises(InvalidSessionToken):
+        await project.session_tokens.authenticate_session_token(token)
+    # Remembered locally, so the synchronous check rejects it from now on as well.
+    with pytest.raises(InvalidSessionToken):
+        project.session_tokens.verify_session_token(token)
+
+
+async def test_revocation_published_by_another_worker_rejects_a_cached_token(
+    shared_state, monkeypatch
+):
+    new_worker(monkeypatch)
+    token = project.session_tokens.issue_session_token("user", prisma.enums.UserRole.USER)
+    claims = await project.session_tokens.authenticate_session_token(token)
+    project.session_tokens.start_session_revocations()
+    try:
+        await asyncio.sleep(0)
+        await shared_state.publish(
+            project.session_tokens.REVOCATION_CHANNEL,
+            json.dumps({"jti": claims.jti, "exp": claims.exp}),
+        )
+        await asyncio.sleep(0.01)
+        with pytest.raises(InvalidSessionToken):
+            await project.session_tokens.authenticate_session_token(token)
+    finally:
+        await project.session_tokens.stop_session_revocations()
+
+
+async def test_unrevoked_tokens_still_verify(shared_state, monkeypatch):
+    new_worker(monkeypatch)
+    token = project.session_tokens.issue_session_token("user", prisma.enums.UserRole.USER)
+    claims = await project.session_tokens.authenticate_session_token(token)
+    assert claims.sub == "user"
+    assert (await project.session_tokens.authenticate_session_token(token)).jti == claims.jti
@@ -0,0 +1,54 @@
+"""
+Profile updates, through the endpoint and against Postgres (see the database fixture).
+"""
+
+import types
+from datetime import datetime
+
+import project.get_user_profile_service
+import project.server
+import project.update_user_profile_service
+import pytest
+from project.update_user_profile_service import UserProfileUpdateResponse, update_user_profile
+from starlette.testclient import TestClient
+
+pytestmark = pytest.mark.anyio
+
+
+def test_endpoint_passes_the_fields_in_order(monkeypatch):
+    calls = []
+
+    async def update(*args):
+        calls.append(args)
+        id, email, firstName, lastName, bio = args
+        return UserProfileUpdateResponse(
+            id=id,
+            email=email,
+            firstName=firstName,
+            lastName=lastName,
+            bio=bio,
+            updatedAt=datetime(2024, 1, 1),
+        )
+
+    monkeypatch.setattr(project.update_user_profile_service, "update_user_profile", update)
+    response = TestClient(project.server.app).put(
+        "/user/profile/u1/update",
+        params={"firstName": "Ada", "lastName": "Lovelace", "email": "ada@example.com", "bio": "hi"},
+    )
+    assert response.status_code == 200
+    assert calls == [("u1", "ada@example.com", "Ada", "Lovelace", "hi")]
+
+
+async def test_an_update_evicts_the_cached_profile(database, user):
+    await database.profile.create(data={"userId": user.id, "firstName": "Old", "lastName": "Name"})
+    cached = await project.get_user_profile_service.get_user_profile(user.id)
+    assert cached.firstName == "Old"
+    await update_user_profile(user.id, "new@example.com", "New", "Name", None)
+    profile = await project.get_user_profile_service.get_user_profile(user.id)
+    assert (profile.email, profile.firstName) == ("new@example.com", "New")
+
+
+async def test_an_update_creates_a_missing_profile(database, user):
+    await update_user_profile(user.id, user.email, "First", "Last", None)
+    profiles = await database.profile.find_many(where={"userId": user.id})
+    assert [(p.firstName, p.lastName) for p in profiles] == [("First", "Last")]